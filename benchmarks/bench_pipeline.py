@@ -0,0 +1,258 @@
+"""
+Measures every stage of `MangaTranslator._translate` on synthetic pages and writes the results as
+JSON, so that runs on different commits can be compared with `compare.py`.
+
+By default detection and OCR return the ground truth of the synthetic page instead of running
+their models, so the benchmark runs offline. Pass `--models` to run the configured detector and
+OCR as well (their weights have to be downloaded already or be downloadable).
+
+    python benchmarks/bench_pipeline.py --sizes 1024x1536,2048x3072 --regions 4,16 -o before.json
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import torch
+
+from benchmarks.synthetic import make_page
+from manga_translator import MangaTranslator, Config, Context
+from manga_translator.config import Translator, Inpainter, Detector, Ocr
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Stages of `MangaTranslator._translate` and the methods that run them
+STAGES = {
+    'colorization': '_run_colorizer',
+    'upscaling': '_run_upscaling',
+    'detection': '_run_detection',
+    'ocr': '_run_ocr',
+    'textline_merge': '_run_textline_merge',
+    'translation': '_run_text_translation',
+    'mask_refinement': '_run_mask_refinement',
+    'inpainting': '_run_inpainting',
+    'rendering': '_run_text_rendering',
+}
+
+
+class RssSampler:
+    """Samples the resident set size of the process in a background thread to find its peak."""
+
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self._process = psutil.Process() if psutil else None
+        self._stop = threading.Event()
+        self._thread = None
+        self.start_rss = self.peak_rss = None
+
+    def rss(self) -> Optional[int]:
+        return self._process.memory_info().rss if self._process else None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self.rss())
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = self.rss()
+        if self._process:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self.peak_rss = max(self.peak_rss, self.rss())
+
+
+class StageProfiler:
+    """
+    Wraps the stage methods of a `MangaTranslator` and records wall time, peak RSS and the memory
+    allocated through the Python allocator (which numpy arrays are traced by) for every call.
+    """
+
+    def __init__(self, translator: MangaTranslator, trace_allocations: bool = True):
+        self.translator = translator
+        self.trace_allocations = trace_allocations
+        self.samples: Dict[str, List[dict]] = {}
+        for stage, method_name in STAGES.items():
+            setattr(translator, method_name, self._wrap(stage, getattr(translator, method_name)))
+
+    def _wrap(self, stage: str, method):
+        async def wrapper(*args, **kwargs):
+            if self.trace_allocations:
+                tracemalloc.reset_peak()
+                alloc_start, _ = tracemalloc.get_traced_memory()
+            with RssSampler() as rss:
+                start = time.perf_counter()
+                result = await method(*args, **kwargs)
+                wall = time.perf_counter() - start
+            sample = {'wall_s': wall}
+            if rss.peak_rss is not None:
+                sample['rss_peak_bytes'] = rss.peak_rss
+                sample['rss_growth_bytes'] = rss.peak_rss - rss.start_rss
+            if self.trace_allocations:
+                alloc_end, alloc_peak = tracemalloc.get_traced_memory()
+                sample['alloc_peak_bytes'] = alloc_peak - alloc_start
+                sample['alloc_retained_bytes'] = alloc_end - alloc_start
+            self.samples.setdefault(stage, []).append(sample)
+            return result
+        return wrapper
+
+    def reset(self):
+        self.samples = {}
+
+    def summary(self) -> Dict[str, dict]:
+        summary = {}
+        for stage, samples in self.samples.items():
+            walls = [s['wall_s'] for s in samples]
+            stats = {'calls': len(samples), 'wall_s': {'mean': statistics.mean(walls), 'min': min(walls), 'max': max(walls)}}
+            for field in ('rss_peak_bytes', 'rss_growth_bytes', 'alloc_peak_bytes', 'alloc_retained_bytes'):
+                if field in samples[0]:
+                    stats[field] = max(s[field] for s in samples)
+            summary[stage] = stats
+        return summary
+
+
+def use_ground_truth(translator: MangaTranslator, page: dict):
+    """Makes detection and OCR return the ground truth of the synthetic page currently in `page`"""
+    async def run_detection(config: Config, ctx: Context):
+        return copy.deepcopy(page['textlines']), page['mask'].copy(), None
+
+    async def run_ocr(config: Config, ctx: Context):
+        return ctx.textlines
+
+    translator._run_detection = run_detection
+    translator._run_ocr = run_ocr
+
+
+def parse_size(size: str):
+    width, height = size.lower().split('x')
+    return int(width), int(height)
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                         stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+async def run(args) -> dict:
+    translator = MangaTranslator({
+        'use_gpu': args.use_gpu,
+        'kernel_size': 3,
+        # models are loaded lazily by the warm-up runs
+        'models_ttl': 0,
+    })
+    config = Config()
+    config.detector.detector = args.detector
+    config.ocr.ocr = args.ocr
+    config.inpainter.inpainter = args.inpainter
+    config.translator.translator = args.translator
+    config.translator.target_lang = args.target_lang
+
+    page = {}
+    if not args.models:
+        use_ground_truth(translator, page)
+    profiler = StageProfiler(translator, not args.no_trace_allocations)
+    if not args.no_trace_allocations:
+        tracemalloc.start()
+
+    cases = []
+    for size in args.sizes.split(','):
+        width, height = parse_size(size)
+        for regions in (int(r) for r in args.regions.split(',')):
+            image, textlines, mask = make_page(width, height, regions, args.seed)
+            page.update(textlines=textlines, mask=mask)
+
+            totals = []
+            for i in range(args.warmup + args.repeat):
+                if i == args.warmup:
+                    profiler.reset()
+                ctx = Context(input=image, result=None)
+                start = time.perf_counter()
+                await translator._translate(config, ctx)
+                totals.append(time.perf_counter() - start)
+            totals = totals[args.warmup:]
+            cases.append({
+                'width': width,
+                'height': height,
+                'regions': regions,
+                'textlines': len(textlines),
+                'repeat': args.repeat,
+                'total_wall_s': {'mean': statistics.mean(totals), 'min': min(totals), 'max': max(totals)},
+                'stages': profiler.summary(),
+            })
+            print(f'{width}x{height}, {regions} regions: {statistics.mean(totals):.3f}s', file=sys.stderr)
+
+    return {
+        'environment': environment(),
+        'settings': {
+            'ground_truth_detection': not args.models,
+            'detector': args.detector,
+            'ocr': args.ocr,
+            'inpainter': args.inpainter,
+            'translator': args.translator,
+            'device': translator.device,
+            'trace_allocations': not args.no_trace_allocations,
+        },
+        'cases': cases,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the translation pipeline stage by stage on synthetic pages')
+    parser.add_argument('--sizes', default='1024x1536,2048x3072', help='Comma separated page sizes (WIDTHxHEIGHT)')
+    parser.add_argument('--regions', default='4,16', help='Comma separated numbers of speech bubbles per page')
+    parser.add_argument('--repeat', default=3, type=int, help='Measured runs per case')
+    parser.add_argument('--warmup', default=1, type=int, help='Runs per case before measuring, they include model loading')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the synthetic pages')
+    parser.add_argument('--models', action='store_true', help='Run the detector and OCR models instead of using the ground truth')
+    parser.add_argument('--detector', default=Detector.default, type=Detector, help='Detector used with --models')
+    parser.add_argument('--ocr', default=Ocr.ocr48px, type=Ocr, help='OCR used with --models')
+    parser.add_argument('--inpainter', default=Inpainter.none, type=Inpainter, help='Inpainter to benchmark')
+    parser.add_argument('--translator', default=Translator.original, type=Translator, choices=[Translator.none, Translator.original],
+                        help='Offline translator to benchmark')
+    parser.add_argument('--target-lang', default='ENG', help='Target language')
+    parser.add_argument('--use-gpu', action='store_true', help='Run the models on the GPU')
+    parser.add_argument('--no-trace-allocations', action='store_true',
+                        help='Do not trace allocations, tracing slows down the stages that allocate a lot')
+    parser.add_argument('-o', '--output', default=None, help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Compares two result files of `bench_pipeline.py`, e.g. of the commits before and after a change.
+
+    python benchmarks/compare.py before.json after.json
+"""
+import argparse
+import json
+
+
+def load_cases(path: str) -> dict:
+    with open(path, encoding='utf-8') as f:
+        results = json.load(f)
+    return {(c['width'], c['height'], c['regions']): c for c in results['cases']}
+
+
+def change(before, after) -> str:
+    if before is None or after is None:
+        return '-'
+    if before == 0:
+        return '   n/a' if after else '  0.0%'
+    return f'{(after - before) / before * 100:+6.1f}%'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two pipeline benchmark results')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+
+    before, after = load_cases(args.before), load_cases(args.after)
+    for key in sorted(before.keys() & after.keys()):
+        b, a = before[key], after[key]
+        print(f'{key[0]}x{key[1]}, {key[2]} regions: '
+              f'{b["total_wall_s"]["mean"]:.3f}s -> {a["total_wall_s"]["mean"]:.3f}s '
+              f'({change(b["total_wall_s"]["mean"], a["total_wall_s"]["mean"])})')
+        print(f'  {"stage":<16}{"wall before":>12}{"wall after":>12}{"change":>9}{"alloc peak change":>19}')
+        for stage in b['stages']:
+            if stage not in a['stages']:
+                continue
+            bs, as_ = b['stages'][stage], a['stages'][stage]
+            print(f'  {stage:<16}{bs["wall_s"]["mean"]:>11.4f}s{as_["wall_s"]["mean"]:>11.4f}s'
+                  f'{change(bs["wall_s"]["mean"], as_["wall_s"]["mean"]):>9}'
+                  f'{change(bs.get("alloc_peak_bytes"), as_.get("alloc_peak_bytes")):>19}')
+    for key in sorted(before.keys() ^ after.keys()):
+        print(f'{key[0]}x{key[1]}, {key[2]} regions: only in {"before" if key in before else "after"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import random
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from manga_translator.utils import Quadrilateral
+
+WORDS = ('the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog', 'manga', 'page', 'what', 'are',
+         'you', 'doing', 'here', 'wait', 'for', 'me', 'again', 'never', 'mind', 'run')
+
+
+def make_page(width: int, height: int, regions: int, seed: int = 0) -> Tuple[Image.Image, List[Quadrilateral], np.ndarray]:
+    """
+    Draws a synthetic manga page: a screentone background with `regions` white speech bubbles that
+    hold a few lines of text each. Returns the page, the textlines with their text (as detection
+    and OCR would return them) and the raw text mask.
+    """
+    rng = random.Random(seed)
+    noise = np.random.default_rng(seed).integers(0, 40, (height, width), dtype=np.uint8)
+    page = np.full((height, width, 3), 215, dtype=np.uint8)
+    page -= noise[..., None]
+    mask = np.zeros((height, width), dtype=np.uint8)
+    textlines = []
+
+    cols = max(1, int(np.ceil(np.sqrt(regions * width / height))))
+    rows = int(np.ceil(regions / cols))
+    cell_w, cell_h = width // cols, height // rows
+    font_scale = max(0.4, min(cell_w, cell_h) / 320)
+    thickness = max(1, int(font_scale * 2))
+    for i in range(regions):
+        x0, y0 = (i % cols) * cell_w, (i // cols) * cell_h
+        center = (x0 + cell_w // 2, y0 + cell_h // 2)
+        cv2.ellipse(page, center, (int(cell_w * 0.45), int(cell_h * 0.4)), 0, 0, 360, (255, 255, 255), -1)
+        cv2.ellipse(page, center, (int(cell_w * 0.45), int(cell_h * 0.4)), 0, 0, 360, (0, 0, 0), thickness)
+
+        lines = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 3))) for _ in range(rng.randint(2, 4))]
+        sizes = [cv2.getTextSize(line, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness) for line in lines]
+        line_h = max(h + b for (_, h), b in sizes) + thickness * 2
+        y = center[1] - line_h * len(lines) // 2
+        for line, ((w, h), b) in zip(lines, sizes):
+            x = center[0] - w // 2
+            cv2.putText(page, line, (x, y + h), cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 0, 0), thickness, cv2.LINE_AA)
+            cv2.putText(mask, line, (x, y + h), cv2.FONT_HERSHEY_SIMPLEX, font_scale, 255, thickness, cv2.LINE_AA)
+            pts = np.array([[x, y], [x + w, y], [x + w, y + h + b], [x, y + h + b]])
+            textlines.append(Quadrilateral(pts, line, 1., 0, 0, 0, 255, 255, 255))
+            y += line_h
+    return Image.fromarray(page), textlines, mask
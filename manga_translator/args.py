@@ -87,12 +87,26 @@ def general_parser(g_parser):
     g = g_parser.add_mutually_exclusive_group()
     g.add_argument('--use-gpu', action='store_true', help='Turn on/off gpu (auto switch between mps and cuda)')
     g.add_argument('--use-gpu-limited', action='store_true', help='Turn on/off gpu (excluding offline translator)')
+    g_parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'],
+                        help='Run the default detector, the 48px OCR and the LaMa inpainters through ONNX Runtime when they are on the CPU, the models are exported next to their weights on first use')
+    g_parser.add_argument('--onnx-intra-op-threads', default=0, type=int,
+                        help='Threads ONNX Runtime uses within an operator (0 lets ONNX Runtime decide)')
+    g_parser.add_argument('--onnx-inter-op-threads', default=0, type=int,
+                        help='Threads ONNX Runtime uses to run independent operators in parallel (0 lets ONNX Runtime decide)')
     g_parser.add_argument('--font-path', default='', type=file_path, help='Path to font file')
     g_parser.add_argument('--pre-dict', default=None, type=file_path, help='Path to the pre-translation dictionary file')
     g_parser.add_argument('--post-dict', default=None, type=file_path,
                         help='Path to the post-translation dictionary file')
     g_parser.add_argument('--kernel-size', default=3, type=int,
                         help='Set the convolution kernel size of the text erasure area to completely clean up text residues')
+    g_parser.add_argument('--translation-cache', default=None, type=str,
+                        help='Path to a SQLite database caching translations across runs, disabled by default')
+    g_parser.add_argument('--translation-cache-size', default=100000, type=int,
+                        help='Maximum number of translations kept in the translation cache, least recently used ones are evicted first')
+    g_parser.add_argument('--glyph-cache', default=None, type=str,
+                        help='Directory to keep the rasterized glyphs of every font in, so that later runs do not have to rasterize them again')
+    g_parser.add_argument('--artifact-cache', default=None, type=str,
+                        help='Directory to keep the intermediate results of every stage in, so that re-running an image only runs the stages after the first one whose settings changed')
 
 
 
@@ -122,6 +136,9 @@ g_batch.add_argument('--save-text-file', default='', type=str, help='Like --save
 parser_batch.add_argument('--prep-manual', action='store_true', help='Prepare for manual typesetting by outputting blank, inpainted images, plus copies of the original for reference')
 parser_batch.add_argument('--save-quality', default=100, type=int, help='Quality of saved JPEG image, range from 0 to 100 with 100 being best')
 parser_batch.add_argument('--config-file', default=None, type=str, help='path to the config file')
+parser_batch.add_argument('--batch-size', default=1, type=int, help='Number of images of a folder that are translated together. Larger values make better use of the models at the cost of memory')
+parser_batch.add_argument('--pipeline-depth', default=0, type=int, help='Overlap detection/OCR, translation and inpainting/rendering of consecutive images of a folder, with at most this many batches queued between two stages. 0 disables pipelining')
+parser_batch.add_argument('--coalesce-pages', default=1, type=int, help='Send the text of up to this many consecutive images of a batch to the translator in a single request, as long as it fits into the token limit of the translator')
 
 # WebSocket mode
 parser_ws = subparsers.add_parser('ws', help='Run in WebSocket mode')
@@ -130,6 +147,8 @@ parser_ws.add_argument('--port', default=5003, type=int, help='Port for WebSocke
 parser_ws.add_argument('--nonce', default=os.getenv('MT_WEB_NONCE', ''), type=str, help='Nonce for securing internal WebSocket communication')
 parser_ws.add_argument('--ws-url', default='ws://localhost:5000', type=str, help='Server URL for WebSocket mode')
 parser_ws.add_argument('--models-ttl', default='0', type=int, help='How long to keep models in memory in seconds after last use (0 means forever)')
+parser_ws.add_argument('--models-ram-budget', default=0, type=int, help='RAM in MB the loaded models may take up, the least recently used ones are unloaded beyond it (0 means unlimited)')
+parser_ws.add_argument('--models-vram-budget', default=0, type=int, help='VRAM in MB the loaded models may take up, the least recently used ones are unloaded beyond it (0 means unlimited)')
 
 # API mode
 parser_api = subparsers.add_parser('shared', help='Run in API mode')
@@ -138,5 +157,7 @@ parser_api.add_argument('--port', default=5003, type=int, help='Port for API ser
 parser_api.add_argument('--nonce', default=os.getenv('MT_WEB_NONCE', ''), type=str, help='Nonce for securing internal API server communication')
 parser_api.add_argument("--report", default=None,type=str, help='reports to server to register instance')
 parser_api.add_argument('--models-ttl', default='0', type=int, help='models TTL in memory in seconds')
+parser_api.add_argument('--models-ram-budget', default=0, type=int, help='RAM in MB the loaded models may take up, the least recently used ones are unloaded beyond it (0 means unlimited)')
+parser_api.add_argument('--models-vram-budget', default=0, type=int, help='VRAM in MB the loaded models may take up, the least recently used ones are unloaded beyond it (0 means unlimited)')
 
 subparsers.add_parser('config-help', help='Print help information for config file')
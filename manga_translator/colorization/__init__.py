@@ -3,6 +3,7 @@ from PIL import Image
 from .common import CommonColorizer, OfflineColorizer
 from .manga_colorization_v2 import MangaColorizationV2
 from ..config import Colorizer
+from ..utils import model_residency
 
 COLORIZERS = {
     Colorizer.mc2: MangaColorizationV2,
@@ -24,9 +25,12 @@ async def prepare(key: Colorizer):
 
 async def dispatch(key: Colorizer, device: str = 'cpu', **kwargs) -> Image.Image:
     colorizer = get_colorizer(key)
-    if isinstance(colorizer, OfflineColorizer):
-        await colorizer.load(device)
-    return await colorizer.colorize(**kwargs)
+    async with model_residency.pinned(colorizer):
+        if isinstance(colorizer, OfflineColorizer):
+            await colorizer.load(device)
+        return await colorizer.colorize(**kwargs)
 
 async def unload(key: Colorizer):
-    colorizer_cache.pop(key, None)
\ No newline at end of file
+    colorizer = colorizer_cache.pop(key, None)
+    if isinstance(colorizer, OfflineColorizer):
+        await colorizer.unload()
\ No newline at end of file
@@ -95,6 +95,7 @@ class Inpainter(str, Enum):
     sd = "sd"
     none = "none"
     original = "original"
+    hybrid = "hybrid"
 
 class Colorizer(str, Enum):
     none = "none"
@@ -279,6 +280,10 @@ class InpainterConfig(BaseModel):
     """Size of image used for inpainting (too large will result in OOM)"""
     inpainting_precision: InpaintPrecision = InpaintPrecision.bf16
     """Inpainting precision for lama, use bf16 while you can."""
+    hybrid_inpainter: Inpainter = Inpainter.lama_large
+    """Inpainter used by the hybrid inpainter for the masked areas that are not on a flat background"""
+    inpainting_roi: bool = False
+    """Only inpaint tiles around the masked areas at their native resolution instead of the whole (downscaled) page. Used by lama and the default inpainter"""
 
 class ColorizerConfig(BaseModel):
     colorization_size: int = 576
@@ -297,6 +302,10 @@ class OcrConfig(BaseModel):
     """Minimum text length of a text region"""
     ignore_bubble: int = 0
     """The threshold for ignoring text in non bubble areas, with valid values ranging from 1 to 50, does not ignore others. Recommendation 5 to 10. If it is too low, normal bubble areas may be ignored, and if it is too large, non bubble areas may be considered normal bubbles"""
+    beams_k: int = 5
+    """Number of hypotheses kept by the beam search of the 48px OCR models, 1 decodes greedily"""
+    batch_pixels: int = 1048576
+    """Pixel budget of an OCR batch. The textlines are batched by width and as many of them as fit into the budget with their padding are recognized together"""
 
 class Config(BaseModel):
     filter_text: Optional[str] = None
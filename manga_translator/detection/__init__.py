@@ -1,4 +1,5 @@
 import numpy as np
+from typing import List
 
 from .default import DefaultDetector
 from .dbnet_convnext import DBConvNextDetector
@@ -8,6 +9,7 @@ from .paddle import PaddleDetector
 from .none import NoneDetector
 from .common import CommonDetector, OfflineDetector
 from ..config import Detector
+from ..utils import model_residency
 
 DETECTORS = {
     Detector.default: DefaultDetector,
@@ -32,15 +34,29 @@ async def prepare(detector_key: Detector):
     if isinstance(detector, OfflineDetector):
         await detector.download()
 
-async def dispatch(detector_key: Detector, image: np.ndarray, detect_size: int, text_threshold: float, box_threshold: float, unclip_ratio: float,
-                   invert: bool, gamma_correct: bool, rotate: bool, auto_rotate: bool = False, device: str = 'cpu', verbose: bool = False):
+async def _load_detector(detector_key: Detector, device: str, text_threshold: float, box_threshold: float, unclip_ratio: float,
+                         invert: bool, verbose: bool) -> CommonDetector:
     detector = get_detector(detector_key)
     if isinstance(detector, OfflineDetector):
         if isinstance(detector, PaddleDetector):
             await detector.load(device, text_threshold=text_threshold, box_threshold=box_threshold, unclip_ratio=unclip_ratio, invert=invert, verbose=verbose)
         else:
             await detector.load(device)
-    return await detector.detect(image, detect_size, text_threshold, box_threshold, unclip_ratio, invert, gamma_correct, rotate, auto_rotate, verbose)
+    return detector
+
+async def dispatch(detector_key: Detector, image: np.ndarray, detect_size: int, text_threshold: float, box_threshold: float, unclip_ratio: float,
+                   invert: bool, gamma_correct: bool, rotate: bool, auto_rotate: bool = False, device: str = 'cpu', verbose: bool = False):
+    async with model_residency.pinned(get_detector(detector_key)):
+        detector = await _load_detector(detector_key, device, text_threshold, box_threshold, unclip_ratio, invert, verbose)
+        return await detector.detect(image, detect_size, text_threshold, box_threshold, unclip_ratio, invert, gamma_correct, rotate, auto_rotate, verbose)
+
+async def dispatch_batch(detector_key: Detector, images: List[np.ndarray], detect_size: int, text_threshold: float, box_threshold: float, unclip_ratio: float,
+                         invert: bool, gamma_correct: bool, rotate: bool, auto_rotate: bool = False, device: str = 'cpu', verbose: bool = False):
+    async with model_residency.pinned(get_detector(detector_key)):
+        detector = await _load_detector(detector_key, device, text_threshold, box_threshold, unclip_ratio, invert, verbose)
+        return await detector.detect_batch(images, detect_size, text_threshold, box_threshold, unclip_ratio, invert, gamma_correct, rotate, auto_rotate, verbose)
 
 async def unload(detector_key: Detector):
-    detector_cache.pop(detector_key, None)
\ No newline at end of file
+    detector = detector_cache.pop(detector_key, None)
+    if isinstance(detector, OfflineDetector):
+        await detector.unload()
\ No newline at end of file
@@ -4,7 +4,7 @@ from collections import Counter
 import numpy as np
 import cv2
 
-from ..utils import InfererModule, ModelWrapper, Quadrilateral
+from ..utils import InfererModule, ModelWrapper, Quadrilateral, TextlineArray
 
 
 class CommonDetector(InfererModule):
@@ -17,32 +17,13 @@ class CommonDetector(InfererModule):
 
         # Apply filters
         img_h, img_w = image.shape[:2]
-        orig_image = image.copy()
-        minimum_image_size = 400
-        # Automatically add border if image too small (instead of simply resizing due to them more likely containing large fonts)
-        add_border = min(img_w, img_h) < minimum_image_size
-        if rotate:
-            self.logger.debug('Adding rotation')
-            image = self._add_rotation(image)
-        if add_border:
-            self.logger.debug('Adding border')
-            image = self._add_border(image, minimum_image_size)
-        if invert:
-            self.logger.debug('Adding inversion')
-            image = self._add_inversion(image)
-        if gamma_correct:
-            self.logger.debug('Adding gamma correction')
-            image = self._add_gamma_correction(image)
-        # if True:
-        #     self.logger.debug('Adding histogram equalization')
-        #     image = self._add_histogram_equalization(image)
-
-        # cv2.imwrite('histogram.png', image)
-        # cv2.waitKey(0)
+        # the filters return new images and leave the original untouched
+        orig_image = image
+        image, add_border = self._apply_filters(image, invert, gamma_correct, rotate)
 
         # Run detection
         textlines, raw_mask, mask = await self._detect(image, detect_size, text_threshold, box_threshold, unclip_ratio, verbose)
-        textlines = list(filter(lambda x: x.area > 1, textlines))
+        textlines = self._filter_textlines(textlines)
 
         # Remove filters
         if add_border:
@@ -63,20 +44,82 @@ class CommonDetector(InfererModule):
 
         return textlines, raw_mask, mask
 
+    async def detect_batch(self, images: List[np.ndarray], detect_size: int, text_threshold: float, box_threshold: float, unclip_ratio: float,
+                           invert: bool, gamma_correct: bool, rotate: bool, auto_rotate: bool = False, verbose: bool = False):
+        '''
+        Batched version of `detect`. Returns a (textlines, raw mask, mask) tuple per image.
+        '''
+        if auto_rotate:
+            # Whether detection has to be rerun with rotation is decided per image
+            return [await self.detect(image, detect_size, text_threshold, box_threshold, unclip_ratio, invert, gamma_correct, rotate,
+                                      auto_rotate, verbose) for image in images]
+
+        filtered = [self._apply_filters(image, invert, gamma_correct, rotate) for image in images]
+        detections = await self._detect_batch([image for image, _ in filtered], detect_size, text_threshold, box_threshold,
+                                              unclip_ratio, verbose)
+
+        results = []
+        for orig_image, (image, add_border), (textlines, raw_mask, mask) in zip(images, filtered, detections):
+            img_h, img_w = orig_image.shape[:2]
+            textlines = self._filter_textlines(textlines)
+            if add_border:
+                textlines, raw_mask, mask = self._remove_border(image, img_w, img_h, textlines, raw_mask, mask)
+            if rotate:
+                textlines, raw_mask, mask = self._remove_rotation(textlines, raw_mask, mask, img_w, img_h)
+            results.append((textlines, raw_mask, mask))
+        return results
+
+    def _filter_textlines(self, textlines: List[Quadrilateral]) -> List[Quadrilateral]:
+        """Removes degenerate textlines, the geometry of the remaining ones is computed in one go"""
+        lines = TextlineArray(textlines)
+        return [txtln for txtln, area in zip(lines, lines.areas) if area > 1]
+
+    def _apply_filters(self, image: np.ndarray, invert: bool, gamma_correct: bool, rotate: bool) -> Tuple[np.ndarray, bool]:
+        img_h, img_w = image.shape[:2]
+        minimum_image_size = 400
+        # Automatically add border if image too small (instead of simply resizing due to them more likely containing large fonts)
+        add_border = min(img_w, img_h) < minimum_image_size
+        if rotate:
+            self.logger.debug('Adding rotation')
+            image = self._add_rotation(image)
+        if add_border:
+            self.logger.debug('Adding border')
+            image = self._add_border(image, minimum_image_size)
+        if invert or gamma_correct:
+            # Inversion and gamma correction are combined into one lookup table that is applied in a single pass
+            lut = np.arange(256, dtype=np.uint8)
+            if invert:
+                self.logger.debug('Adding inversion')
+                lut = self._add_inversion(lut)
+            if gamma_correct:
+                self.logger.debug('Adding gamma correction')
+                lut = self._gamma_correction_lut(image, lut)
+            image = cv2.LUT(image, lut)
+        # if True:
+        #     self.logger.debug('Adding histogram equalization')
+        #     image = self._add_histogram_equalization(image)
+
+        # cv2.imwrite('histogram.png', image)
+        # cv2.waitKey(0)
+        return image, add_border
+
     @abstractmethod
     async def _detect(self, image: np.ndarray, detect_size: int, text_threshold: float, box_threshold: float,
                       unclip_ratio: float, verbose: bool = False) -> Tuple[List[Quadrilateral], np.ndarray, np.ndarray]:
         pass
 
+    async def _detect_batch(self, images: List[np.ndarray], detect_size: int, text_threshold: float, box_threshold: float,
+                            unclip_ratio: float, verbose: bool = False) -> List[Tuple[List[Quadrilateral], np.ndarray, np.ndarray]]:
+        '''
+        May be overwritten by detectors that can process several images in one forward pass.
+        '''
+        return [await self._detect(image, detect_size, text_threshold, box_threshold, unclip_ratio, verbose) for image in images]
+
     def _add_border(self, image: np.ndarray, target_side_length: int):
         old_h, old_w = image.shape[:2]
         new_w = new_h = max(old_w, old_h, target_side_length)
-        new_image = np.zeros([new_h, new_w, 3]).astype(np.uint8)
-        # new_image[:] = np.array([255, 255, 255], np.uint8)
-        x, y = 0, 0
-        # x, y = (new_h - old_h) // 2, (new_w - old_w) // 2
-        new_image[y:y+old_h, x:x+old_w] = image
-        return new_image
+        # the image stays at the top left, the border is added to the right and bottom
+        return cv2.copyMakeBorder(image, 0, new_h - old_h, 0, new_w - old_w, cv2.BORDER_CONSTANT, value=0)
 
     def _remove_border(self, image: np.ndarray, old_w: int, old_h: int, textlines: List[Quadrilateral], raw_mask, mask):
         new_h, new_w = image.shape[:2]
@@ -116,12 +159,20 @@ class CommonDetector(InfererModule):
         return cv2.bitwise_not(image)
 
     def _add_gamma_correction(self, image: np.ndarray):
+        return cv2.LUT(image, self._gamma_correction_lut(image, np.arange(256, dtype=np.uint8)))
+
+    def _gamma_correction_lut(self, image: np.ndarray, lut: np.ndarray) -> np.ndarray:
+        '''
+        Returns `lut` followed by the gamma correction that brings the mean gray level of the image
+        mapped through `lut` to the middle. `lut` may only be the identity or the inversion.
+        '''
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         mid = 0.5
-        mean = np.mean(gray)
+        mean = cv2.mean(gray)[0]
+        if lut[0] > lut[255]:
+            mean = 255 - mean
         gamma = np.log(mid * 255) / np.log(mean)
-        img_gamma = np.power(image, gamma).clip(0,255).astype(np.uint8)
-        return img_gamma
+        return np.power(lut.astype(np.float64), gamma).clip(0, 255).astype(np.uint8)
 
     def _add_histogram_equalization(self, image: np.ndarray):
         img_yuv = cv2.cvtColor(image, cv2.COLOR_BGR2YUV)
@@ -140,6 +191,15 @@ class OfflineDetector(CommonDetector, ModelWrapper):
     async def _detect(self, *args, **kwargs):
         return await self.infer(*args, **kwargs)
 
+    async def _detect_batch(self, images: List[np.ndarray], *args, **kwargs):
+        if not self.is_loaded():
+            raise Exception(f'{self._key}: Tried to forward pass without having loaded the model.')
+        return await self._infer_batch(images, *args, **kwargs)
+
+    async def _infer_batch(self, images: List[np.ndarray], detect_size: int, text_threshold: float, box_threshold: float,
+                           unclip_ratio: float, verbose: bool = False):
+        return [await self._infer(image, detect_size, text_threshold, box_threshold, unclip_ratio, verbose) for image in images]
+
     @abstractmethod
     async def _infer(self, image: np.ndarray, detect_size: int, text_threshold: float, box_threshold: float,
                        unclip_ratio: float, verbose: bool = False):
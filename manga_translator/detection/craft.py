@@ -145,7 +145,10 @@ class CRAFTDetector(OfflineDetector):
         MODEL = self.model
 
     async def _unload(self):
+        global MODEL
+        MODEL = None
         del self.model
+        del self.model_refiner
 
     async def _infer(self, image: np.ndarray, detect_size: int, text_threshold: float, box_threshold: float,
                      unclip_ratio: float, verbose: bool = False):
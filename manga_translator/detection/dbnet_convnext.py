@@ -536,6 +536,8 @@ class DBConvNextDetector(OfflineDetector):
         MODEL = self.model
 
     async def _unload(self):
+        global MODEL
+        MODEL = None
         del self.model
 
     async def _infer(self, image: np.ndarray, detect_size: int, text_threshold: float, box_threshold: float,
@@ -546,7 +548,7 @@ class DBConvNextDetector(OfflineDetector):
 
         if db is None:
             # rearrangement is not required, fallback to default forward
-            img_resized, target_ratio, _, pad_w, pad_h = imgproc.resize_aspect_ratio(cv2.bilateralFilter(image, 17, 80, 80), detect_size, cv2.INTER_LINEAR, mag_ratio = 1)
+            img_resized, target_ratio, _, pad_w, pad_h = imgproc.resize_aspect_ratio(image, detect_size, cv2.INTER_LINEAR, mag_ratio = 1, bilateral_filter=(17, 80, 80))
             img_resized_h, img_resized_w = img_resized.shape[:2]
             ratio_h = ratio_w = 1 / target_ratio
             db, mask = det_batch_forward_default([img_resized], self.device)
@@ -561,17 +563,10 @@ class DBConvNextDetector(OfflineDetector):
         # boxes, scores = det({'shape': [(img_resized.shape[0], img_resized.shape[1])]}, db)
         boxes, scores = det({'shape':[(img_resized_h, img_resized_w)]}, db)
         boxes, scores = boxes[0], scores[0]
-        if boxes.size == 0:
-            polys = []
-        else:
-            idx = boxes.reshape(boxes.shape[0], -1).sum(axis=1) > 0
-            polys, _ = boxes[idx], scores[idx]
-            polys = polys.astype(np.float64)
-            polys = craft_utils.adjustResultCoordinates(polys, ratio_w, ratio_h, ratio_net=1)
-            polys = polys.astype(np.int64)
-
-        textlines = [Quadrilateral(pts.astype(int), '', score) for pts, score in zip(polys, scores)]
-        textlines = list(filter(lambda q: q.area > 16, textlines))
+        polys = craft_utils.adjustResultCoordinates(boxes.astype(np.float64), ratio_w, ratio_h, ratio_net=1).astype(np.int64)
+        keep = dbnet_utils.polygon_areas(polys) > 16
+
+        textlines = [Quadrilateral(pts, '', score) for pts, score in zip(polys[keep], scores[keep])]
         mask_resized = cv2.resize(mask, (mask.shape[1] * 2, mask.shape[0] * 2), interpolation=cv2.INTER_LINEAR)
         if pad_h > 0:
             mask_resized = mask_resized[:-pad_h, :]
@@ -47,28 +47,48 @@ class DefaultDetector(OfflineDetector):
         self.device = device
         if device == 'cuda' or device == 'mps':
             self.model = self.model.to(self.device)
+        elif self._use_onnx(device):
+            self.model = self._load_onnx(self.model, (torch.zeros(1, 3, 256, 256),), 'detect.ckpt', ['image'], ['db', 'mask'],
+                                         {name: {0: 'batch', 2: 'height', 3: 'width'} for name in ('image', 'db', 'mask')})
         global MODEL
         MODEL = self.model
 
     async def _unload(self):
+        global MODEL
+        MODEL = None
         del self.model
 
     async def _infer(self, image: np.ndarray, detect_size: int, text_threshold: float, box_threshold: float,
                      unclip_ratio: float, verbose: bool = False):
+        return (await self._infer_batch([image], detect_size, text_threshold, box_threshold, unclip_ratio, verbose))[0]
+
+    async def _infer_batch(self, images: List[np.ndarray], detect_size: int, text_threshold: float, box_threshold: float,
+                           unclip_ratio: float, verbose: bool = False):
+        results = [None] * len(images)
+        # Pages are grouped by their padded detection resolution so that each group is a single forward pass
+        buckets = {}
+        for i, image in enumerate(images):
+            # TODO: Move det_rearrange_forward to common.py and refactor
+            db, mask = det_rearrange_forward(image, det_batch_forward_default, detect_size, 4, device=self.device, verbose=verbose)
+
+            if db is None:
+                # rearrangement is not required, fallback to default forward
+                img_resized, target_ratio, _, pad_w, pad_h = imgproc.resize_aspect_ratio(image, detect_size, cv2.INTER_LINEAR, mag_ratio = 1, bilateral_filter=(17, 80, 80))
+                buckets.setdefault(img_resized.shape[:2], []).append((i, img_resized, 1 / target_ratio, pad_w, pad_h))
+            else:
+                img_resized_h, img_resized_w = image.shape[:2]
+                results[i] = self._postprocess(db, mask, img_resized_h, img_resized_w, 1, 0, 0, text_threshold, box_threshold, unclip_ratio)
 
-        # TODO: Move det_rearrange_forward to common.py and refactor
-        db, mask = det_rearrange_forward(image, det_batch_forward_default, detect_size, 4, device=self.device, verbose=verbose)
+        for (img_resized_h, img_resized_w), bucket in buckets.items():
+            db, mask = det_batch_forward_default([img_resized for _, img_resized, _, _, _ in bucket], self.device)
+            for j, (i, _, ratio, pad_w, pad_h) in enumerate(bucket):
+                results[i] = self._postprocess(db[j:j+1], mask[j:j+1], img_resized_h, img_resized_w, ratio, pad_w, pad_h,
+                                               text_threshold, box_threshold, unclip_ratio)
+        return results
 
-        if db is None:
-            # rearrangement is not required, fallback to default forward
-            img_resized, target_ratio, _, pad_w, pad_h = imgproc.resize_aspect_ratio(cv2.bilateralFilter(image, 17, 80, 80), detect_size, cv2.INTER_LINEAR, mag_ratio = 1)
-            img_resized_h, img_resized_w = img_resized.shape[:2]
-            ratio_h = ratio_w = 1 / target_ratio
-            db, mask = det_batch_forward_default([img_resized], self.device)
-        else:
-            img_resized_h, img_resized_w = image.shape[:2]
-            ratio_w = ratio_h = 1
-            pad_h = pad_w = 0
+    def _postprocess(self, db: np.ndarray, mask: np.ndarray, img_resized_h: int, img_resized_w: int, ratio: float, pad_w: int, pad_h: int,
+                     text_threshold: float, box_threshold: float, unclip_ratio: float):
+        ratio_w = ratio_h = ratio
         self.logger.info(f'Detection resolution: {img_resized_w}x{img_resized_h}')
 
         mask = mask[0, 0, :, :]
@@ -76,17 +96,10 @@ class DefaultDetector(OfflineDetector):
         # boxes, scores = det({'shape': [(img_resized.shape[0], img_resized.shape[1])]}, db)
         boxes, scores = det({'shape':[(img_resized_h, img_resized_w)]}, db)
         boxes, scores = boxes[0], scores[0]
-        if boxes.size == 0:
-            polys = []
-        else:
-            idx = boxes.reshape(boxes.shape[0], -1).sum(axis=1) > 0
-            polys, _ = boxes[idx], scores[idx]
-            polys = polys.astype(np.float64)
-            polys = craft_utils.adjustResultCoordinates(polys, ratio_w, ratio_h, ratio_net=1)
-            polys = polys.astype(np.int64)
+        polys = craft_utils.adjustResultCoordinates(boxes.astype(np.float64), ratio_w, ratio_h, ratio_net=1).astype(np.int64)
+        keep = dbnet_utils.polygon_areas(polys) > 16
 
-        textlines = [Quadrilateral(pts.astype(int), '', score) for pts, score in zip(polys, scores)]
-        textlines = list(filter(lambda q: q.area > 16, textlines))
+        textlines = [Quadrilateral(pts, '', score) for pts, score in zip(polys[keep], scores[keep])]
         mask_resized = cv2.resize(mask, (mask.shape[1] * 2, mask.shape[0] * 2), interpolation=cv2.INTER_LINEAR)
         if pad_h > 0:
             mask_resized = mask_resized[:-pad_h, :]
@@ -5,6 +5,13 @@ import numpy as np
 from shapely.geometry import Polygon
 import torch
 
+def polygon_areas(polys: np.ndarray) -> np.ndarray:
+    '''
+    Shoelace areas of N polygons given as an (N, K, 2) array of their points in order.
+    '''
+    x, y = polys[:, :, 0].astype(np.float64), polys[:, :, 1].astype(np.float64)
+    return np.abs((x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y).sum(axis=1)) / 2
+
 class SegDetectorRepresenter():
     def __init__(self, thresh=0.6, box_thresh=0.8, max_candidates=1000, unclip_ratio=2.2):
         self.min_size = 3
@@ -98,6 +105,11 @@ class SegDetectorRepresenter():
         '''
         _bitmap: single map with shape (H, W),
             whose values are binarized as {0, 1}
+
+        Returns the (K, 4, 2) int64 boxes of the K kept candidates in the destination size and their scores.
+        Every contour of the bitmap, holes included, is a candidate in the order of `cv2.findContours`.
+        Contours without holes are scored in one pass over the labelled connected components of the bitmap,
+        only the kept candidates are unclipped and their boxes are ordered and scaled together.
         '''
 
         assert len(_bitmap.shape) == 2
@@ -106,42 +118,73 @@ class SegDetectorRepresenter():
             pred = pred.cpu().detach().numpy()
         else:
             bitmap = _bitmap
+        bitmap = bitmap.astype(np.uint8)
         height, width = bitmap.shape
-        try:
-            contours, _ = cv2.findContours((bitmap * 255).astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        except ValueError:
-            return [], []
-        num_contours = min(len(contours), self.max_candidates)
-        boxes = np.zeros((num_contours, 4, 2), dtype=np.int64)
-        scores = np.zeros((num_contours,), dtype=np.float32)
-
-        for index in range(num_contours):
-            contour = contours[index].squeeze(1)
-            points, sside = self.get_mini_boxes(contour)
-            if sside < self.min_size:
-                continue
-            points = np.array(points)
-            score = self.box_score_fast(pred, contour)
-            if self.box_thresh > score:
-                continue
-
-            box = self.unclip(points, unclip_ratio=self.unclip_ratio).reshape(-1, 1, 2)
-            box, sside = self.get_mini_boxes(box)
-            if sside < self.min_size + 2:
-                continue
-            box = np.array(box)
-            if not isinstance(dest_width, int):
-                dest_width = dest_width.item()
-                dest_height = dest_height.item()
-
-            box[:, 0] = np.clip(np.round(box[:, 0] / width * dest_width), 0, dest_width)
-            box[:, 1] = np.clip(np.round(box[:, 1] / height * dest_height), 0, dest_height)
-            startidx = box.sum(axis=1).argmin()
-            box = np.roll(box, 4-startidx, 0)
-            box = np.array(box)
-            boxes[index, :, :] = box.astype(np.int64)
-            scores[index] = score
-        return boxes, scores
+        if not isinstance(dest_width, int):
+            dest_width = dest_width.item()
+            dest_height = dest_height.item()
+        no_boxes = np.zeros((0, 4, 2), dtype=np.int64), np.zeros((0,), dtype=np.float32)
+
+        contours, _ = cv2.findContours(bitmap, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+        if not contours:
+            return no_boxes
+
+        # every contour lies on the foreground pixels of one 8-connected component, the outer boundaries of the
+        # components run clockwise and the boundaries of their holes counter clockwise
+        num_labels, labels = cv2.connectedComponents(bitmap, connectivity=8, ltype=cv2.CV_32S)
+        first_points = np.array([c[0, 0] for c in contours])
+        contour_labels = labels[first_points[:, 1], first_points[:, 0]]
+        is_hole = np.array([cv2.contourArea(c, oriented=True) > 0 for c in contours])
+        has_holes = np.zeros(num_labels, dtype=bool)
+        has_holes[contour_labels[is_hole]] = True
+        contours = contours[:self.max_candidates]
+        rects = [cv2.minAreaRect(contour) for contour in contours]
+        candidates = np.array([i for i, (_, size, _) in enumerate(rects) if min(size) >= self.min_size], dtype=np.int64)
+        contour_labels, is_hole = contour_labels[candidates], is_hole[candidates]
+
+        # mean prediction of every component, summed over the foreground pixels only
+        foreground = np.flatnonzero(bitmap)
+        foreground_labels = labels.ravel()[foreground]
+        counts = np.bincount(foreground_labels, minlength=num_labels)
+        sums = np.bincount(foreground_labels, weights=pred.ravel()[foreground], minlength=num_labels)
+        scores = (sums / np.maximum(counts, 1))[contour_labels]
+        # the area inside a hole contour or an outer contour with holes differs from its component,
+        # those are filled and scored one by one
+        for i in np.flatnonzero(is_hole | has_holes[contour_labels]):
+            scores[i] = self.box_score_fast(pred, contours[candidates[i]].squeeze(1))
+        keep = scores >= self.box_thresh
+        candidates, scores = candidates[keep], scores[keep]
+        if candidates.size == 0:
+            return no_boxes
+
+        # only the kept candidates are unclipped, one by one as pyclipper offsets the corners rounded to integers
+        points = self.order_box_points(np.stack([cv2.boxPoints(rects[i]) for i in candidates]))
+        rects = [cv2.minAreaRect(self.unclip(p, unclip_ratio=self.unclip_ratio).reshape(-1, 1, 2)) for p in points]
+        keep = np.array([min(size) >= self.min_size + 2 for _, size, _ in rects])
+        if not keep.any():
+            return no_boxes
+        box = self.order_box_points(np.stack([cv2.boxPoints(rect) for rect, k in zip(rects, keep) if k]))
+        scores = scores[keep]
+
+        box[:, :, 0] = np.clip(np.round(box[:, :, 0] / width * dest_width), 0, dest_width)
+        box[:, :, 1] = np.clip(np.round(box[:, :, 1] / height * dest_height), 0, dest_height)
+        # start every box at its top-left most point
+        startidx = box.sum(axis=2).argmin(axis=1)
+        box = np.take_along_axis(box, ((np.arange(4)[None] + startidx[:, None]) % 4)[:, :, None], axis=1)
+        return box.astype(np.int64), scores.astype(np.float32)
+
+    @staticmethod
+    def order_box_points(points):
+        '''
+        Vectorized point order of `get_mini_boxes`: the two left points by x, each pair ordered by y.
+        '''
+        points = np.take_along_axis(points, np.argsort(points[:, :, 0], axis=1, kind='stable')[:, :, None], axis=1)
+        left_swap = points[:, 1, 1] <= points[:, 0, 1]
+        right_swap = points[:, 3, 1] <= points[:, 2, 1]
+        n = np.arange(len(points))
+        index_1 = left_swap.astype(int)
+        index_2 = np.where(right_swap, 3, 2)
+        return np.stack([points[n, index_1], points[n, index_2], points[n, 5 - index_2], points[n, 1 - index_1]], axis=1)
 
     def unclip(self, box, unclip_ratio=1.8):
         poly = Polygon(box)
@@ -34,7 +34,12 @@ def denormalizeMeanVariance(in_img, mean=(0.485, 0.456, 0.406), variance=(0.229,
     img = np.clip(img, 0, 255).astype(np.uint8)
     return img
 
-def resize_aspect_ratio(img, square_size, interpolation, mag_ratio=1):
+def resize_aspect_ratio(img, square_size, interpolation, mag_ratio=1, bilateral_filter=None):
+    '''
+    bilateral_filter: optional (d, sigma_color, sigma_space) of a `cv2.bilateralFilter` to smooth the image with.
+        It runs on the smaller of the original and the resized image, when downscaling its window is scaled
+        down along with the image.
+    '''
     height, width, channel = img.shape
 
     # magnify image size
@@ -47,7 +52,12 @@ def resize_aspect_ratio(img, square_size, interpolation, mag_ratio=1):
     ratio = target_size / max(height, width)    
 
     target_h, target_w = int(round(height * ratio)), int(round(width * ratio))
+    if bilateral_filter is not None and ratio >= 1:
+        img = cv2.bilateralFilter(img, *bilateral_filter)
     proc = cv2.resize(img, (target_w, target_h), interpolation = interpolation)
+    if bilateral_filter is not None and ratio < 1:
+        d, sigma_color, sigma_space = bilateral_filter
+        proc = cv2.bilateralFilter(proc, max(int(round(d * ratio)) | 1, 3), sigma_color, sigma_space * ratio)
 
     MULT = 256
 
@@ -61,8 +71,7 @@ def resize_aspect_ratio(img, square_size, interpolation, mag_ratio=1):
     if target_w % MULT != 0:
         pad_w = (MULT - target_w % MULT)
         target_w32 = target_w + pad_w
-    resized = np.zeros((target_h32, target_w32, channel), dtype=np.uint8)
-    resized[0:target_h, 0:target_w, :] = proc
+    resized = cv2.copyMakeBorder(proc, 0, pad_h, 0, pad_w, cv2.BORDER_CONSTANT, value=0)
     target_h, target_w = target_h32, target_w32
 
     size_heatmap = (int(target_w/2), int(target_h/2))
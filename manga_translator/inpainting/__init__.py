@@ -1,14 +1,16 @@
-from typing import Optional
+from typing import List, Optional
 
 import numpy as np
 
 from .common import CommonInpainter, OfflineInpainter
+from .hybrid import HybridInpainter
 from .inpainting_aot import AotInpainter
 from .inpainting_lama_mpe import LamaMPEInpainter, LamaLargeInpainter
 from .inpainting_sd import StableDiffusionInpainter
 from .none import NoneInpainter
 from .original import OriginalInpainter
 from ..config import Inpainter, InpainterConfig
+from ..utils import model_residency
 
 INPAINTERS = {
     Inpainter.default: AotInpainter,
@@ -17,6 +19,7 @@ INPAINTERS = {
     Inpainter.sd: StableDiffusionInpainter,
     Inpainter.none: NoneInpainter,
     Inpainter.original: OriginalInpainter,
+    Inpainter.hybrid: HybridInpainter,
 }
 inpainter_cache = {}
 
@@ -28,18 +31,48 @@ def get_inpainter(key: Inpainter, *args, **kwargs) -> CommonInpainter:
         inpainter_cache[key] = inpainter(*args, **kwargs)
     return inpainter_cache[key]
 
-async def prepare(inpainter_key: Inpainter, device: str = 'cpu'):
+def _hybrid_inner_key(config: InpainterConfig) -> Inpainter:
+    """The inpainter that the hybrid inpainter passes the textured areas to"""
+    if config.hybrid_inpainter == Inpainter.hybrid:
+        raise ValueError('The hybrid inpainter needs a different inpainter for the textured areas')
+    return config.hybrid_inpainter
+
+async def prepare(inpainter_key: Inpainter, device: str = 'cpu', config: Optional[InpainterConfig] = None):
+    config = config or InpainterConfig()
     inpainter = get_inpainter(inpainter_key)
+    if isinstance(inpainter, HybridInpainter):
+        await prepare(_hybrid_inner_key(config), device, config)
     if isinstance(inpainter, OfflineInpainter):
         await inpainter.download()
         await inpainter.load(device)
 
-async def dispatch(inpainter_key: Inpainter, image: np.ndarray, mask: np.ndarray, config: Optional[InpainterConfig], inpainting_size: int = 1024, device: str = 'cpu', verbose: bool = False) -> np.ndarray:
+def _get_inpainters(inpainter_key: Inpainter, config: InpainterConfig) -> List[CommonInpainter]:
+    inpainters = [get_inpainter(inpainter_key)]
+    if isinstance(inpainters[0], HybridInpainter):
+        inpainters.append(get_inpainter(_hybrid_inner_key(config)))
+    return inpainters
+
+async def _load_inpainter(inpainter_key: Inpainter, config: InpainterConfig, device: str) -> CommonInpainter:
     inpainter = get_inpainter(inpainter_key)
+    if isinstance(inpainter, HybridInpainter):
+        inpainter.inpainter = await _load_inpainter(_hybrid_inner_key(config), config, device)
     if isinstance(inpainter, OfflineInpainter):
         await inpainter.load(device)
+    return inpainter
+
+async def dispatch(inpainter_key: Inpainter, image: np.ndarray, mask: np.ndarray, config: Optional[InpainterConfig], inpainting_size: int = 1024, device: str = 'cpu', verbose: bool = False) -> np.ndarray:
+    config = config or InpainterConfig()
+    async with model_residency.pinned(*_get_inpainters(inpainter_key, config)):
+        inpainter = await _load_inpainter(inpainter_key, config, device)
+        return await inpainter.inpaint(image, mask, config, inpainting_size, verbose)
+
+async def dispatch_batch(inpainter_key: Inpainter, images: List[np.ndarray], masks: List[np.ndarray], config: Optional[InpainterConfig], inpainting_size: int = 1024, device: str = 'cpu', verbose: bool = False) -> List[np.ndarray]:
     config = config or InpainterConfig()
-    return await inpainter.inpaint(image, mask, config, inpainting_size, verbose)
+    async with model_residency.pinned(*_get_inpainters(inpainter_key, config)):
+        inpainter = await _load_inpainter(inpainter_key, config, device)
+        return await inpainter.inpaint_batch(images, masks, config, inpainting_size, verbose)
 
 async def unload(inpainter_key: Inpainter):
-    inpainter_cache.pop(inpainter_key, None)
\ No newline at end of file
+    inpainter = inpainter_cache.pop(inpainter_key, None)
+    if isinstance(inpainter, OfflineInpainter):
+        await inpainter.unload()
\ No newline at end of file
@@ -1,5 +1,6 @@
 import numpy as np
 from abc import abstractmethod
+from typing import List
 
 from ..config import InpainterConfig
 from ..utils import InfererModule, ModelWrapper
@@ -9,16 +10,33 @@ class CommonInpainter(InfererModule):
     async def inpaint(self, image: np.ndarray, mask: np.ndarray, config: InpainterConfig, inpainting_size: int = 1024, verbose: bool = False) -> np.ndarray:
         return await self._inpaint(image, mask, config, inpainting_size, verbose)
 
+    async def inpaint_batch(self, images: List[np.ndarray], masks: List[np.ndarray], config: InpainterConfig, inpainting_size: int = 1024, verbose: bool = False) -> List[np.ndarray]:
+        return await self._inpaint_batch(images, masks, config, inpainting_size, verbose)
+
     @abstractmethod
     async def _inpaint(self, image: np.ndarray, mask: np.ndarray, config: InpainterConfig, inpainting_size: int = 1024, verbose: bool = False) -> np.ndarray:
         pass
 
+    async def _inpaint_batch(self, images: List[np.ndarray], masks: List[np.ndarray], config: InpainterConfig, inpainting_size: int = 1024, verbose: bool = False) -> List[np.ndarray]:
+        '''
+        May be overwritten by inpainters that can process several images in one forward pass.
+        '''
+        return [await self._inpaint(image, mask, config, inpainting_size, verbose) for image, mask in zip(images, masks)]
+
 class OfflineInpainter(CommonInpainter, ModelWrapper):
     _MODEL_SUB_DIR = 'inpainting'
 
     async def _inpaint(self, *args, **kwargs):
         return await self.infer(*args, **kwargs)
 
+    async def _inpaint_batch(self, images: List[np.ndarray], masks: List[np.ndarray], *args, **kwargs):
+        if not self.is_loaded():
+            raise Exception(f'{self._key}: Tried to forward pass without having loaded the model.')
+        return await self._infer_batch(images, masks, *args, **kwargs)
+
+    async def _infer_batch(self, images: List[np.ndarray], masks: List[np.ndarray], config: InpainterConfig, inpainting_size: int = 1024, verbose: bool = False) -> List[np.ndarray]:
+        return [await self._infer(image, mask, config, inpainting_size, verbose) for image, mask in zip(images, masks)]
+
     @abstractmethod
     async def _infer(self, image: np.ndarray, mask: np.ndarray, config: InpainterConfig, inpainting_size: int = 1024, verbose: bool = False) -> np.ndarray:
         pass
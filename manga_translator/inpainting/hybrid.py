@@ -0,0 +1,74 @@
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from .common import CommonInpainter
+from ..config import InpainterConfig
+from ..utils.bubble import flat_background_color
+
+
+class HybridInpainter(CommonInpainter):
+    """
+    Fills the masked areas that sit on a flat background (most speech bubbles) with the colour of
+    the background and only passes the remaining areas to the neural inpainter `self.inpainter`.
+    """
+
+    # width of the ring around a masked area that its background colour is estimated from
+    _RING_WIDTH = 6
+    # gap between the masked area and the ring, skips the anti-aliased edges of the text
+    _RING_GAP = 2
+
+    def __init__(self):
+        super().__init__()
+        self.inpainter: Optional[CommonInpainter] = None
+
+    def fill_flat_areas(self, image: np.ndarray, mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the image with the masked areas on flat backgrounds filled and the mask of the
+        areas that are left for the neural inpainter.
+        """
+        binary = (mask >= 127).astype(np.uint8)
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+        height, width = binary.shape
+        img_filled = np.copy(image)
+        mask_textured = np.zeros_like(mask)
+        margin = self._RING_GAP + self._RING_WIDTH
+        kernel_gap = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * self._RING_GAP + 1,) * 2)
+        kernel_ring = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * margin + 1,) * 2)
+        filled = 0
+        for label in range(1, num_labels):
+            x, y, w, h, _ = stats[label]
+            x1, y1 = max(x - margin, 0), max(y - margin, 0)
+            x2, y2 = min(x + w + margin, width), min(y + h + margin, height)
+            component = (labels[y1:y2, x1:x2] == label).astype(np.uint8)
+            # other masked areas are excluded from the ring, they are inpainted anyway
+            excluded = cv2.dilate(binary[y1:y2, x1:x2], kernel_gap)
+            ring = (cv2.dilate(component, kernel_ring) > 0) & (excluded == 0)
+
+            component = component > 0
+            color = flat_background_color(image[y1:y2, x1:x2], ring)
+            if color is None:
+                mask_textured[y1:y2, x1:x2][component] = 255
+            else:
+                img_filled[y1:y2, x1:x2][component] = color
+                filled += 1
+        self.logger.info(f'Filled {filled} of {num_labels - 1} masked areas with their background colour')
+        return img_filled, mask_textured
+
+    async def _inpaint(self, image: np.ndarray, mask: np.ndarray, config: InpainterConfig, inpainting_size: int = 1024, verbose: bool = False) -> np.ndarray:
+        return (await self._inpaint_batch([image], [mask], config, inpainting_size, verbose))[0]
+
+    async def _inpaint_batch(self, images: List[np.ndarray], masks: List[np.ndarray], config: InpainterConfig, inpainting_size: int = 1024, verbose: bool = False) -> List[np.ndarray]:
+        results, textured = [], []
+        for i, (image, mask) in enumerate(zip(images, masks)):
+            img_filled, mask_textured = self.fill_flat_areas(image, mask)
+            results.append(img_filled)
+            if mask_textured.any():
+                textured.append((i, mask_textured))
+        if textured:
+            inpainted = await self.inpainter.inpaint_batch([results[i] for i, _ in textured], [m for _, m in textured],
+                                                           config, inpainting_size, verbose)
+            for (i, _), img_inpainted in zip(textured, inpainted):
+                results[i] = img_inpainted
+        return results
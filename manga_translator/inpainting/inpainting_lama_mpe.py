@@ -7,8 +7,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import cv2
+import math
 import os
 import shutil
+from typing import List, Optional, Tuple
 from torch import Tensor
 
 from .common import OfflineInpainter
@@ -49,18 +51,120 @@ class LamaMPEInpainter(OfflineInpainter):
         self.device = device
         if device.startswith('cuda') or device == 'mps':
             self.model.to(device)
+        elif self._use_onnx(device):
+            self._load_onnx_generator('inpainting_lama_mpe.ckpt')
 
     async def _unload(self):
         del self.model
 
-    async def _infer(self, image: np.ndarray, mask: np.ndarray, config: InpainterConfig, inpainting_size: int = 1024, verbose: bool = False) -> np.ndarray:
-        img_original = np.copy(image)
-        mask_original = np.copy(mask)
-        mask_original[mask_original < 127] = 0
-        mask_original[mask_original >= 127] = 1
-        mask_original = mask_original[:, :, None]
+    def _load_onnx_generator(self, weights_file: str):
+        """
+        Replaces the generator of `self.model` by its export run through ONNX Runtime, the masked
+        positional encodings are still computed in torch and passed to it.
+        """
+        names = ['image', 'mask']
+        inputs = [torch.zeros(1, 3, 256, 256), torch.zeros(1, 1, 256, 256)]
+        if self.model.mpe is not None:
+            names += ['rel_pos', 'direct']
+            inputs += [torch.zeros(1, 64, 256, 256), torch.zeros(1, 64, 256, 256)]
+        self.model.generator = self._load_onnx(self.model.generator, tuple(inputs), weights_file, names, ['output'],
+                                               {name: {0: 'batch', 2: 'height', 3: 'width'} for name in names + ['output']})
 
-        height, width, c = image.shape
+    async def _infer(self, image: np.ndarray, mask: np.ndarray, config: InpainterConfig, inpainting_size: int = 1024, verbose: bool = False) -> np.ndarray:
+        return (await self._infer_batch([image], [mask], config, inpainting_size, verbose))[0]
+
+    async def _infer_batch(self, images: List[np.ndarray], masks: List[np.ndarray], config: InpainterConfig, inpainting_size: int = 1024, verbose: bool = False) -> List[np.ndarray]:
+        # Every network input is either a whole page (tile is None) or a tile (y1, y2, x1, x2) of a page
+        jobs = []
+        results = [None] * len(images)
+        for i, mask in enumerate(masks):
+            tiles = self._roi_tiles(mask) if config.inpainting_roi else None
+            if tiles is None:
+                jobs.append((i, None))
+            else:
+                jobs.extend((i, tile) for tile in tiles)
+                # the tiles are pasted into a copy, the caller's image is left untouched
+                results[i] = images[i].copy()
+                self.logger.info(f'Inpainting {len(tiles)} tiles')
+
+        inputs = []
+        for i, tile in jobs:
+            if tile is None:
+                inputs.append(self._prepare_input(images[i], masks[i], inpainting_size))
+            else:
+                y1, y2, x1, x2 = tile
+                inputs.append(self._prepare_tile_input(images[i][y1:y2, x1:x2], masks[i][y1:y2, x1:x2], inpainting_size))
+
+        # Inputs are grouped by their inpainting resolution so that each group is a single forward pass
+        buckets = {}
+        for j, (img_torch, _, _) in enumerate(inputs):
+            buckets.setdefault(tuple(img_torch.shape[2:]), []).append(j)
+
+        for indices in buckets.values():
+            img_torch = torch.cat([inputs[j][0] for j in indices])
+            mask_torch = torch.cat([inputs[j][1] for j in indices])
+            img_inpainted_torch = self._forward(img_torch, mask_torch, config)
+            for j, img_inpainted in zip(indices, img_inpainted_torch):
+                i, tile = jobs[j]
+                h, w = inputs[j][2]
+                if tile is None:
+                    results[i] = self._blend_output(images[i], masks[i], img_inpainted[:, :h, :w])
+                else:
+                    y1, y2, x1, x2 = tile
+                    results[i][y1:y2, x1:x2] = self._blend_output(images[i][y1:y2, x1:x2], masks[i][y1:y2, x1:x2],
+                                                                  img_inpainted[:, :h, :w])
+        return results
+
+    # ROI inpainting: context kept around every masked area, relative to the size of the area
+    _ROI_CONTEXT = 0.5
+    _ROI_MIN_CONTEXT = 64
+    # pages whose tiles would cover more than this fraction of the page are inpainted as a whole
+    _ROI_MAX_COVERAGE = 0.5
+    # tiles are padded up to a multiple of this, so that tiles of similar sizes share a forward pass
+    _TILE_SIZE_CLASS = 128
+
+    def _roi_tiles(self, mask: np.ndarray) -> Optional[List[Tuple[int, int, int, int]]]:
+        """
+        Groups the connected components of `mask` into tiles (y1, y2, x1, x2) that hold the
+        components together with enough surrounding context. Overlapping tiles are merged.
+        Returns None if the page is better inpainted as a whole.
+        """
+        height, width = mask.shape[:2]
+        num_labels, _, stats, _ = cv2.connectedComponentsWithStats((mask >= 127).astype(np.uint8), connectivity=8)
+        tiles = []
+        for x, y, w, h, _ in stats[1:]:
+            context = max(self._ROI_MIN_CONTEXT, int(max(w, h) * self._ROI_CONTEXT))
+            tiles.append((max(y - context, 0), min(y + h + context, height), max(x - context, 0), min(x + w + context, width)))
+        tiles = merge_overlapping_tiles(tiles)
+
+        if sum((y2 - y1) * (x2 - x1) for y1, y2, x1, x2 in tiles) > self._ROI_MAX_COVERAGE * height * width:
+            return None
+        return tiles
+
+    def _tile_size(self, size: int, inpainting_size: int) -> int:
+        """Size of the network input for a tile side of `size`, see `_TILE_SIZE_CLASS`"""
+        padded = -(-size // self._TILE_SIZE_CLASS) * self._TILE_SIZE_CLASS
+        if padded > inpainting_size:
+            # not padded beyond the inpainting size, only to a multiple of 8
+            padded = -(-size // 8) * 8
+        return padded
+
+    def _prepare_tile_input(self, image: np.ndarray, mask: np.ndarray, inpainting_size: int):
+        """
+        Like `_prepare_input`, but tiles are padded to their size class (see `_tile_size`) instead
+        of being resized, so that they are inpainted at their native resolution.
+        """
+        if max(image.shape[0: 2]) > inpainting_size:
+            image = resize_keep_aspect(image, inpainting_size)
+            mask = resize_keep_aspect(mask, inpainting_size)
+        h, w = image.shape[:2]
+        pad_h, pad_w = self._tile_size(h, inpainting_size) - h, self._tile_size(w, inpainting_size) - w
+        if pad_h or pad_w:
+            image = np.pad(image, ((0, pad_h), (0, pad_w), (0, 0)), mode='symmetric')
+            mask = np.pad(mask, ((0, pad_h), (0, pad_w)))
+        return (*self._to_tensors(image, mask), (h, w))
+
+    def _prepare_input(self, image: np.ndarray, mask: np.ndarray, inpainting_size: int):
         if max(image.shape[0: 2]) > inpainting_size:
             image = resize_keep_aspect(image, inpainting_size)
             mask = resize_keep_aspect(mask, inpainting_size)
@@ -78,6 +182,9 @@ class LamaMPEInpainter(OfflineInpainter):
             image = cv2.resize(image, (new_w, new_h), interpolation = cv2.INTER_LINEAR)
             mask = cv2.resize(mask, (new_w, new_h), interpolation = cv2.INTER_LINEAR)
         self.logger.info(f'Inpainting resolution: {new_w}x{new_h}')
+        return (*self._to_tensors(image, mask), (new_h, new_w))
+
+    def _to_tensors(self, image: np.ndarray, mask: np.ndarray) -> Tuple[Tensor, Tensor]:
         if isinstance(self.model, LamaFourier):
             img_torch = torch.from_numpy(image).permute(2, 0, 1).unsqueeze_(0).float() / 255.
         else:
@@ -85,6 +192,9 @@ class LamaMPEInpainter(OfflineInpainter):
         mask_torch = torch.from_numpy(mask).unsqueeze_(0).unsqueeze_(0).float() / 255.0
         mask_torch[mask_torch < 0.5] = 0
         mask_torch[mask_torch >= 0.5] = 1
+        return img_torch, mask_torch
+
+    def _forward(self, img_torch: Tensor, mask_torch: Tensor, config: InpainterConfig) -> Tensor:
         if self.device.startswith('cuda') or self.device == 'mps':
             img_torch = img_torch.to(self.device)
             mask_torch = mask_torch.to(self.device)
@@ -105,17 +215,64 @@ class LamaMPEInpainter(OfflineInpainter):
 
                 with torch.autocast(device_type="cuda", dtype=precision):
                     img_inpainted_torch = self.model(img_torch, mask_torch)
+        return img_inpainted_torch
+
+    def _blend_output(self, img_original: np.ndarray, mask: np.ndarray, img_inpainted_torch: Tensor) -> np.ndarray:
+        """
+        Converts a single (C, H, W) network output back to an image of the original size
+        and pastes it into the original image wherever the mask is set.
+        """
+        mask_original = np.copy(mask)
+        mask_original[mask_original < 127] = 0
+        mask_original[mask_original >= 127] = 1
+        mask_original = mask_original[:, :, None]
 
+        height, width, c = img_original.shape
         if isinstance(self.model, LamaFourier):
-            img_inpainted = (img_inpainted_torch.cpu().squeeze_(0).permute(1, 2, 0).float().numpy() * 255.).astype(np.uint8)
+            img_inpainted = (img_inpainted_torch.cpu().permute(1, 2, 0).float().numpy() * 255.).astype(np.uint8)
         else:
-            img_inpainted = ((img_inpainted_torch.cpu().squeeze_(0).permute(1, 2, 0).float().numpy() + 1.0) * 127.5).astype(np.uint8)
-        if new_h != height or new_w != width:
+            img_inpainted = ((img_inpainted_torch.cpu().permute(1, 2, 0).float().numpy() + 1.0) * 127.5).astype(np.uint8)
+        if img_inpainted.shape[0] != height or img_inpainted.shape[1] != width:
             img_inpainted = cv2.resize(img_inpainted, (width, height), interpolation = cv2.INTER_LINEAR)
         ans = img_inpainted * mask_original + img_original * (1 - mask_original)
         return ans
     
 
+def merge_overlapping_tiles(tiles: List[Tuple[int, int, int, int]]) -> List[Tuple[int, int, int, int]]:
+    """
+    Merges tiles (y1, y2, x1, x2) that overlap into their bounding tile until no two tiles overlap.
+    Each pass sweeps over the tiles sorted by y1 and joins the overlapping ones with a union-find.
+    A merged tile can overlap tiles that none of its parts did, so this repeats until a pass merges
+    nothing, which usually happens on the second pass.
+    """
+    while True:
+        parent = list(range(len(tiles)))
+
+        def find(a: int) -> int:
+            while parent[a] != a:
+                parent[a] = parent[parent[a]]
+                a = parent[a]
+            return a
+
+        # tiles whose vertical range still reaches the current tile
+        active = []
+        for t in sorted(range(len(tiles)), key=lambda t: tiles[t][0]):
+            y1, _, x1, x2 = tiles[t]
+            active = [a for a in active if tiles[a][1] > y1]
+            for a in active:
+                if tiles[a][2] < x2 and x1 < tiles[a][3]:
+                    parent[find(a)] = find(t)
+            active.append(t)
+
+        groups = {}
+        for t, tile in enumerate(tiles):
+            groups.setdefault(find(t), []).append(tile)
+        if len(groups) == len(tiles):
+            return tiles
+        tiles = [(min(t[0] for t in group), max(t[1] for t in group), min(t[2] for t in group), max(t[3] for t in group))
+                 for group in groups.values()]
+
+
 class LamaLargeInpainter(LamaMPEInpainter):
 
     _MODEL_MAPPING = {
@@ -132,6 +289,8 @@ class LamaLargeInpainter(LamaMPEInpainter):
         self.device = device
         if device.startswith('cuda') or device == 'mps':
             self.model.to(device)
+        elif self._use_onnx(device):
+            self._load_onnx_generator('lama_large_512px.ckpt')
 
 
 
@@ -182,6 +341,50 @@ class FFCSE_block(nn.Module):
         return x_l, x_g
 
 
+def dft_basis(n, size, like: Tensor) -> Tuple[Tensor, Tensor]:
+    """
+    Returns the cos and sin (n, size) of the angles 2 * pi * j * k / n of the DFT of length `n`
+    for the first `size` frequencies k.
+    """
+    j = torch.arange(n, device=like.device)
+    k = torch.arange(size, device=like.device)
+    # reduced in integers, float32 angles lose their precision for large j * k
+    angles = torch.remainder(j[:, None] * k[None, :], n).to(like.dtype) * (2 * math.pi / n)
+    return torch.cos(angles), torch.sin(angles)
+
+
+def rfft2_ortho(x: Tensor) -> Tuple[Tensor, Tensor]:
+    """
+    `torch.fft.rfftn(x, dim=(-2, -1), norm='ortho')` as matrix products, returns the real and the
+    imaginary part. The ONNX exporter has no FFT ops.
+    """
+    h, w = x.shape[-2:]
+    cos_w, sin_w = dft_basis(w, w // 2 + 1, x)
+    real, imag = x @ cos_w, -(x @ sin_w)
+    cos_h, sin_h = dft_basis(h, h, x)
+    real, imag = cos_h @ real + sin_h @ imag, cos_h @ imag - sin_h @ real
+    # computed as a tensor so that the exported graph does not fix the size
+    scale = torch.rsqrt(torch.ones_like(x[..., :1, :1]) * (h * w))
+    return real * scale, imag * scale
+
+
+def irfft2_ortho(real: Tensor, imag: Tensor, w) -> Tensor:
+    """
+    Inverse of `rfft2_ortho` for an output width of `w`, like `torch.fft.irfftn(..., norm='ortho')`
+    it ignores the imaginary part of the DC and Nyquist frequencies.
+    """
+    h, size = real.shape[-2:]
+    cos_h, sin_h = dft_basis(h, h, real)
+    real, imag = cos_h @ real - sin_h @ imag, cos_h @ imag + sin_h @ real
+    cos_w, sin_w = dft_basis(w, size, real)
+    # the frequencies between DC and Nyquist stand in for their conjugates as well
+    k = torch.arange(size, device=real.device)
+    weights = torch.where((k == 0) | (k * 2 == w), 1, 2).to(real.dtype)
+    output = (real * weights) @ cos_w.transpose(0, 1) - (imag * weights) @ sin_w.transpose(0, 1)
+    scale = torch.rsqrt(torch.ones_like(output[..., :1, :1]) * (h * w))
+    return output * scale
+
+
 class FourierUnit(nn.Module):
 
     def __init__(self, in_channels, out_channels, groups=1, spatial_scale_factor=None, spatial_scale_mode='bilinear',
@@ -223,8 +426,12 @@ class FourierUnit(nn.Module):
         if x.dtype in (torch.float16, torch.bfloat16):
             x = x.type(torch.float32)
 
-        ffted = torch.fft.rfftn(x, dim=fft_dim, norm=self.fft_norm)
-        ffted = torch.stack((ffted.real, ffted.imag), dim=-1)
+        if torch.onnx.is_in_onnx_export():
+            assert not self.ffc3d and self.fft_norm == 'ortho'
+            ffted = torch.stack(rfft2_ortho(x), dim=-1)
+        else:
+            ffted = torch.fft.rfftn(x, dim=fft_dim, norm=self.fft_norm)
+            ffted = torch.stack((ffted.real, ffted.imag), dim=-1)
         ffted = ffted.permute(0, 1, 4, 2, 3).contiguous()  # (batch, c, 2, h, w/2+1)
         ffted = ffted.view((batch, -1,) + ffted.size()[3:])
 
@@ -244,10 +451,13 @@ class FourierUnit(nn.Module):
             0, 1, 3, 4, 2).contiguous()  # (batch,c, t, h, w/2+1, 2)
         if ffted.dtype in (torch.float16, torch.bfloat16):
             ffted = ffted.type(torch.float32)
-        ffted = torch.complex(ffted[..., 0], ffted[..., 1])
+        if torch.onnx.is_in_onnx_export():
+            output = irfft2_ortho(ffted[..., 0], ffted[..., 1], x.shape[-1])
+        else:
+            ffted = torch.complex(ffted[..., 0], ffted[..., 1])
 
-        ifft_shape_slice = x.shape[-3:] if self.ffc3d else x.shape[-2:]
-        output = torch.fft.irfftn(ffted, s=ifft_shape_slice, dim=fft_dim, norm=self.fft_norm)
+            ifft_shape_slice = x.shape[-3:] if self.ffc3d else x.shape[-2:]
+            output = torch.fft.irfftn(ffted, s=ifft_shape_slice, dim=fft_dim, norm=self.fft_norm)
 
         if self.spatial_scale_factor is not None:
             output = F.interpolate(output, size=orig_size, mode=self.spatial_scale_mode, align_corners=False)
@@ -711,10 +921,14 @@ class LamaFourier:
     def __call__(self, img: Tensor, mask: Tensor, rel_pos=None, direct=None):
 
         if self.mpe is not None:
-            # 1 batch only
-            rel_pos, _, direct = self.load_masked_position_encoding(mask[0][0].cpu().numpy())
-            rel_pos = torch.LongTensor(rel_pos).unsqueeze_(0).to(img.device)
-            direct = torch.LongTensor(direct).unsqueeze_(0).to(img.device)
+            # positional encodings are computed per sample
+            rel_pos, direct = [], []
+            for m in mask[:, 0].cpu().numpy():
+                sample_rel_pos, _, sample_direct = self.load_masked_position_encoding(m)
+                rel_pos.append(sample_rel_pos)
+                direct.append(sample_direct)
+            rel_pos = torch.LongTensor(np.stack(rel_pos)).to(img.device)
+            direct = torch.LongTensor(np.stack(direct)).to(img.device)
             rel_pos, direct = self.mpe(rel_pos, direct)
         else:
             rel_pos, direct = None, None
@@ -1,4 +1,7 @@
 import asyncio
+import collections
+import functools
+import itertools
 import cv2
 import json
 import langcodes
@@ -9,38 +12,46 @@ import time
 import torch
 import logging
 import sys
+import threading
 import traceback
 import numpy as np
 from PIL import Image
-from typing import Optional, Any
+from typing import Optional, Any, List, Iterable, AsyncIterator
 
 from .config import Config, Colorizer, Detector, Translator, Renderer, Inpainter
 from .utils import (
     BASE_PATH,
     LANGUAGE_ORIENTATION_PRESETS,
     ModelWrapper,
+    model_residency,
     Context,
+    Quadrilateral,
     load_image,
     dump_image,
+    chunks,
+    ArtifactStore,
     visualize_textblocks,
     is_valuable_text,
     sort_regions,
 )
 
-from .detection import dispatch as dispatch_detection, prepare as prepare_detection, unload as unload_detection
-from .upscaling import dispatch as dispatch_upscaling, prepare as prepare_upscaling, unload as unload_upscaling
-from .ocr import dispatch as dispatch_ocr, prepare as prepare_ocr, unload as unload_ocr
+from .detection import dispatch as dispatch_detection, dispatch_batch as dispatch_detection_batch, prepare as prepare_detection
+from .upscaling import dispatch as dispatch_upscaling, prepare as prepare_upscaling
+from .ocr import dispatch as dispatch_ocr, dispatch_batch as dispatch_ocr_batch, prepare as prepare_ocr
 from .textline_merge import dispatch as dispatch_textline_merge
 from .mask_refinement import dispatch as dispatch_mask_refinement
-from .inpainting import dispatch as dispatch_inpainting, prepare as prepare_inpainting, unload as unload_inpainting
+from .inpainting import dispatch as dispatch_inpainting, dispatch_batch as dispatch_inpainting_batch, prepare as prepare_inpainting
 from .translators import (
     LANGDETECT_MAP,
     dispatch as dispatch_translation,
     prepare as prepare_translation,
-    unload as unload_translation,
+    within_request_limit,
+    CommonTranslator,
+    TranslationCache,
 )
-from .colorization import dispatch as dispatch_colorization, prepare as prepare_colorization, unload as unload_colorization
+from .colorization import dispatch as dispatch_colorization, prepare as prepare_colorization
 from .rendering import dispatch as dispatch_rendering, dispatch_eng_render
+from .rendering.text_render import GlyphAtlas, set_glyph_atlas
 
 # Will be overwritten by __main__.py if module is being run directly (with python -m)
 logger = logging.getLogger('manga_translator')
@@ -51,6 +62,30 @@ def set_main_logger(l):
     logger = l
 
 
+def _timed_stage(stage: str, offload: bool = False):
+    """
+    Decorator for the `_run_*` methods, which take the config and the context of a page or the
+    list of contexts of a batch. Records a timing span of the stage in the `timings` of every context.
+
+    With `offload` the method is run in a worker thread (see `MangaTranslator._run_offloaded`),
+    for the blocking model and rendering stages.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self: 'MangaTranslator', config: Config, ctx, *args, **kwargs):
+            ctxs = ctx if isinstance(ctx, list) else [ctx]
+            inputs = [self._stage_inputs(c) for c in ctxs]
+            start = time.time()
+            started = time.perf_counter()
+            if offload:
+                result = await self._run_offloaded(stage, method(self, config, ctx, *args, **kwargs))
+            else:
+                result = await method(self, config, ctx, *args, **kwargs)
+            await self._record_timing(stage, ctxs, inputs, start, time.perf_counter() - started)
+            return result
+        return wrapper
+    return decorator
+
 class TranslationInterrupt(Exception):
     """
     Can be raised from within a progress hook to prematurely terminate
@@ -99,7 +134,11 @@ class MangaTranslator:
     device: Optional[str]
     kernel_size: Optional[int]
     models_ttl: int
+    batch_size: int
+    pipeline_depth: int
+    coalesce_pages: int
     _progress_hooks: list[Any]
+    _timing_hooks: list[Any]
     result_sub_folder: str
 
     def __init__(self, params: dict = None):
@@ -115,6 +154,9 @@ class MangaTranslator:
         self.models_ttl = 0
 
         self._progress_hooks = []
+        self._timing_hooks = []
+        # One lock per offloaded stage, see `_run_offloaded`
+        self._stage_locks = collections.defaultdict(threading.Lock)
         self._add_logger_hook()
 
         params = params or {}
@@ -128,8 +170,6 @@ class MangaTranslator:
         # The flag below controls whether to allow TF32 on cuDNN. This flag defaults to True.
         torch.backends.cudnn.allow_tf32 = True
 
-        self._model_usage_timestamps = {}
-        self._detector_cleanup_task = None
         self.prep_manual = params.get('prep_manual', None)
         
     def parse_init_params(self, params: dict):
@@ -137,6 +177,13 @@ class MangaTranslator:
         self.use_mtpe = params.get('use_mtpe', False)
         self.font_path = params.get('font_path', None)
         self.models_ttl = params.get('models_ttl', 0)
+        # Budgets are given in MB, the least recently used models are unloaded to stay within them
+        model_residency.configure(ram_budget=(params.get('models_ram_budget') or 0) * 2**20,
+                                  vram_budget=(params.get('models_vram_budget') or 0) * 2**20,
+                                  ttl=self.models_ttl)
+        self.batch_size = params.get('batch_size', 1)
+        self.pipeline_depth = params.get('pipeline_depth', 0)
+        self.coalesce_pages = params.get('coalesce_pages', 1)
 
         self.ignore_errors = params.get('ignore_errors', False)
         # check mps for apple silicon or cuda for nvidia
@@ -151,6 +198,12 @@ class MangaTranslator:
                 'Is the correct pytorch version installed? (See https://pytorch.org/)')
         if params.get('model_dir'):
             ModelWrapper._MODEL_DIR = params.get('model_dir')
+        ModelWrapper._BACKEND = params.get('backend') or 'torch'
+        ModelWrapper._ONNX_THREADS = (params.get('onnx_intra_op_threads') or 0, params.get('onnx_inter_op_threads') or 0)
+        if params.get('translation_cache'):
+            CommonTranslator._CACHE = TranslationCache(params.get('translation_cache'), params.get('translation_cache_size', 100000))
+        if params.get('glyph_cache'):
+            set_glyph_atlas(GlyphAtlas(params.get('glyph_cache')))
         #todo: fix why is kernel size loaded in the constructor
         self.kernel_size=int(params.get('kernel_size'))
         # Set input files
@@ -160,6 +213,14 @@ class MangaTranslator:
         # Set load_text
         self.load_text = params.get('load_text', False)
 
+        self._artifact_store = None
+        if params.get('artifact_cache'):
+            if self.load_text:
+                # Translations loaded from a file can change without the stage keys noticing
+                logger.warn('--artifact-cache is disabled when using --load-text')
+            else:
+                self._artifact_store = ArtifactStore(params.get('artifact_cache'))
+
     @property
     def using_gpu(self):
         return self.device.startswith('cuda') or self.device == 'mps'
@@ -174,32 +235,339 @@ class MangaTranslator:
         result = translation_dict.result
         ```
         """
-        # TODO: Take list of images to speed up batch processing
-
         ctx = Context()
 
         ctx.input = image
         ctx.result = None
 
         # preload and download models (not strictly necessary, remove to lazy load)
+        await self._preload_models(config)
+
+        # translate
+        return await self._translate(config, ctx)
+
+    async def translate_batch(self, images: List[Image.Image], config: Config, batch_size: Optional[int] = None) -> List[Context]:
+        """
+        Translates a list of PIL images (e.g. the pages of a chapter). Returns one context per image,
+        in the same order as `images`.
+
+        Pages are processed in groups of `batch_size`. Within a group every stage is run over all
+        pages before the next stage starts, and detection and inpainting receive the whole group
+        in a single call so that the models can run them as one batch.
+        """
+        batch_size = max(batch_size or self.batch_size, 1)
+
+        # preload and download models (not strictly necessary, remove to lazy load)
+        await self._preload_models(config)
+
+        results = []
+        for batch in chunks(images, batch_size):
+            ctxs = []
+            for image in batch:
+                ctx = Context()
+                ctx.input = image
+                ctx.result = None
+                ctxs.append(ctx)
+            results.extend(await self._translate_batch(config, ctxs))
+        return results
+
+    async def translate_pipelined(self, images: Iterable[Image.Image], config: Config, depth: Optional[int] = None,
+                                  batch_size: Optional[int] = None) -> AsyncIterator[Context]:
+        """
+        Translates a stream of PIL images (e.g. the pages of a chapter) and yields one context per
+        image, in the same order as `images`.
+
+        The pipeline is split into three stages that run concurrently on consecutive groups of
+        `batch_size` pages: detection/OCR, translation and mask refinement/inpainting/rendering.
+        While a group is being translated the next one is detected and the previous one is
+        rendered, which hides most of the latency of online translators. At most `depth` groups
+        wait between two stages.
+
+        The blocking model and rendering stages run in worker threads (see `_run_offloaded`) so
+        that the event loop stays free for the translation stage, the hooks are still called on
+        the event loop.
+        """
+        depth = max(depth or self.pipeline_depth, 1)
+        batch_size = max(batch_size or self.batch_size, 1)
+
+        # preload and download models (not strictly necessary, remove to lazy load)
+        await self._preload_models(config)
+
+        detected = asyncio.Queue(maxsize=depth)
+        translated = asyncio.Queue(maxsize=depth)
+        finished = asyncio.Queue(maxsize=depth)
+
+        # Every stage passes `(ctxs, pending)` on to the next one and `None` once it is done,
+        # also when it fails so that the stages behind it shut down as well.
+        async def analyse():
+            try:
+                it = iter(images)
+                while batch := list(itertools.islice(it, batch_size)):
+                    ctxs = []
+                    for image in batch:
+                        ctx = Context()
+                        ctx.input = image
+                        ctx.result = None
+                        ctxs.append(ctx)
+                    pending = await self._analyse_batch(config, ctxs)
+                    await detected.put((ctxs, pending))
+            finally:
+                await detected.put(None)
+
+        async def translate():
+            try:
+                while (item := await detected.get()) is not None:
+                    ctxs, pending = item
+                    await translated.put((ctxs, await self._translate_batch_text(config, pending)))
+            finally:
+                await translated.put(None)
+
+        async def finish():
+            try:
+                while (item := await translated.get()) is not None:
+                    ctxs, pending = item
+                    await self._finish_batch(config, pending)
+                    await finished.put(ctxs)
+            finally:
+                await finished.put(None)
+
+        workers = [asyncio.create_task(worker()) for worker in (analyse, translate, finish)]
+        try:
+            while (ctxs := await finished.get()) is not None:
+                for ctx in ctxs:
+                    yield ctx
+            for worker in workers:
+                if worker.done() and not worker.cancelled() and worker.exception():
+                    raise worker.exception()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _run_offloaded(self, stage: str, coro):
+        """
+        Runs the coroutine `coro` of a blocking stage on its own event loop in a worker thread. It
+        may only touch the models of the stage, calls of the same stage are serialized so that a
+        model (and its stage's model cache) is never used by two threads at once.
+        """
+        lock = self._stage_locks[stage]
+
+        def run():
+            with lock:
+                return asyncio.run(coro)
+        return await asyncio.to_thread(run)
+
+    async def _preload_models(self, config: Config):
         if ( self.models_ttl == 0 ):
             logger.info('Loading models')
             if config.upscale.upscale_ratio:
                 await prepare_upscaling(config.upscale.upscaler)
             await prepare_detection(config.detector.detector)
             await prepare_ocr(config.ocr.ocr, self.device)
-            await prepare_inpainting(config.inpainter.inpainter, self.device)
+            await prepare_inpainting(config.inpainter.inpainter, self.device, config.inpainter)
             await prepare_translation(config.translator.translator_gen)
             if config.colorizer.colorizer != Colorizer.none:
                 await prepare_colorization(config.colorizer.colorizer)
 
-        # translate
-        return await self._translate(config, ctx)
-
     async def _translate(self, config: Config, ctx: Context) -> Context:
-        # Start the background cleanup job once if not already started.
-        if self._detector_cleanup_task is None:
-            self._detector_cleanup_task = asyncio.create_task(self._detector_cleanup_job())
+        await self._prepare_image(config, ctx)
+
+        # -- Detection
+        if not self._load_artifacts(ctx, 'detection'):
+            await self._report_progress('detection')
+            try:
+                ctx.textlines, ctx.mask_raw, ctx.mask = await self._run_detection(config, ctx)
+                self._save_artifacts(ctx, 'detection')
+            except Exception as e:  
+                logger.error(f"Error during detection:\n{traceback.format_exc()}")  
+                if not self.ignore_errors:  
+                    raise 
+                ctx.textlines = [] 
+                ctx.mask_raw = None
+                ctx.mask = None
+        if not await self._check_detection(config, ctx):
+            return await self._revert_upscale(config, ctx)
+
+        if not await self._recognize_text(config, ctx):
+            return await self._revert_upscale(config, ctx)
+
+        if not await self._translate_text(config, ctx):
+            return await self._revert_upscale(config, ctx)
+
+        await self._refine_mask(config, ctx)
+
+        # -- Inpainting
+        if not self._load_artifacts(ctx, 'inpainting'):
+            await self._report_progress('inpainting')
+            try:
+                ctx.img_inpainted = await self._run_inpainting(config, ctx)
+                self._save_artifacts(ctx, 'inpainting')
+            except Exception as e:  
+                logger.error(f"Error during inpainting:\n{traceback.format_exc()}")  
+                if not self.ignore_errors:  
+                    raise 
+                ctx.img_inpainted = ctx.img_rgb # Fallback to original RGB image if inpainting fails
+        self._finish_inpainting(ctx)
+
+        await self._render_text(config, ctx)
+
+        return await self._revert_upscale(config, ctx)
+
+    async def _translate_batch(self, config: Config, ctxs: List[Context]) -> List[Context]:
+        pending = await self._analyse_batch(config, ctxs)
+        pending = await self._translate_batch_text(config, pending)
+        await self._finish_batch(config, pending)
+        return ctxs
+
+    async def _analyse_batch(self, config: Config, ctxs: List[Context]) -> List[Context]:
+        """
+        Runs the image stages up to and including textline merge. Returns the contexts that
+        still have text to translate, pages that finish early already have their result set.
+        """
+        for ctx in ctxs:
+            await self._prepare_image(config, ctx)
+
+        # -- Detection
+        detect_ctxs = [ctx for ctx in ctxs if not self._load_artifacts(ctx, 'detection')]
+        if detect_ctxs:
+            await self._report_progress('detection')
+            try:
+                detections = await self._run_detection_batch(config, detect_ctxs)
+                for ctx, (textlines, mask_raw, mask) in zip(detect_ctxs, detections):
+                    ctx.textlines, ctx.mask_raw, ctx.mask = textlines, mask_raw, mask
+                    self._save_artifacts(ctx, 'detection')
+            except Exception as e:  
+                logger.error(f"Error during detection:\n{traceback.format_exc()}")  
+                if not self.ignore_errors:  
+                    raise 
+                for ctx in detect_ctxs:
+                    ctx.textlines, ctx.mask_raw, ctx.mask = [], None, None
+
+        # Pages that finish early (no text, translation error, ...) drop out of `pending`
+        pending = []
+        for ctx in ctxs:
+            if await self._check_detection(config, ctx):
+                pending.append(ctx)
+            else:
+                await self._revert_upscale(config, ctx)
+
+        # -- OCR, the textlines of all pages are batched together
+        ocr_ctxs = [ctx for ctx in pending if not self._load_artifacts(ctx, 'ocr')]
+        if ocr_ctxs:
+            await self._report_progress('ocr')
+            try:
+                for ctx, textlines in zip(ocr_ctxs, await self._run_ocr_batch(config, ocr_ctxs)):
+                    ctx.textlines = textlines
+                    self._save_artifacts(ctx, 'ocr')
+            except Exception as e:  
+                logger.error(f"Error during ocr:\n{traceback.format_exc()}")  
+                if not self.ignore_errors:  
+                    raise 
+                for ctx in ocr_ctxs:
+                    ctx.textlines = [] # Fallback to empty textlines if OCR fails
+
+        # -- Textline merge
+        return await self._filter_pending(config, pending, self._merge_textlines)
+
+    async def _translate_batch_text(self, config: Config, pending: List[Context]) -> List[Context]:
+        if self.coalesce_pages > 1 and len(pending) > 1 and config.translator.translator != Translator.none \
+                and not (self.prep_manual or self.load_text or self.save_text):
+            await self._coalesce_translations(config, pending)
+        return await self._filter_pending(config, pending, self._translate_text)
+
+    async def _coalesce_translations(self, config: Config, pending: List[Context]):
+        """
+        Translates the text regions of up to `coalesce_pages` consecutive pages with a single
+        translator call, as long as they fit into one request. The translations are scattered back
+        to `ctx.coalesced_translations`, which `_run_text_translation` then uses instead of
+        translating the page on its own.
+        """
+        chain = config.translator.translator_gen
+        groups = []
+        group, queries = [], []
+        for ctx in pending:
+            if self._has_artifacts(ctx, 'translation'):
+                continue
+            page_queries = [region.text for region in ctx.text_regions]
+            if group and (len(group) >= self.coalesce_pages or not within_request_limit(chain, queries + page_queries)):
+                groups.append((group, queries))
+                group, queries = [], []
+            group.append(ctx)
+            queries.extend(page_queries)
+        groups.append((group, queries))
+
+        for group, queries in groups:
+            # the group is empty when every page has its translation artifacts already
+            if len(group) <= 1:
+                continue
+            await self._report_progress('translating')
+            group_ctx = Context()
+            inputs = [self._stage_inputs(ctx) for ctx in group]
+            start = time.time()
+            started = time.perf_counter()
+            try:
+                translated_sentences = await dispatch_translation(chain, queries, config.translator, self.use_mtpe, group_ctx,
+                                                                  'cpu' if self._gpu_limited_memory else self.device)
+            except TranslationInterrupt:
+                raise
+            except Exception as e:
+                # The pages are translated one by one instead
+                logger.error(f"Error during translating:\n{traceback.format_exc()}")
+                continue
+            if len(translated_sentences) != len(queries):
+                # The lines can't be assigned to the pages, so they are translated one by one instead
+                logger.error(f'Coalesced translation returned {len(translated_sentences)} lines for {len(queries)} queries')
+                continue
+            # the 'translation' span of the pages only covers their post-processing
+            await self._record_timing('coalesced_translation', group, inputs, start, time.perf_counter() - started)
+            offset = 0
+            for ctx in group:
+                end = offset + len(ctx.text_regions)
+                ctx.coalesced_translations = translated_sentences[offset:end]
+                if 'translations' in group_ctx:
+                    ctx.translations = {lang: texts[offset:end] for lang, texts in group_ctx.translations.items()}
+                offset = end
+
+    async def _filter_pending(self, config: Config, pending: List[Context], stage) -> List[Context]:
+        remaining = []
+        for ctx in pending:
+            if await stage(config, ctx):
+                remaining.append(ctx)
+            else:
+                await self._revert_upscale(config, ctx)
+        return remaining
+
+    async def _finish_batch(self, config: Config, pending: List[Context]):
+        """Runs mask refinement, inpainting and rendering for the pages of `pending`."""
+        if not pending:
+            return
+
+        for ctx in pending:
+            await self._refine_mask(config, ctx)
+
+        # -- Inpainting
+        inpaint_ctxs = [ctx for ctx in pending if not self._load_artifacts(ctx, 'inpainting')]
+        if inpaint_ctxs:
+            await self._report_progress('inpainting')
+            try:
+                inpainted = await self._run_inpainting_batch(config, inpaint_ctxs)
+                for ctx, img_inpainted in zip(inpaint_ctxs, inpainted):
+                    ctx.img_inpainted = img_inpainted
+                    self._save_artifacts(ctx, 'inpainting')
+            except Exception as e:  
+                logger.error(f"Error during inpainting:\n{traceback.format_exc()}")  
+                if not self.ignore_errors:  
+                    raise 
+                for ctx in inpaint_ctxs:
+                    ctx.img_inpainted = ctx.img_rgb # Fallback to original RGB images if inpainting fails
+        for ctx in pending:
+            self._finish_inpainting(ctx)
+
+        # -- Rendering
+        for ctx in pending:
+            await self._render_text(config, ctx)
+            await self._revert_upscale(config, ctx)
+
+    async def _prepare_image(self, config: Config, ctx: Context):
         # -- Colorization
         if config.colorizer.colorizer != Colorizer.none:
             await self._report_progress('colorizing')
@@ -231,18 +599,63 @@ class MangaTranslator:
 
         ctx.img_rgb, ctx.img_alpha = load_image(ctx.upscaled)
 
-        # -- Detection
-        await self._report_progress('detection')
-        try:
-            ctx.textlines, ctx.mask_raw, ctx.mask = await self._run_detection(config, ctx)
-        except Exception as e:  
-            logger.error(f"Error during detection:\n{traceback.format_exc()}")  
-            if not self.ignore_errors:  
-                raise 
-            ctx.textlines = [] 
-            ctx.mask_raw = None
-            ctx.mask = None
+        if self._artifact_store is not None:
+            ctx.artifact_keys = self._artifact_keys(config, ctx)
+
+    # Context fields kept in the artifact store for each stage, in pipeline order
+    _ARTIFACTS = {
+        'detection': ('textlines', 'mask_raw', 'mask'),
+        'ocr': ('textlines',),
+        'translation': ('text_regions', 'translations'),
+        'mask': ('mask',),
+        'inpainting': ('img_inpainted',),
+    }
 
+    def _artifact_keys(self, config: Config, ctx: Context) -> dict:
+        """
+        Returns the artifact store key of every stage in `_ARTIFACTS`. Each key builds on the key of
+        the previous stage, so changing the input image or the settings of a stage invalidates the
+        results of that stage and of all the stages after it. Rendering is always run.
+        """
+        def file_version(path):
+            return f'{path}:{os.path.getmtime(path)}' if path and os.path.exists(path) else path
+
+        keys = {}
+        keys['detection'] = ArtifactStore.make_key(ctx.img_rgb, config.detector.model_dump_json())
+        keys['ocr'] = ArtifactStore.make_key(keys['detection'], config.ocr.model_dump_json(), config.render.font_color)
+        keys['translation'] = ArtifactStore.make_key(keys['ocr'], config.translator.model_dump_json(), config.filter_text,
+                                                     config.render.uppercase, config.render.lowercase,
+                                                     config.render.alignment, config.render.direction, self.prep_manual,
+                                                     file_version(self.pre_dict), file_version(self.post_dict))
+        keys['mask'] = ArtifactStore.make_key(keys['translation'], config.mask_dilation_offset, self.kernel_size)
+        keys['inpainting'] = ArtifactStore.make_key(keys['mask'], config.inpainter.model_dump_json())
+        return keys
+
+    def _has_artifacts(self, ctx: Context, stage: str) -> bool:
+        return self._artifact_store is not None and self._artifact_store.exists(ctx.artifact_keys[stage])
+
+    def _load_artifacts(self, ctx: Context, stage: str) -> bool:
+        """
+        Restores the results of `stage` from the artifact store. Returns False if the stage has to be run.
+        """
+        if self._artifact_store is None:
+            return False
+        artifacts = self._artifact_store.load(ctx.artifact_keys[stage])
+        if artifacts is None:
+            return False
+        logger.info(f'Reusing cached {stage} results')
+        ctx.update(artifacts)
+        return True
+
+    def _save_artifacts(self, ctx: Context, stage: str):
+        if self._artifact_store is not None:
+            self._artifact_store.save(ctx.artifact_keys[stage],
+                                      {name: ctx[name] for name in self._ARTIFACTS[stage] if name in ctx})
+
+    async def _check_detection(self, config: Config, ctx: Context) -> bool:
+        """
+        Returns `False` and sets the intermediate image as result if no textlines were detected.
+        """
         if self.verbose and ctx.mask_raw is not None:
             cv2.imwrite(self._result_path('mask_raw.png'), ctx.mask_raw)
 
@@ -250,29 +663,36 @@ class MangaTranslator:
             await self._report_progress('skip-no-regions', True)
             # If no text was found result is intermediate image product
             ctx.result = ctx.upscaled
-            return await self._revert_upscale(config, ctx)
+            return False
 
         if self.verbose:
             img_bbox_raw = np.copy(ctx.img_rgb)
             for txtln in ctx.textlines:
                 cv2.polylines(img_bbox_raw, [txtln.pts], True, color=(255, 0, 0), thickness=2)
             cv2.imwrite(self._result_path('bboxes_unfiltered.png'), cv2.cvtColor(img_bbox_raw, cv2.COLOR_RGB2BGR))
+        return True
 
+    async def _recognize_text(self, config: Config, ctx: Context) -> bool:
         # -- OCR
-        await self._report_progress('ocr')
-        try:
-            ctx.textlines = await self._run_ocr(config, ctx)
-        except Exception as e:  
-            logger.error(f"Error during ocr:\n{traceback.format_exc()}")  
-            if not self.ignore_errors:  
-                raise 
-            ctx.textlines = [] # Fallback to empty textlines if OCR fails
+        if not self._load_artifacts(ctx, 'ocr'):
+            await self._report_progress('ocr')
+            try:
+                ctx.textlines = await self._run_ocr(config, ctx)
+                self._save_artifacts(ctx, 'ocr')
+            except Exception as e:  
+                logger.error(f"Error during ocr:\n{traceback.format_exc()}")  
+                if not self.ignore_errors:  
+                    raise 
+                ctx.textlines = [] # Fallback to empty textlines if OCR fails
+
+        return await self._merge_textlines(config, ctx)
 
+    async def _merge_textlines(self, config: Config, ctx: Context) -> bool:
         if not ctx.textlines:
             await self._report_progress('skip-no-text', True)
             # If no text was found result is intermediate image product
             ctx.result = ctx.upscaled
-            return await self._revert_upscale(config, ctx)
+            return False
 
         # Apply pre-dictionary after OCR
         pre_dict = load_dictionary(self.pre_dict)
@@ -303,34 +723,42 @@ class MangaTranslator:
         if self.verbose and ctx.text_regions:
             bboxes = visualize_textblocks(cv2.cvtColor(ctx.img_rgb, cv2.COLOR_BGR2RGB), ctx.text_regions)
             cv2.imwrite(self._result_path('bboxes.png'), bboxes)
+        return True
 
+    async def _translate_text(self, config: Config, ctx: Context) -> bool:
         # -- Translation
-        await self._report_progress('translating')
-        try:
-            ctx.text_regions = await self._run_text_translation(config, ctx)
-        except Exception as e:  
-            logger.error(f"Error during translating:\n{traceback.format_exc()}")  
-            if not self.ignore_errors:  
-                raise 
-            ctx.text_regions = [] # Fallback to empty text_regions if translation fails
+        if not self._load_artifacts(ctx, 'translation'):
+            await self._report_progress('translating')
+            try:
+                ctx.text_regions = await self._run_text_translation(config, ctx)
+                if ctx.text_regions != 'cancel':
+                    self._save_artifacts(ctx, 'translation')
+            except Exception as e:  
+                logger.error(f"Error during translating:\n{traceback.format_exc()}")  
+                if not self.ignore_errors:  
+                    raise 
+                ctx.text_regions = [] # Fallback to empty text_regions if translation fails
 
         await self._report_progress('after-translating')
 
         if not ctx.text_regions:
             await self._report_progress('error-translating', True)
             ctx.result = ctx.upscaled
-            return await self._revert_upscale(config, ctx)
+            return False
         elif ctx.text_regions == 'cancel':
             await self._report_progress('cancelled', True)
             ctx.result = ctx.upscaled
-            return await self._revert_upscale(config, ctx)
+            return False
+        return True
 
+    async def _refine_mask(self, config: Config, ctx: Context):
         # -- Mask refinement
         # (Delayed to take advantage of the region filtering done after ocr and translation)
-        if ctx.mask is None:
+        if ctx.mask is None and not self._load_artifacts(ctx, 'mask'):
             await self._report_progress('mask-generation')
             try:
                 ctx.mask = await self._run_mask_refinement(config, ctx)
+                self._save_artifacts(ctx, 'mask')
             except Exception as e:  
                 logger.error(f"Error during mask-generation:\n{traceback.format_exc()}")  
                 if not self.ignore_errors:  
@@ -343,19 +771,13 @@ class MangaTranslator:
             cv2.imwrite(self._result_path('inpaint_input.png'), cv2.cvtColor(inpaint_input_img, cv2.COLOR_RGB2BGR))
             cv2.imwrite(self._result_path('mask_final.png'), ctx.mask)
 
-        # -- Inpainting
-        await self._report_progress('inpainting')
-        try:
-            ctx.img_inpainted = await self._run_inpainting(config, ctx)
-        except Exception as e:  
-            logger.error(f"Error during inpainting:\n{traceback.format_exc()}")  
-            if not self.ignore_errors:  
-                raise 
-            ctx.img_inpainted = ctx.img_rgb # Fallback to original RGB image if inpainting fails
+    def _finish_inpainting(self, ctx: Context):
         ctx.gimp_mask = np.dstack((cv2.cvtColor(ctx.img_inpainted, cv2.COLOR_RGB2BGR), ctx.mask))
 
         if self.verbose:
             cv2.imwrite(self._result_path('inpainted.png'), cv2.cvtColor(ctx.img_inpainted, cv2.COLOR_RGB2BGR))
+
+    async def _render_text(self, config: Config, ctx: Context):
         # -- Rendering
         await self._report_progress('rendering')
         try:
@@ -368,8 +790,6 @@ class MangaTranslator:
 
         await self._report_progress('finished', True)
         ctx.result = dump_image(ctx.input, ctx.img_rendered, ctx.img_alpha)
-
-        return await self._revert_upscale(config, ctx)
     
     # If `revert_upscaling` is True, revert to input size
     # Else leave `ctx` as-is
@@ -380,9 +800,8 @@ class MangaTranslator:
 
         return ctx
 
+    @_timed_stage('colorization', offload=True)
     async def _run_colorizer(self, config: Config, ctx: Context):
-        current_time = time.time()
-        self._model_usage_timestamps[("colorizer", config.colorizer.colorizer)] = current_time
         #todo: im pretty sure the ctx is never used. does it need to be passed in?
         return await dispatch_colorization(
             config.colorizer.colorizer,
@@ -393,56 +812,38 @@ class MangaTranslator:
             **ctx
         )
 
+    @_timed_stage('upscaling', offload=True)
     async def _run_upscaling(self, config: Config, ctx: Context):
-        current_time = time.time()
-        self._model_usage_timestamps[("upscaling", config.upscale.upscaler)] = current_time
         return (await dispatch_upscaling(config.upscale.upscaler, [ctx.img_colorized], config.upscale.upscale_ratio, self.device))[0]
 
+    @_timed_stage('detection', offload=True)
     async def _run_detection(self, config: Config, ctx: Context):
-        current_time = time.time()
-        self._model_usage_timestamps[("detection", config.detector.detector)] = current_time
         return await dispatch_detection(config.detector.detector, ctx.img_rgb, config.detector.detection_size, config.detector.text_threshold,
                                         config.detector.box_threshold,
                                         config.detector.unclip_ratio, config.detector.det_invert, config.detector.det_gamma_correct, config.detector.det_rotate,
                                         config.detector.det_auto_rotate,
                                         self.device, self.verbose)
 
-    async def _unload_model(self, tool: str, model: str):
-        logger.info(f"Unloading {tool} model: {model}")
-        match tool:
-            case 'colorization':
-                await unload_colorization(model)
-            case 'detection':
-                await unload_detection(model)
-            case 'inpainting':
-                await unload_inpainting(model)
-            case 'ocr':
-                await unload_ocr(model)
-            case 'upscaling':
-                await unload_upscaling(model)
-            case 'translation':
-                await unload_translation(model)
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()  # empty CUDA cache
-
-    # Background models cleanup job.
-    async def _detector_cleanup_job(self):
-        while True:
-            if self.models_ttl == 0:
-                await asyncio.sleep(1)
-                continue
-            now = time.time()
-            for (tool, model), last_used in list(self._model_usage_timestamps.items()):
-                if now - last_used > self.models_ttl:
-                    await self._unload_model(tool, model)
-                    del self._model_usage_timestamps[(tool, model)]
-            await asyncio.sleep(1)
+    @_timed_stage('detection', offload=True)
+    async def _run_detection_batch(self, config: Config, ctxs: List[Context]):
+        return await dispatch_detection_batch(config.detector.detector, [ctx.img_rgb for ctx in ctxs], config.detector.detection_size,
+                                              config.detector.text_threshold, config.detector.box_threshold,
+                                              config.detector.unclip_ratio, config.detector.det_invert, config.detector.det_gamma_correct, config.detector.det_rotate,
+                                              config.detector.det_auto_rotate,
+                                              self.device, self.verbose)
 
+    @_timed_stage('ocr', offload=True)
     async def _run_ocr(self, config: Config, ctx: Context):
-        current_time = time.time()
-        self._model_usage_timestamps[("ocr", config.ocr.ocr)] = current_time
         textlines = await dispatch_ocr(config.ocr.ocr, ctx.img_rgb, ctx.textlines, config.ocr, self.device, self.verbose)
+        return self._filter_ocr_textlines(config, textlines)
+
+    @_timed_stage('ocr', offload=True)
+    async def _run_ocr_batch(self, config: Config, ctxs: List[Context]):
+        textlines = await dispatch_ocr_batch(config.ocr.ocr, [ctx.img_rgb for ctx in ctxs], [ctx.textlines for ctx in ctxs],
+                                             config.ocr, self.device, self.verbose)
+        return [self._filter_ocr_textlines(config, page_textlines) for page_textlines in textlines]
 
+    def _filter_ocr_textlines(self, config: Config, textlines: List[Quadrilateral]) -> List[Quadrilateral]:
         new_textlines = []
         for textline in textlines:
             if textline.text.strip():
@@ -453,11 +854,8 @@ class MangaTranslator:
                 new_textlines.append(textline)
         return new_textlines
 
+    @_timed_stage('textline_merge')
     async def _run_textline_merge(self, config: Config, ctx: Context):
-        current_time = time.time()
-        self._model_usage_timestamps[("textline_merge", "textline_merge")] = current_time
-        text_regions = await dispatch_textline_merge(ctx.textlines, ctx.img_rgb.shape[1], ctx.img_rgb.shape[0],
-                                                     verbose=self.verbose)
         # Filter out languages to skip  
         if config.translator.skip_lang is not None:  
             skip_langs = [lang.strip().upper() for lang in config.translator.skip_lang.split(',')]  
@@ -594,14 +992,13 @@ class MangaTranslator:
         text_regions = sort_regions(text_regions, right_to_left=True if config.detector.detector != Detector.ctd else False)
         return text_regions
 
+    @_timed_stage('translation')
     async def _run_text_translation(self, config: Config, ctx: Context):
         # 如果设置了prep_manual则将translator设置为none，防止token浪费
         # Set translator to none to provent token waste if prep_manual is True  
         if self.prep_manual:  
             config.translator.translator = Translator.none          
     
-        current_time = time.time()
-        self._model_usage_timestamps[("translation", config.translator.translator)] = current_time
 
         # 为none翻译器添加特殊处理  
         # Add special handling for none translator  
@@ -630,7 +1027,10 @@ class MangaTranslator:
         else:  
             # 如果是none翻译器，不需要调用翻译服务，文本已经设置为空  
             # If using none translator, no need to call translation service, text is already set to empty  
-            if config.translator.translator != Translator.none:  
+            if ctx.get('coalesced_translations') is not None:
+                # Already translated together with the neighbouring pages by `_coalesce_translations`
+                translated_sentences = ctx.coalesced_translations
+            elif config.translator.translator != Translator.none:  
                 translated_sentences = \
                     await dispatch_translation(config.translator.translator_gen,  
                                               [region.text for region in ctx.text_regions],  
@@ -897,19 +1297,23 @@ class MangaTranslator:
         return new_text_regions 
                
 
+    @_timed_stage('mask_refinement', offload=True)
     async def _run_mask_refinement(self, config: Config, ctx: Context):
         return await dispatch_mask_refinement(ctx.text_regions, ctx.img_rgb, ctx.mask_raw, 'fit_text',
                                               config.mask_dilation_offset, config.ocr.ignore_bubble, self.verbose,self.kernel_size)
 
+    @_timed_stage('inpainting', offload=True)
     async def _run_inpainting(self, config: Config, ctx: Context):
-        current_time = time.time()
-        self._model_usage_timestamps[("inpainting", config.inpainter.inpainter)] = current_time
         return await dispatch_inpainting(config.inpainter.inpainter, ctx.img_rgb, ctx.mask, config.inpainter, config.inpainter.inpainting_size, self.device,
                                          self.verbose)
 
+    @_timed_stage('inpainting', offload=True)
+    async def _run_inpainting_batch(self, config: Config, ctxs: List[Context]):
+        return await dispatch_inpainting_batch(config.inpainter.inpainter, [ctx.img_rgb for ctx in ctxs], [ctx.mask for ctx in ctxs],
+                                               config.inpainter, config.inpainter.inpainting_size, self.device, self.verbose)
+
+    @_timed_stage('rendering', offload=True)
     async def _run_text_rendering(self, config: Config, ctx: Context):
-        current_time = time.time()
-        self._model_usage_timestamps[("rendering", config.render.renderer)] = current_time
         if config.render.renderer == Renderer.none:
             output = ctx.img_inpainted
         # manga2eng currently only supports horizontal left to right rendering
@@ -936,6 +1340,42 @@ class MangaTranslator:
         for ph in self._progress_hooks:
             await ph(state, finished)
 
+    def add_timing_hook(self, th):
+        """
+        Adds a coroutine that is called as `th(stage, timing)` after every stage of every page,
+        with the span that is also recorded in `ctx.timings[stage]`.
+        """
+        self._timing_hooks.append(th)
+
+    def _stage_device(self, stage: str) -> str:
+        if stage in ('textline_merge', 'mask_refinement', 'rendering'):
+            return 'cpu'
+        if stage in ('translation', 'coalesced_translation') and self._gpu_limited_memory:
+            return 'cpu'
+        return self.device
+
+    @staticmethod
+    def _stage_inputs(ctx: Context) -> dict:
+        """Size of the input of a stage: pixels of the page and the regions (or textlines) with their characters"""
+        if ctx.img_rgb is not None:
+            pixels = ctx.img_rgb.shape[0] * ctx.img_rgb.shape[1]
+        else:
+            pixels = ctx.input.width * ctx.input.height
+        regions = ctx.text_regions if ctx.text_regions is not None else (ctx.textlines or [])
+        return {'pixels': pixels, 'regions': len(regions), 'characters': sum(len(r.text) for r in regions)}
+
+    async def _record_timing(self, stage: str, ctxs: List[Context], inputs: List[dict], start: float, duration: float):
+        for ctx, ctx_inputs in zip(ctxs, inputs):
+            timing = {'start': start, 'end': start + duration, 'duration': duration, 'device': self._stage_device(stage), **ctx_inputs}
+            if len(ctxs) > 1:
+                # the duration is the one of the whole batch
+                timing['batch'] = len(ctxs)
+            if ctx.timings is None:
+                ctx.timings = {}
+            ctx.timings[stage] = timing
+            for th in self._timing_hooks:
+                await th(stage, timing)
+
     def _add_logger_hook(self):
         # TODO: Pass ctx to logger hook
         LOG_MESSAGES = {
@@ -966,4 +1406,8 @@ class MangaTranslator:
             elif state in LOG_MESSAGES_ERROR:
                 logger.error(LOG_MESSAGES_ERROR[state])
 
+        async def th(stage, timing):
+            logger.debug(f'{stage} took {timing["duration"]:.3f}s')
+
         self.add_progress_hook(ph)
+        self.add_timing_hook(th)
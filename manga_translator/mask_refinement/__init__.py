@@ -3,7 +3,7 @@ import cv2
 import numpy as np
 
 from .text_mask_utils import complete_mask_fill, complete_mask
-from ..utils import TextBlock, Quadrilateral
+from ..utils import TextBlock, Quadrilateral, TextlineArray
 from ..utils.bubble import is_ignore
 
 async def dispatch(text_regions: List[TextBlock], raw_image: np.ndarray, raw_mask: np.ndarray, method: str = 'fit_text', dilation_offset: int = 0, ignore_bubble: int = 0, verbose: bool = False,kernel_size:int=3) -> np.ndarray:
@@ -20,6 +20,7 @@ async def dispatch(text_regions: List[TextBlock], raw_image: np.ndarray, raw_mas
         for l in region.lines:
             q = Quadrilateral(l * scale_factor, '', 0)
             textlines.append(q)
+    textlines = TextlineArray(textlines)
 
     final_mask = complete_mask(img_resized, mask_resized, textlines, dilation_offset=dilation_offset,kernel_size=kernel_size) if method == 'fit_text' else complete_mask_fill([txtln.aabb.xywh for txtln in textlines])
     if final_mask is None:
@@ -93,6 +93,17 @@ def refine_mask(rgbimg, rawmask):
     crf_mask = np.array(res * 255, dtype=np.uint8)
     return crf_mask
 
+def bilateral_filter_region(img: np.ndarray, x: int, y: int, w: int, h: int, d: int = 17, sigma_color: float = 80, sigma_space: float = 80) -> np.ndarray:
+    """
+    Returns `img[y: y + h, x: x + w]` as if the whole image had been passed through `cv2.bilateralFilter`.
+    Only the region and a margin of the filter radius around it are filtered.
+    """
+    radius = d // 2
+    bx1, by1 = max(x - radius, 0), max(y - radius, 0)
+    bx2, by2 = min(x + w + radius, img.shape[1]), min(y + h + radius, img.shape[0])
+    filtered = cv2.bilateralFilter(np.ascontiguousarray(img[by1: by2, bx1: bx2]), d, sigma_color, sigma_space)
+    return np.ascontiguousarray(filtered[y - by1: y - by1 + h, x - bx1: x - bx1 + w])
+
 def complete_mask(img: np.ndarray, mask: np.ndarray, textlines: List[Quadrilateral], keep_threshold = 1e-2, dilation_offset = 0,kernel_size=3):
     bboxes = [txtln.aabb.xywh for txtln in textlines]
     polys = [Polygon(txtln.pts) for txtln in textlines]
@@ -101,11 +112,16 @@ def complete_mask(img: np.ndarray, mask: np.ndarray, textlines: List[Quadrilater
     num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask)
 
     M = len(textlines)
-    textline_ccs = [np.zeros_like(mask) for _ in range(M)]
+    if M == 0:
+        return None
+    # Only the pairs of components and textlines with overlapping AABBs can intersect
+    tl_pts = np.array([txtln.pts for txtln in textlines], dtype = np.float64)
+    tl_min, tl_max = tl_pts.min(axis = 1), tl_pts.max(axis = 1)
+    tl_areas = [poly.area for poly in polys]
     iinfo = np.iinfo(labels.dtype)
     textline_rects = np.full(shape = (M, 4), fill_value = [iinfo.max, iinfo.max, iinfo.min, iinfo.min], dtype = labels.dtype)
-    ratio_mat = np.zeros(shape = (num_labels, M), dtype = np.float32)
-    dist_mat = np.zeros(shape = (num_labels, M), dtype = np.float32)
+    # Labels of the components assigned to every textline
+    textline_labels = [[] for _ in range(M)]
     valid = False
     for label in range(1, num_labels):
         # skip area too small
@@ -120,38 +136,33 @@ def complete_mask(img: np.ndarray, mask: np.ndarray, textlines: List[Quadrilater
         cc_pts = np.array([[x1, y1], [x1 + w1, y1], [x1 + w1, y1 + h1], [x1, y1 + h1]])
         cc_poly = Polygon(cc_pts)
 
-        for tl_idx in range(M):
-            area2 = polys[tl_idx].area
-            overlapping_area = polys[tl_idx].intersection(cc_poly).area
-            ratio_mat[label, tl_idx] = overlapping_area / min(area1, area2)
-            dist_mat[label, tl_idx] = polys[tl_idx].distance(cc_poly.centroid)
-            # print(textlines[tl_idx].pts, cc_pts, '->', overlapping_area, min(area1, area2), '=', overlapping_area / min(area1, area2), '|', polys[tl_idx].distance(cc_poly))
-
-        avg = np.argmax(ratio_mat[label])
-        # print(avg, 'overlap:', ratio_mat[label, avg], '<=', keep_threshold)
-        area2 = polys[avg].area
+        # The textline the component overlaps the most, the first one if it overlaps none
+        avg, ratio = 0, np.float32(0)
+        overlapping = np.nonzero((tl_min[:, 0] < x1 + w1) & (tl_max[:, 0] > x1) & (tl_min[:, 1] < y1 + h1) & (tl_max[:, 1] > y1))[0]
+        if len(overlapping) > 0:
+            ratios = np.array([polys[i].intersection(cc_poly).area / min(area1, tl_areas[i]) for i in overlapping], dtype = np.float32)
+            best = np.argmax(ratios)
+            if ratios[best] > 0:
+                avg, ratio = overlapping[best], ratios[best]
+        area2 = tl_areas[avg]
         if area1 >= area2:
             continue
-        if ratio_mat[label, avg] <= keep_threshold:
-            avg = np.argmin(dist_mat[label])
-            area2 = polys[avg].area
+        if ratio <= keep_threshold:
+            # The textline closest to the centroid of the component. The distance to the AABB of a
+            # textline is a lower bound, the distance to its closest vertex an upper bound.
+            cx, cy = x1 + w1 / 2, y1 + h1 / 2
+            aabb_dist = np.hypot(np.maximum(np.maximum(tl_min[:, 0] - cx, cx - tl_max[:, 0]), 0),
+                                 np.maximum(np.maximum(tl_min[:, 1] - cy, cy - tl_max[:, 1]), 0))
+            upper_bound = np.hypot(tl_pts[:, :, 0] - cx, tl_pts[:, :, 1] - cy).min()
+            closest = np.nonzero(aabb_dist <= upper_bound * (1 + 1e-6) + 1e-6)[0]
+            dists = np.array([polys[i].distance(cc_poly.centroid) for i in closest], dtype = np.float32)
+            best = np.argmin(dists)
+            avg = closest[best]
             unit = max(min([textlines[avg].font_size, w1, h1]), 10)
-            # print("unit", unit, textlines[avg].font_size, w1, h1)
-            # if area1 < 0.4 * w1 * h1:
-            #     # ccs is probably angled
-            #     unit /= 2
-            # if avg == 0:
-            # print('no intersect', area1, '>=', area2, dist_mat[label, avg], '>=', 0.5 * unit)
-            if dist_mat[label, avg] >= 0.5 * unit:
-                # print(dist_mat[label])
-                # print('CONTINUE')
+            if dists[best] >= 0.5 * unit:
                 continue
 
-        textline_ccs[avg][y1:y1+h1, x1:x1+w1][labels[y1:y1+h1, x1:x1+w1] == label] = 255
-        # if avg == 0:
-        # print(avg)
-        # cv2.imshow('ccs', image_resize(textline_ccs[avg], height = 800))
-        # cv2.waitKey(0)
+        textline_labels[avg].append(label)
         textline_rects[avg, 0] = min(textline_rects[avg, 0], x1)
         textline_rects[avg, 1] = min(textline_rects[avg, 1], y1)
         textline_rects[avg, 2] = max(textline_rects[avg, 2], x1 + w1)
@@ -165,30 +176,26 @@ def complete_mask(img: np.ndarray, mask: np.ndarray, textlines: List[Quadrilater
     textline_rects[:, 2] -= textline_rects[:, 0]
     textline_rects[:, 3] -= textline_rects[:, 1]
     
+    # Every textline is refined inside its own ROI, which is composed back into the final mask
     final_mask = np.zeros_like(mask)
-    img = cv2.bilateralFilter(img, 17, 80, 80)
-    for i, cc in enumerate(tqdm(textline_ccs, '[mask]')):
+    for i in tqdm(range(M), '[mask]'):
+        if not textline_labels[i]:
+            continue
         x1, y1, w1, h1 = textline_rects[i]
         text_size = min(w1, h1, textlines[i].font_size)
         x1, y1, w1, h1 = extend_rect(x1, y1, w1, h1, img.shape[1], img.shape[0], int(text_size * 0.1))
+        if w1 <= 0 or h1 <= 0:
+            continue
         # TODO: Need to think of better way to determine dilate_size.
         dilate_size = max((int((text_size + dilation_offset) * 0.3) // 2) * 2 + 1, 3)
-        # print(textlines[i].font_size, min(w1, h1), dilate_size)
         kern = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (dilate_size, dilate_size))
-        cc_region = np.ascontiguousarray(cc[y1: y1 + h1, x1: x1 + w1])
-        if cc_region.size == 0:
-            continue
-        # cv2.imshow('cc before', image_resize(cc_region, height = 800))
-        img_region = np.ascontiguousarray(img[y1: y1 + h1, x1: x1 + w1])
-        # cv2.imshow('img', image_resize(img_region, height = 800))
-        cc_region = refine_mask(img_region, cc_region)
-        # cv2.imshow('cc after', image_resize(cc_region, height = 800))
-        # cv2.waitKey(0)
-        cc[y1: y1 + h1, x1: x1 + w1] = cc_region
-        # cc = cv2.dilate(cc, kern)
         x2, y2, w2, h2 = extend_rect(x1, y1, w1, h1, img.shape[1], img.shape[0], -(-dilate_size // 2))
-        cc[y2:y2+h2, x2:x2+w2] = cv2.dilate(cc[y2:y2+h2, x2:x2+w2], kern)
-        final_mask[y2:y2+h2, x2:x2+w2] = cv2.bitwise_or(final_mask[y2:y2+h2, x2:x2+w2], cc[y2:y2+h2, x2:x2+w2])
+        cc = np.isin(labels[y2: y2 + h2, x2: x2 + w2], textline_labels[i]).astype(np.uint8) * 255
+        rx, ry = x1 - x2, y1 - y2
+        cc_region = np.ascontiguousarray(cc[ry: ry + h1, rx: rx + w1])
+        img_region = bilateral_filter_region(img, x1, y1, w1, h1)
+        cc[ry: ry + h1, rx: rx + w1] = refine_mask(img_region, cc_region)
+        final_mask[y2: y2 + h2, x2: x2 + w2] |= cv2.dilate(cc, kern)
     kern = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
     # for (x, y, w, h) in text_lines:
     #     final_mask = cv2.rectangle(final_mask, (x, y), (x + w, y + h), (255), -1)
@@ -1,6 +1,6 @@
 import json
 import os
-from typing import Union, List
+from typing import Union, List, Optional, Tuple
 
 from PIL import Image
 
@@ -95,6 +95,8 @@ class MangaTranslatorLocal(MangaTranslator):
                 raise FileExistsError(_dest)
 
             translated_count = 0
+            # Images waiting to be translated together when --batch-size or --pipeline-depth is set
+            batch = []
             for root, subdirs, files in os.walk(path):
                 files = natural_sort(files)
                 dest_root = replace_prefix(root, path, _dest)
@@ -107,12 +109,21 @@ class MangaTranslatorLocal(MangaTranslator):
                     output_dest = replace_prefix(file_path, path, _dest)
                     p, ext = os.path.splitext(output_dest)
                     output_dest = f'{p}.{file_ext or ext[1:]}'
+                    if (self.batch_size > 1 or self.pipeline_depth > 0) and not file_path.endswith('.txt'):
+                        batch.append((file_path, output_dest))
+                        # The pipeline groups the images itself and is fed the whole folder at once
+                        if not self.pipeline_depth and len(batch) >= self.batch_size:
+                            translated_count += await self.translate_files(batch, params, config)
+                            batch = []
+                        continue
                     try:
                         if await self.translate_file(file_path, output_dest, params, config):
                             translated_count += 1
                     except Exception as e:
                         logger.error(e)
                         raise e
+            if batch:
+                translated_count += await self.translate_files(batch, params, config)
             if translated_count == 0:
                 logger.info('No further untranslated files found. Use --overwrite to write over existing translations.')
             else:
@@ -172,43 +183,111 @@ class MangaTranslatorLocal(MangaTranslator):
         # TODO: Add .gif handler
 
         else:  # Treat as image
-            try:
-                img = Image.open(path)
-                img.verify()
-                img = Image.open(path)
-            except Exception:
-                logger.warn(f'Failed to open image: {path}')
+            img = self._open_image(path)
+            if img is None:
                 return False
 
             ctx = await self.translate(img, config)
-            result = ctx.result
-
-            # TODO
-            # Proper way to use the config but for now juste pass what we miss here ton ctx
-            # Because old methods are still using for example ctx.gimp_font
-            # Not done before because we change the ctx few lines above
-            ctx.gimp_font = config.render.gimp_font
-
-            # Save result
-            if self.skip_no_text and not ctx.text_regions:
-                logger.debug('Not saving due to --skip-no-text')
-                return True
-            if result:
-                logger.info(f'Saving "{dest}"')
-                ctx.save_quality = self.save_quality
-                save_result(result, dest, ctx)
+            return await self._save_translation(path, dest, ctx, config)
+        return False
+
+    async def translate_files(self, files: List[Tuple[str, str]], params: dict, config: Config) -> int:
+        """
+        Translates several images together, through `translate_pipelined` if --pipeline-depth is set
+        and through `translate_batch` otherwise. `files` is a list of (path, dest) pairs. Returns the
+        number of images that were translated or skipped. If translation fails, the images that
+        were not saved yet are translated one by one with the usual retry handling.
+        """
+        count = 0
+        pending = []
+        for path, dest in files:
+            if not params.get('overwrite') and os.path.exists(dest):
+                logger.info(
+                    f'Skipping as already translated: "{dest}". Use --overwrite to overwrite existing translations.')
                 await self._report_progress('saved', True)
+                count += 1
+                continue
+            pending.append((path, dest))
+
+        # (path, dest) pairs of the images handed to the translator, in order
+        opened = []
+
+        def open_images():
+            for path, dest in pending:
+                img = self._open_image(path)
+                if img is not None:
+                    logger.info(f'Translating: "{path}"')
+                    opened.append((path, dest))
+                    yield img
+
+        saved = 0
+
+        async def save(ctx: Context):
+            nonlocal count, saved
+            path, dest = opened[saved]
+            saved += 1
+            if await self._save_translation(path, dest, ctx, config):
+                count += 1
 
-                if self.save_text or self.save_text_file or self.prep_manual:
-                    if self.prep_manual:
-                        # Save original image next to translated
-                        p, ext = os.path.splitext(dest)
-                        img_filename = p + '-orig' + ext
-                        img_path = os.path.join(os.path.dirname(dest), img_filename)
-                        img.save(img_path, quality=self.save_quality)
-                    if self.text_regions:
-                        self._save_text_to_file(path, ctx)
-                return True
+        try:
+            if self.pipeline_depth > 0:
+                async for ctx in self.translate_pipelined(open_images(), config):
+                    await save(ctx)
+            else:
+                images = list(open_images())
+                if images:
+                    for ctx in await self.translate_batch(images, config):
+                        await save(ctx)
+        except TranslationInterrupt:
+            return count
+        except Exception as e:
+            logger.error(f'{e.__class__.__name__}: {e}', exc_info=e if self.verbose else None)
+            logger.info('Batch translation failed, translating remaining images one by one')
+            remaining = pending[pending.index(opened[saved - 1]) + 1:] if saved else pending
+            for path, dest in remaining:
+                if await self.translate_file(path, dest, params, config):
+                    count += 1
+        return count
+
+    def _open_image(self, path: str) -> Optional[Image.Image]:
+        try:
+            img = Image.open(path)
+            img.verify()
+            img = Image.open(path)
+        except Exception:
+            logger.warn(f'Failed to open image: {path}')
+            return None
+        return img
+
+    async def _save_translation(self, path: str, dest: str, ctx: Context, config: Config) -> bool:
+        result = ctx.result
+
+        # TODO
+        # Proper way to use the config but for now juste pass what we miss here ton ctx
+        # Because old methods are still using for example ctx.gimp_font
+        # Not done before because we change the ctx few lines above
+        ctx.gimp_font = config.render.gimp_font
+
+        # Save result
+        if self.skip_no_text and not ctx.text_regions:
+            logger.debug('Not saving due to --skip-no-text')
+            return True
+        if result:
+            logger.info(f'Saving "{dest}"')
+            ctx.save_quality = self.save_quality
+            save_result(result, dest, ctx)
+            await self._report_progress('saved', True)
+
+            if self.save_text or self.save_text_file or self.prep_manual:
+                if self.prep_manual:
+                    # Save original image next to translated
+                    p, ext = os.path.splitext(dest)
+                    img_filename = p + '-orig' + ext
+                    img_path = os.path.join(os.path.dirname(dest), img_filename)
+                    ctx.input.save(img_path, quality=self.save_quality)
+                if self.text_regions:
+                    self._save_text_to_file(path, ctx)
+            return True
         return False
 
     def _save_text_to_file(self, image_path: str, ctx: Context):
@@ -0,0 +1,122 @@
+"""
+Binary protocol spoken between the web server and the `shared` mode executors.
+
+A stream is made of frames, each starting with a 1 byte status code and the 4 byte big endian
+length of the payload that follows. Status codes are 0 for the result, 1 for progress reports,
+2 for errors and 5 for the timing of a finished stage (JSON); the web server additionally uses
+3 (queue position) and 4 (processing started) towards its own clients.
+
+Requests and results are messages: a 4 byte big endian length, a JSON header and the raw bytes of
+the buffers the header describes (name, dtype, shape and offset). Buffers are decoded as numpy
+views into the received payload, so images and crops are never copied or pickled on the way.
+Malformed frames and messages raise a `ValueError`.
+"""
+import json
+import struct
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+STATUS_RESULT = 0
+STATUS_PROGRESS = 1
+STATUS_ERROR = 2
+STATUS_TIMING = 5
+
+_FRAME_HEADER = struct.Struct('>BI')
+_MESSAGE_HEADER = struct.Struct('>I')
+# upper bound of the payload size a frame may announce, a result holds a few page sized images
+MAX_FRAME_SIZE = 1 << 30
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+def encode_frame(status: int, payload: Buffer = b'') -> bytes:
+    return _FRAME_HEADER.pack(status, len(payload)) + payload
+
+
+class FrameReader:
+    """
+    Splits a byte stream that arrives in arbitrary chunks back into frames. The payload of every
+    frame is copied exactly once, into a buffer allocated with the size announced by its header.
+    Headers announcing more than `max_size` bytes are rejected before anything is allocated.
+    """
+
+    def __init__(self, max_size: int = MAX_FRAME_SIZE):
+        self.max_size = max_size
+        self._header = bytearray()
+        self._status = 0
+        self._payload = None
+        self._filled = 0
+
+    def feed(self, chunk: Buffer) -> List[Tuple[int, bytearray]]:
+        frames = []
+        view = memoryview(chunk)
+        while view:
+            if self._payload is None:
+                missing = _FRAME_HEADER.size - len(self._header)
+                self._header += view[:missing]
+                view = view[missing:]
+                if len(self._header) < _FRAME_HEADER.size:
+                    break
+                self._status, size = _FRAME_HEADER.unpack(self._header)
+                self._header.clear()
+                if size > self.max_size:
+                    raise ValueError(f'Frame of {size} bytes exceeds the limit of {self.max_size} bytes')
+                self._payload = bytearray(size)
+                self._filled = 0
+            n = min(len(view), len(self._payload) - self._filled)
+            self._payload[self._filled:self._filled + n] = view[:n]
+            self._filled += n
+            view = view[n:]
+            if self._filled == len(self._payload):
+                frames.append((self._status, self._payload))
+                self._payload = None
+        return frames
+
+    def close(self):
+        """Called at the end of the stream, which must not stop within a frame"""
+        if self._header or self._payload is not None:
+            raise ValueError('Stream ended within a frame')
+
+
+def encode_message(meta: Dict[str, Any], buffers: Optional[Dict[str, Union[np.ndarray, Buffer]]] = None) -> bytes:
+    """
+    Packs the JSON serializable `meta` and the raw contents of `buffers` into a single message.
+    """
+    descriptions = []
+    parts = []
+    offset = 0
+    for name, buffer in (buffers or {}).items():
+        array = np.ascontiguousarray(buffer if isinstance(buffer, np.ndarray) else np.frombuffer(buffer, np.uint8))
+        descriptions.append({'name': name, 'dtype': array.dtype.str, 'shape': array.shape,
+                             'offset': offset, 'nbytes': array.nbytes})
+        parts.append(array.reshape(-1).view(np.uint8))
+        offset += array.nbytes
+    header = json.dumps({'meta': meta, 'buffers': descriptions}).encode('utf-8')
+    return b''.join([_MESSAGE_HEADER.pack(len(header)), header, *parts])
+
+
+def decode_message(payload: Buffer) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    """
+    Inverse of `encode_message`. The returned arrays are views into `payload`.
+    """
+    view = memoryview(payload)
+    if len(view) < _MESSAGE_HEADER.size:
+        raise ValueError('Message is shorter than its header')
+    header_size, = _MESSAGE_HEADER.unpack(view[:_MESSAGE_HEADER.size])
+    start = _MESSAGE_HEADER.size + header_size
+    if start > len(view):
+        raise ValueError('Message header exceeds the message')
+    header = json.loads(bytes(view[_MESSAGE_HEADER.size:start]))
+    buffers = {}
+    for desc in header['buffers']:
+        dtype = np.dtype(desc['dtype'])
+        if dtype.hasobject:
+            raise ValueError(f'Buffer {desc["name"]} has an object dtype')
+        offset, nbytes = desc['offset'], desc['nbytes']
+        if offset < 0 or nbytes != int(np.prod(desc['shape'], dtype=np.int64)) * dtype.itemsize \
+                or start + offset + nbytes > len(view):
+            raise ValueError(f'Buffer {desc["name"]} exceeds the message')
+        data = view[start + offset:start + offset + nbytes]
+        buffers[desc['name']] = np.frombuffer(data, dtype=dtype).reshape(desc['shape'])
+    return header['meta'], buffers
@@ -1,31 +1,58 @@
 import asyncio
-import pickle
+import io
+import json
 from threading import Lock
 
 import uvicorn
-from fastapi import FastAPI, HTTPException, Path, Request, Response
-from pydantic import BaseModel
-import inspect
+from PIL import Image
+from fastapi import FastAPI, HTTPException, Request, Response
 
 from starlette.responses import StreamingResponse
 
-from manga_translator import MangaTranslator
-
-class MethodCall(BaseModel):
-    method_name: str
-    attributes: bytes
-
-
-async def load_data(request: Request, method):
-    attributes_bytes = await request.body()
-    attributes = pickle.loads(attributes_bytes)
-    sig = inspect.signature(method)
-    expected_args = set(sig.parameters.keys())
-    provided_args = set(attributes.keys())
-
-    if expected_args != provided_args:
-        raise HTTPException(status_code=400, detail="Incorrect number or names of arguments")
-    return attributes
+from manga_translator import MangaTranslator, Config, Context
+from manga_translator.mode.protocol import encode_frame, encode_message, decode_message, \
+    STATUS_RESULT, STATUS_PROGRESS, STATUS_ERROR, STATUS_TIMING
+
+
+async def load_data(request: Request):
+    """Decodes a translation request, which holds the encoded input image and the config"""
+    try:
+        meta, buffers = decode_message(await request.body())
+        image = Image.open(io.BytesIO(buffers['image']))
+        config = Config.model_validate_json(meta['config'])
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Malformed request: {e}")
+    return image, config
+
+
+def encode_result(ctx: Context) -> bytes:
+    """
+    Encodes the fields of a translation result the web server responds with: the rendered image
+    as PNG, the text regions, the inpainted background behind every region and the stage timings.
+    """
+    img_byte_arr = io.BytesIO()
+    ctx.result.save(img_byte_arr, format="PNG")
+    regions = []
+    buffers = {'result': img_byte_arr.getbuffer()}
+    for i, region in enumerate(ctx.text_regions or []):
+        minX, minY, maxX, maxY = (int(v) for v in region.xyxy)
+        if 'translations' in ctx:
+            text = {key: value[i] for key, value in ctx.translations.items()}
+        else:
+            text = {}
+        text[region.source_lang] = region.text
+        region.adjust_bg_color = False
+        fg, bg = region.get_font_colors()
+        regions.append({
+            'minX': minX, 'minY': minY, 'maxX': maxX, 'maxY': maxY,
+            'is_bulleted_list': region.is_bulleted_list,
+            'angle': float(region.angle),
+            'prob': float(region.prob),
+            'text_color': {'fg': fg.tolist(), 'bg': bg.tolist()},
+            'text': text,
+        })
+        buffers[f'background{i}'] = ctx.img_inpainted[minY:maxY, minX:maxX]
+    return encode_message({'regions': regions, 'timings': ctx.timings or {}}, buffers)
 
 
 class MangaShare:
@@ -35,42 +62,37 @@ class MangaShare:
         self.port = int(params.get('port', '5003'))
         self.nonce = params.get('nonce', None)
 
-        # each chunk has a structure like this status_code(int/1byte),len(int/4bytes),bytechunk
-        # status codes are 0 for result, 1 for progress report, 2 for error
+        # the stream is made of frames, see manga_translator.mode.protocol
         self.progress_queue = asyncio.Queue()
         self.lock = Lock()
 
         async def hook(state: str, finished: bool):
-            state_data = state.encode("utf-8")
-            progress_data = b'\x01' + len(state_data).to_bytes(4, 'big') + state_data
-            await self.progress_queue.put(progress_data)
+            await self.progress_queue.put(encode_frame(STATUS_PROGRESS, state.encode("utf-8")))
             await asyncio.sleep(0)
 
+        async def timing_hook(stage: str, timing: dict):
+            data = json.dumps({'stage': stage, **timing}).encode("utf-8")
+            await self.progress_queue.put(encode_frame(STATUS_TIMING, data))
+
         self.manga.add_progress_hook(hook)
+        self.manga.add_timing_hook(timing_hook)
 
     async def progress_stream(self):
         """
-        loops until the status is != 1 which is eiter an error or the result
+        loops until the status is either an error or the result
         """
         while True:
             progress = await self.progress_queue.get()
             yield progress
-            if progress[0] != 1:
+            if progress[0] in (STATUS_RESULT, STATUS_ERROR):
                 break
 
-    async def run_method(self, method, **attributes):
+    async def run_translate(self, image: Image.Image, config: Config):
         try:
-            if asyncio.iscoroutinefunction(method):
-                result = await method(**attributes)
-            else:
-                result = method(**attributes)
-            result_bytes = pickle.dumps(result)
-            encoded_result = b'\x00' + len(result_bytes).to_bytes(4, 'big') + result_bytes
-            await self.progress_queue.put(encoded_result)
+            ctx = await self.manga.translate(image, config)
+            await self.progress_queue.put(encode_frame(STATUS_RESULT, encode_result(ctx)))
         except Exception as e:
-            err_bytes = str(e).encode("utf-8")
-            encoded_result = b'\x02' + len(err_bytes).to_bytes(4, 'big') + err_bytes
-            await self.progress_queue.put(encoded_result)
+            await self.progress_queue.put(encode_frame(STATUS_ERROR, str(e).encode("utf-8")))
         finally:
             self.lock.release()
 
@@ -84,14 +106,8 @@ class MangaShare:
     def check_lock(self):
         if not self.lock.acquire(blocking=False):
             raise HTTPException(status_code=429, detail="some Method is already being executed.")
-
-    def get_fn(self, method_name: str):
-        if method_name.startswith("__"):
-            raise HTTPException(status_code=403, detail="These functions are not allowed to be executed remotely")
-        method = getattr(self.manga, method_name, None)
-        if not method:
-            raise HTTPException(status_code=404, detail="Method not found")
-        return method
+        # drop the reports left over from a request that was not streamed
+        self.progress_queue = asyncio.Queue()
 
     async def listen(self, translation_params: dict = None):
         app = FastAPI()
@@ -102,34 +118,34 @@ class MangaShare:
                 return {"locked": True}
             return {"locked": False}
 
-        @app.post("/simple_execute/{method_name}")
-        async def execute_method(request: Request, method_name: str = Path(...)):
+        @app.post("/simple_execute/translate")
+        async def execute_translate(request: Request):
             self.check_nonce(request)
             self.check_lock()
-            method = self.get_fn(method_name)
-            attr = await load_data(request, method)
             try:
-                if asyncio.iscoroutinefunction(method):
-                    result = await method(**attr)
-                else:
-                    result = method(**attr)
-                self.lock.release()
-                result_bytes = pickle.dumps(result)
-                return Response(content=result_bytes, media_type="application/octet-stream")
+                image, config = await load_data(request)
+                ctx = await self.manga.translate(image, config)
+                return Response(content=encode_result(ctx), media_type="application/octet-stream")
+            except HTTPException:
+                raise
             except Exception as e:
-                self.lock.release()
                 raise HTTPException(status_code=500, detail=str(e))
+            finally:
+                self.lock.release()
 
-        @app.post("/execute/{method_name}")
-        async def execute_method(request: Request, method_name: str = Path(...)):
+        @app.post("/execute/translate")
+        async def execute_translate_stream(request: Request):
             self.check_nonce(request)
             self.check_lock()
-            method = self.get_fn(method_name)
-            attr = await load_data(request, method)
+            try:
+                image, config = await load_data(request)
+            except HTTPException:
+                self.lock.release()
+                raise
 
             # streaming response
             streaming_response = StreamingResponse(self.progress_stream(), media_type="application/octet-stream")
-            asyncio.create_task(self.run_method(method, **attr))
+            asyncio.create_task(self.run_translate(image, config))
             return streaming_response
 
         config = uvicorn.Config(app, host=self.host, port=self.port)
@@ -6,7 +6,7 @@ from .model_48px import Model48pxOCR
 from .model_48px_ctc import Model48pxCTCOCR
 from .model_manga_ocr import ModelMangaOCR
 from ..config import Ocr, OcrConfig
-from ..utils import Quadrilateral
+from ..utils import Quadrilateral, model_residency
 
 OCRS = {
     Ocr.ocr32px: Model32pxOCR,
@@ -32,10 +32,21 @@ async def prepare(ocr_key: Ocr, device: str = 'cpu'):
 
 async def dispatch(ocr_key: Ocr, image: np.ndarray, regions: List[Quadrilateral], config:Optional[OcrConfig] = None, device: str = 'cpu', verbose: bool = False) -> List[Quadrilateral]:
     ocr = get_ocr(ocr_key)
-    if isinstance(ocr, OfflineOCR):
-        await ocr.load(device)
-    config = config or OcrConfig()
-    return await ocr.recognize(image, regions, config, verbose)
+    async with model_residency.pinned(ocr):
+        if isinstance(ocr, OfflineOCR):
+            await ocr.load(device)
+        config = config or OcrConfig()
+        return await ocr.recognize(image, regions, config, verbose)
+
+async def dispatch_batch(ocr_key: Ocr, images: List[np.ndarray], regions: List[List[Quadrilateral]], config:Optional[OcrConfig] = None, device: str = 'cpu', verbose: bool = False) -> List[List[Quadrilateral]]:
+    ocr = get_ocr(ocr_key)
+    async with model_residency.pinned(ocr):
+        if isinstance(ocr, OfflineOCR):
+            await ocr.load(device)
+        config = config or OcrConfig()
+        return await ocr.recognize_batch(images, regions, config, verbose)
 
 async def unload(ocr_key: Ocr):
-    ocr_cache.pop(ocr_key, None)
+    ocr = ocr_cache.pop(ocr_key, None)
+    if isinstance(ocr, OfflineOCR):
+        await ocr.unload()
@@ -2,12 +2,35 @@ import numpy as np
 from abc import abstractmethod
 from typing import List, Union
 from collections import Counter
-import networkx as nx
-import itertools
 
 from ..config import OcrConfig
 from ..utils import InfererModule, TextBlock, ModelWrapper, Quadrilateral
 
+def plan_batches(widths: List[int], text_height: int, pixel_budget: int, max_batch_size: int = 64,
+                 bucket_ratio: float = 2.0, sort: bool = True) -> List[List[int]]:
+    """
+    Groups the textline crops with the given `widths` into batches. Every crop of a batch is padded to
+    the widest one, so the crops are sorted by width and a batch is closed once its padded size would
+    exceed `pixel_budget` pixels, it would hold more than `max_batch_size` crops or its widest crop
+    would be more than `bucket_ratio` times as wide as its narrowest one. With `sort=False` the order
+    of the crops is kept. Returns the indices of the crops of every batch.
+    """
+    order = sorted(range(len(widths)), key=lambda i: widths[i]) if sort else range(len(widths))
+    batches = []
+    batch, min_width, max_width = [], 0, 0
+    for i in order:
+        width = max(widths[i], 1)
+        new_min, new_max = min(min_width, width) if batch else width, max(max_width, width)
+        if batch and (len(batch) >= max_batch_size or (len(batch) + 1) * new_max * text_height > pixel_budget
+                      or new_max > bucket_ratio * new_min):
+            batches.append(batch)
+            batch, new_min, new_max = [], width, width
+        batch.append(i)
+        min_width, max_width = new_min, new_max
+    if batch:
+        batches.append(batch)
+    return batches
+
 class CommonOCR(InfererModule):
     def _generate_text_direction(self, bboxes: List[Union[Quadrilateral, TextBlock]]):
         if len(bboxes) > 0:
@@ -16,15 +39,11 @@ class CommonOCR(InfererModule):
                     for line_idx in range(len(blk.lines)):
                         yield blk, line_idx
             else:
-                from ..utils import quadrilateral_can_merge_region
-
-                G = nx.Graph()
-                for i, box in enumerate(bboxes):
-                    G.add_node(i, box = box)
-                for ((u, ubox), (v, vbox)) in itertools.combinations(enumerate(bboxes), 2):
-                    if quadrilateral_can_merge_region(ubox, vbox, aspect_ratio_tol=1):
-                        G.add_edge(u, v)
-                for node_set in nx.algorithms.components.connected_components(G):
+                from ..utils import quadrilateral_can_merge_region, neighbouring_quadrilaterals, connected_components
+
+                edges = [(u, v) for u, v in neighbouring_quadrilaterals(bboxes)
+                         if quadrilateral_can_merge_region(bboxes[u], bboxes[v], aspect_ratio_tol=1)]
+                for node_set in connected_components(len(bboxes), edges):
                     nodes = list(node_set)
                     # majority vote for direction
                     dirs = [box.direction for box in [bboxes[i] for i in nodes]]
@@ -45,10 +64,20 @@ class CommonOCR(InfererModule):
         '''
         return await self._recognize(image, textlines, config, verbose)
 
+    async def recognize_batch(self, images: List[np.ndarray], textlines: List[List[Quadrilateral]], config: OcrConfig, verbose: bool = False) -> List[List[Quadrilateral]]:
+        '''
+        Batched version of `recognize`, the textlines of all images can be recognized together.
+        Returns the recognized textlines of every image.
+        '''
+        return await self._recognize_batch(images, textlines, config, verbose)
+
     @abstractmethod
     async def _recognize(self, image: np.ndarray, textlines: List[Quadrilateral], config: OcrConfig, verbose: bool = False) -> List[Quadrilateral]:
         pass
 
+    async def _recognize_batch(self, images: List[np.ndarray], textlines: List[List[Quadrilateral]], config: OcrConfig, verbose: bool = False) -> List[List[Quadrilateral]]:
+        return [await self._recognize(image, page_textlines, config, verbose) for image, page_textlines in zip(images, textlines)]
+
 
 class OfflineOCR(CommonOCR, ModelWrapper):
     _MODEL_SUB_DIR = 'ocr'
@@ -56,6 +85,14 @@ class OfflineOCR(CommonOCR, ModelWrapper):
     async def _recognize(self, *args, **kwargs):
         return await self.infer(*args, **kwargs)
 
+    async def _recognize_batch(self, images: List[np.ndarray], textlines: List[List[Quadrilateral]], *args, **kwargs):
+        if not self.is_loaded():
+            raise Exception(f'{self._key}: Tried to forward pass without having loaded the model.')
+        return await self._infer_batch(images, textlines, *args, **kwargs)
+
+    async def _infer_batch(self, images: List[np.ndarray], textlines: List[List[Quadrilateral]], config: OcrConfig, verbose: bool = False) -> List[List[Quadrilateral]]:
+        return [await self._infer(image, page_textlines, config, verbose) for image, page_textlines in zip(images, textlines)]
+
     @abstractmethod
     async def _infer(self, image: np.ndarray, textlines: List[Quadrilateral], args: OcrConfig, verbose: bool = False) -> List[Quadrilateral]:
         pass
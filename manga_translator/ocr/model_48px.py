@@ -1,7 +1,7 @@
 
 import math
 from typing import Callable, List, Optional, Tuple, Union
-from collections import defaultdict
+from itertools import groupby
 import os
 import shutil
 import cv2
@@ -13,13 +13,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from manga_translator.config import OcrConfig
-from .xpos_relative_position import XPOS
+from .xpos_relative_position import XPOS, apply_rotary_pos_emb, fixed_pos_embedding
 
 # Roformer with Xpos and Local Attention ViT
 
-from .common import OfflineOCR
-from ..utils import TextBlock, Quadrilateral, chunks
-from ..utils.generic import AvgMeter
+from .common import OfflineOCR, plan_batches
+from ..utils import TextBlock, Quadrilateral, warp_textlines
 from ..utils.bubble import is_ignore
 
 # Roformer with Xpos
@@ -36,6 +35,9 @@ class Model48pxOCR(OfflineOCR):
         },
     }
 
+    # Threads used to warp the textlines of a batch, OpenCV already parallelizes every single warp
+    _CROP_THREADS = 1
+
     def __init__(self, *args, **kwargs):
         os.makedirs(self.model_dir, exist_ok=True)
         if os.path.exists('ocr_ar_48px.ckpt'):
@@ -59,38 +61,65 @@ class Model48pxOCR(OfflineOCR):
             self.use_gpu = False
         if self.use_gpu:
             self.model = self.model.to(device)
+        elif self._use_onnx(device):
+            # The beam search runs in torch with its decoder cache, only the backbone and the encoders are exported
+            self.encoder = self._load_onnx(OCREncoder(self.model), (torch.zeros(1, 3, 48, 256), torch.tensor([66])),
+                                           'ocr_ar_48px.ckpt', ['image', 'feats_lengths'], ['memory', 'mask'],
+                                           {'image': {0: 'batch', 3: 'width'}, 'feats_lengths': {0: 'batch'},
+                                            'memory': {0: 'batch', 1: 'length'}, 'mask': {0: 'batch', 1: 'length'}},
+                                           graph_file='ocr_ar_48px.encoder.onnx')
+            self.model.encode = self.encoder
+            self.model.backbone = self.model.encoders = None
 
 
     async def _unload(self):
         del self.model
+        self.encoder = None
     
     async def _infer(self, image: np.ndarray, textlines: List[Quadrilateral], config: OcrConfig, verbose: bool = False, ignore_bubble: int = 0) -> List[TextBlock]:
-        text_height = 48
-        max_chunk_size = 16
+        return (await self._infer_batch([image], [textlines], config, verbose))[0]
 
-        quadrilaterals = list(self._generate_text_direction(textlines))
-        region_imgs = [q.get_transformed_region(image, d, text_height) for q, d in quadrilaterals]
-        out_regions = []
+    async def _infer_batch(self, images: List[np.ndarray], textlines: List[List[Quadrilateral]], config: OcrConfig, verbose: bool = False) -> List[List[TextBlock]]:
+        text_height = 48
 
-        perm = range(len(region_imgs))
-        is_quadrilaterals = False
-        if len(quadrilaterals) > 0 and isinstance(quadrilaterals[0][0], Quadrilateral):
-            perm = sorted(range(len(region_imgs)), key = lambda x: region_imgs[x].shape[1])
-            is_quadrilaterals = True
+        # The textlines of all pages are batched together. Quadrilaterals are warped straight into
+        # the batches below, the lines of text blocks are cropped up front.
+        lines = []
+        crops = []
+        for page, (image, page_textlines) in enumerate(zip(images, textlines)):
+            for q, d in self._generate_text_direction(page_textlines):
+                if isinstance(q, Quadrilateral):
+                    crops.append(q.get_transformation(image.shape, d, text_height))
+                    q.assigned_direction = d
+                else:
+                    crops.append(q.get_transformed_region(image, d, text_height))
+                lines.append((page, q, d))
+        region_widths = [crop[2][0] if isinstance(crop, tuple) else crop.shape[1] for crop in crops]
+        is_quadrilaterals = [len(page_textlines) > 0 and isinstance(page_textlines[0], Quadrilateral) for page_textlines in textlines]
+        # The lines of a text block are appended to it in order, so they are not sorted by width
+        sort = not any(isinstance(q, TextBlock) for _, q, _ in lines)
+        out_regions = [[] for _ in images]
 
         ix = 0
-        for indices in chunks(perm, max_chunk_size):
+        for indices in plan_batches(region_widths, text_height, config.batch_pixels, sort=sort):
+            indices = sorted(indices, key = lambda x: lines[x][0])
             N = len(indices)
-            widths = [region_imgs[i].shape[1] for i in indices]
+            widths = [region_widths[i] for i in indices]
             max_width = 4 * (max(widths) + 7) // 4
             region = np.zeros((N, text_height, max_width, 3), dtype = np.uint8)
+            start = 0
+            for page, group in groupby(indices, key = lambda x: lines[x][0]):
+                group = list(group)
+                if is_quadrilaterals[page]:
+                    warp_textlines(images[page], [crops[idx] for idx in group], region[start: start + len(group)], self._CROP_THREADS)
+                else:
+                    for i, idx in enumerate(group):
+                        region[start + i, :, : region_widths[idx], :] = crops[idx]
+                start += len(group)
             for i, idx in enumerate(indices):
-                W = region_imgs[idx].shape[1]
-                tmp = region_imgs[idx]
-                region[i, :, : W, :]=tmp
                 if verbose:
                     os.makedirs('result/ocrs/', exist_ok=True)
-                    if quadrilaterals[idx][1] == 'v':
+                    if lines[idx][2] == 'v':
                         cv2.imwrite(f'result/ocrs/{ix}.png', cv2.rotate(cv2.cvtColor(region[i, :, :, :], cv2.COLOR_RGB2BGR), cv2.ROTATE_90_CLOCKWISE))
                     else:
                         cv2.imwrite(f'result/ocrs/{ix}.png', cv2.cvtColor(region[i, :, :, :], cv2.COLOR_RGB2BGR))
@@ -100,20 +129,12 @@ class Model48pxOCR(OfflineOCR):
             if self.use_gpu:
                 image_tensor = image_tensor.to(self.device)
             with torch.no_grad():
-                ret = self.model.infer_beam_batch_tensor(image_tensor, widths, beams_k = 5, max_seq_length = 255)
-            for i, (pred_chars_index, prob, fg_pred, bg_pred, fg_ind_pred, bg_ind_pred) in enumerate(ret):
+                ret = self.model.infer_beam_batch_tensor(image_tensor, widths, beams_k = config.beams_k, max_seq_length = 255)
+            for i, (pred_chars_index, prob, (fr, fg, fb), (br, bg, bb)) in enumerate(ret):
                 if prob < 0.2:
                     continue
-                has_fg = (fg_ind_pred[:, 1] > fg_ind_pred[:, 0])
-                has_bg = (bg_ind_pred[:, 1] > bg_ind_pred[:, 0])
                 seq = []
-                fr = AvgMeter()
-                fg = AvgMeter()
-                fb = AvgMeter()
-                br = AvgMeter()
-                bg = AvgMeter()
-                bb = AvgMeter()
-                for chid, c_fg, c_bg, h_fg, h_bg in zip(pred_chars_index, fg_pred, bg_pred, has_fg, has_bg) :
+                for chid in pred_chars_index:
                     ch = self.model.dictionary[chid]
                     if ch == '<S>':
                         continue
@@ -122,27 +143,9 @@ class Model48pxOCR(OfflineOCR):
                     if ch == '<SP>':
                         ch = ' '
                     seq.append(ch)
-                    if h_fg.item() :
-                        fr(int(c_fg[0] * 255))
-                        fg(int(c_fg[1] * 255))
-                        fb(int(c_fg[2] * 255))
-                    if h_bg.item() :
-                        br(int(c_bg[0] * 255))
-                        bg(int(c_bg[1] * 255))
-                        bb(int(c_bg[2] * 255))
-                    else :
-                        br(int(c_fg[0] * 255))
-                        bg(int(c_fg[1] * 255))
-                        bb(int(c_fg[2] * 255))
                 txt = ''.join(seq)
-                fr = min(max(int(fr()), 0), 255)
-                fg = min(max(int(fg()), 0), 255)
-                fb = min(max(int(fb()), 0), 255)
-                br = min(max(int(br()), 0), 255)
-                bg = min(max(int(bg()), 0), 255)
-                bb = min(max(int(bb()), 0), 255)
                 self.logger.info(f'prob: {prob} {txt} fg: ({fr}, {fg}, {fb}) bg: ({br}, {bg}, {bb})')
-                cur_region = quadrilaterals[indices[i]][0]
+                page, cur_region, _ = lines[indices[i]]
                 if isinstance(cur_region, Quadrilateral):
                     cur_region.text = txt
                     cur_region.prob = prob
@@ -156,11 +159,10 @@ class Model48pxOCR(OfflineOCR):
                     cur_region.text.append(txt)
                     cur_region.update_font_colors(np.array([fr, fg, fb]), np.array([br, bg, bb]))
 
-                out_regions.append(cur_region)
+                out_regions[page].append(cur_region)
 
-        if is_quadrilaterals:
-            return out_regions
-        return textlines
+        return [page_regions if page_is_quadrilaterals else page_textlines
+                for page_regions, page_is_quadrilaterals, page_textlines in zip(out_regions, is_quadrilaterals, textlines)]
 
 class ConvNeXtBlock(nn.Module):
     r""" ConvNeXt Block. There are two equivalent implementations:
@@ -381,109 +383,111 @@ def generate_square_subsequent_mask(sz):
     mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
     return mask
 
-class Beam:
-    def __init__(self, char_seq = [], logprobs = []):
-        # L
-        if isinstance(char_seq, list):
-            self.chars = torch.tensor(char_seq, dtype=torch.long)
-            self.logprobs = torch.tensor(logprobs, dtype=torch.float32)
-        else:
-            self.chars = char_seq.clone()
-            self.logprobs = logprobs.clone()
-
-    def avg_logprob(self):
-        return self.logprobs.mean().item()
-
-    def sort_key(self):
-        return -self.avg_logprob()
-
-    def seq_end(self, end_tok):
-        return self.chars.view(-1)[-1] == end_tok
-
-    def extend(self, idx, logprob):
-        return Beam(
-            torch.cat([self.chars, idx.unsqueeze(0)], dim = -1),
-            torch.cat([self.logprobs, logprob.unsqueeze(0)], dim = -1),
-        )
-
-DECODE_BLOCK_LENGTH = 8
+def average_char_colors(chars: torch.LongTensor, fg_pred: torch.Tensor, bg_pred: torch.Tensor, fg_ind_pred: torch.Tensor,
+                        bg_ind_pred: torch.Tensor, start_tok: int, end_tok: int) -> torch.LongTensor:
+    """
+    Averages the colours predicted for the chars (N, L) of N textlines up to their end token. The fg
+    colour is averaged over the chars that have one, the bg colour over all chars and falls back to
+    the fg colour of the chars without one. Returns the fg and bg colours (N, 6) in 0-255.
+    """
+    valid = ((chars == end_tok).cumsum(1) == 0) & (chars != start_tok)
+    has_fg = valid & (fg_ind_pred[..., 1] > fg_ind_pred[..., 0])
+    has_bg = bg_ind_pred[..., 1] > bg_ind_pred[..., 0]
+    fg = (fg_pred * 255).trunc()
+    bg = torch.where(has_bg[..., None], (bg_pred * 255).trunc(), fg)
+    fg = (fg * has_fg[..., None]).sum(1) / has_fg.sum(1, keepdim = True).clamp(min = 1)
+    bg = (bg * valid[..., None]).sum(1) / valid.sum(1, keepdim = True).clamp(min = 1)
+    return torch.cat([fg, bg], dim = 1).trunc().clamp(0, 255).long()
+
+class DecoderKVCache:
+    """
+    Keys and values of the decoder attentions during beam search over N samples with `beams`
+    hypotheses each. The keys and values of the self attentions are written into preallocated
+    buffers step by step, the ones of the encoder output are computed once and shared by the
+    hypotheses of a sample.
+    """
+    def __init__(self, decoders: nn.ModuleList, memory: torch.Tensor, memory_mask: torch.BoolTensor, beams: int, max_seq_length: int):
+        N, S, E = memory.shape
+        attn: XposMultiheadAttention = decoders[0].self_attn
+        self.num_heads, self.head_dim = attn.num_heads, attn.head_dim
+        # L, N, k, H, T, D
+        self.self_k = memory.new_zeros(len(decoders), N, beams, self.num_heads, max_seq_length, self.head_dim)
+        self.self_v = torch.zeros_like(self.self_k)
+        # L, N, H, S, D
+        memory_k, memory_v = [], []
+        for layer in decoders:
+            cross_attn: XposMultiheadAttention = layer.multihead_attn
+            k = cross_attn.k_proj(memory).view(N, S, self.num_heads, self.head_dim).transpose(1, 2)
+            k = cross_attn.xpos(k.reshape(N * self.num_heads, S, self.head_dim), downscale = True)
+            memory_k.append(k.view(N, self.num_heads, S, self.head_dim))
+            memory_v.append(cross_attn.v_proj(memory).view(N, S, self.num_heads, self.head_dim).transpose(1, 2))
+        self.memory_k = torch.stack(memory_k)
+        self.memory_v = torch.stack(memory_v)
+        # N, 1, 1, S
+        self.memory_mask = memory_mask[:, None, None, :]
+        # Xpos of the self attention at every position. Queries and keys are scaled relative to
+        # position 0 instead of the middle of the sequence, which cancels out in their products.
+        self.pos_scale, self.pos_sin, self.pos_cos = [], [], []
+        positions = torch.arange(max_seq_length, device = memory.device, dtype = memory.dtype)
+        for layer in decoders:
+            xpos = layer.self_attn.xpos
+            scale = xpos.scale ** positions.div(xpos.scale_base)[:, None]
+            sin, cos = fixed_pos_embedding(scale)
+            self.pos_scale.append(scale)
+            self.pos_sin.append(sin)
+            self.pos_cos.append(cos)
+
+    def select(self, index: torch.LongTensor):
+        """Keeps the samples at `index`"""
+        self.self_k = self.self_k[:, index]
+        self.self_v = self.self_v[:, index]
+        self.memory_k = self.memory_k[:, index]
+        self.memory_v = self.memory_v[:, index]
+        self.memory_mask = self.memory_mask[index]
+
+    def reorder(self, parents: torch.LongTensor, step: int):
+        """Makes hypothesis j of every sample continue hypothesis `parents[:, j]` up to `step`"""
+        samples = torch.arange(parents.size(0), device = parents.device)[:, None]
+        self.self_k[:, :, :, :, : step + 1] = self.self_k[:, samples, parents, :, : step + 1]
+        self.self_v[:, :, :, :, : step + 1] = self.self_v[:, samples, parents, :, : step + 1]
+
+    def self_attention(self, l: int, attn: XposMultiheadAttention, x: torch.Tensor, step: int) -> torch.Tensor:
+        N, K, E = x.shape
+        H, D = self.num_heads, self.head_dim
+        q = (attn.q_proj(x) * attn.scaling).reshape(N * K * H, 1, D)
+        k = attn.k_proj(x).reshape(N * K * H, 1, D)
+        sin, cos, scale = self.pos_sin[l][step: step + 1], self.pos_cos[l][step: step + 1], self.pos_scale[l][step: step + 1]
+        q = apply_rotary_pos_emb(q, sin, cos, scale)
+        self.self_k[l, :, :, :, step] = apply_rotary_pos_emb(k, sin, cos, 1 / scale).view(N, K, H, D)
+        self.self_v[l, :, :, :, step] = attn.v_proj(x).view(N, K, H, D)
+        # N, k, H, 1, T
+        attn_weights = torch.matmul(q.view(N, K, H, 1, D), self.self_k[l, :, :, :, : step + 1].transpose(-1, -2))
+        attn_weights = F.softmax(attn_weights, dim = -1, dtype = torch.float32).type_as(attn_weights)
+        out = torch.matmul(attn_weights, self.self_v[l, :, :, :, : step + 1])
+        return attn.out_proj(out.view(N, K, E))
+
+    def cross_attention(self, l: int, attn: XposMultiheadAttention, x: torch.Tensor, step: int) -> torch.Tensor:
+        N, K, E = x.shape
+        H, D = self.num_heads, self.head_dim
+        q = (attn.q_proj(x) * attn.scaling).reshape(N * K * H, 1, D)
+        q = attn.xpos(q, offset = step).view(N, K, H, D).transpose(1, 2)
+        # N, H, k, S
+        attn_weights = torch.matmul(q, self.memory_k[l].transpose(-1, -2))
+        attn_weights = attn_weights.masked_fill(self.memory_mask, float('-inf'))
+        attn_weights = F.softmax(attn_weights, dim = -1, dtype = torch.float32).type_as(attn_weights)
+        out = torch.matmul(attn_weights, self.memory_v[l]).transpose(1, 2)
+        return attn.out_proj(out.reshape(N, K, E))
+
+class OCREncoder(nn.Module):
+    """
+    Wraps `OCR.encode` of `ocr` as a module for the export to ONNX.
+    """
+    def __init__(self, ocr: 'OCR'):
+        super().__init__()
+        self.ocr = ocr
 
-class Hypothesis:
-    def __init__(self, device, start_tok: int, end_tok: int, padding_tok: int, memory_idx: int, num_layers: int, embd_dim: int):
-        self.device = device
-        self.start_tok = start_tok
-        self.end_tok = end_tok
-        self.padding_tok = padding_tok
-        self.memory_idx = memory_idx
-        self.embd_size = embd_dim
-        self.num_layers = num_layers
-        # 1, L, E
-        self.cached_activations = [torch.zeros(1, 0, self.embd_size).to(self.device)] * (num_layers + 1)
-        self.out_idx = torch.LongTensor([start_tok]).to(self.device)
-        self.out_logprobs = torch.FloatTensor([0]).to(self.device)
-        self.length = 0
-
-    def seq_end(self):
-        return self.out_idx.view(-1)[-1] == self.end_tok
-
-    def logprob(self):
-        return self.out_logprobs.mean().item()
-
-    def sort_key(self):
-        return -self.logprob()
-
-    def prob(self):
-        return self.out_logprobs.mean().exp().item()
-
-    def __len__(self):
-        return self.length
-
-    def extend(self, idx, logprob):
-        ret = Hypothesis(self.device, self.start_tok, self.end_tok, self.padding_tok, self.memory_idx, self.num_layers, self.embd_size)
-        ret.cached_activations = [item.clone() for item in self.cached_activations]
-        ret.length = self.length + 1
-        ret.out_idx = torch.cat([self.out_idx, torch.LongTensor([idx]).to(self.device)], dim = 0)
-        ret.out_logprobs = torch.cat([self.out_logprobs, torch.FloatTensor([logprob]).to(self.device)], dim = 0)
-        return ret
-
-    def output(self):
-        return self.cached_activations[-1]
-
-def next_token_batch(
-    hyps: List[Hypothesis],
-    memory: torch.Tensor, # N, H, W, C
-    memory_mask: torch.BoolTensor,
-    decoders: nn.ModuleList,
-    embd: nn.Embedding
-    ):
-    layer: nn.TransformerDecoderLayer
-    N = len(hyps)
-    offset = len(hyps[0])
-
-    # N
-    last_toks = torch.stack([item.out_idx[-1] for item in hyps])
-    # N, 1, E
-    tgt: torch.FloatTensor = embd(last_toks).unsqueeze_(1)
-    
-    # N, L, E
-    memory = torch.stack([memory[idx, :, :] for idx in [item.memory_idx for item in hyps]], dim = 0)
-    for l, layer in enumerate(decoders):
-        # TODO: keys and values are recomputed every time
-        # N, L - 1, E
-        combined_activations = torch.cat([item.cached_activations[l] for item in hyps], dim = 0)
-        # N, L, E
-        combined_activations = torch.cat([combined_activations, tgt], dim = 1)
-        for i in range(N):
-            hyps[i].cached_activations[l] = combined_activations[i: i + 1, :, :]
-        # N, 1, E
-        tgt = tgt + layer.self_attn(layer.norm1(tgt), layer.norm1(combined_activations), layer.norm1(combined_activations), q_offset = offset)[0]
-        tgt = tgt + layer.multihead_attn(layer.norm2(tgt), memory, memory, key_padding_mask = memory_mask, q_offset = offset)[0]
-        tgt = tgt + layer._ff_block(layer.norm3(tgt))
-    #print(tgt[0, 0, 0])
-    for i in range(N):
-        hyps[i].cached_activations[len(decoders)] = torch.cat([hyps[i].cached_activations[len(decoders)], tgt[i: i + 1, :, :]], dim = 1)
-    # N, E
-    return tgt.squeeze_(1)
+    def forward(self, img: torch.FloatTensor, feats_lengths: torch.LongTensor) -> Tuple[torch.Tensor, torch.BoolTensor]:
+        return self.ocr.encode(img, feats_lengths)
 
 class OCR(nn.Module):
     def __init__(self, dictionary, max_len):
@@ -511,7 +515,6 @@ class OCR(nn.Module):
             decoder.self_attn = XposMultiheadAttention(embd_dim, nhead, self_attention = True)
             decoder.multihead_attn = XposMultiheadAttention(embd_dim, nhead, encoder_decoder_attention = True)
             self.decoders.append(decoder)
-        self.decoders.forward = self.decoder_forward
         
         self.embd = nn.Embedding(self.dict_size, embd_dim)
         self.pred1 = nn.Sequential(nn.Linear(embd_dim, embd_dim), nn.GELU(), nn.Dropout(0.15))
@@ -528,31 +531,29 @@ class OCR(nn.Module):
             memory = layer(layer, src = memory, src_key_padding_mask = encoder_mask)
         return memory
 
-    def decoder_forward(
-        self,
-        embd: torch.Tensor,
-        cached_activations: torch.Tensor,  # Shape [N, L, T, E] where L=num_layers, T=sequence length, E=embedding size
-        memory: torch.Tensor,  # Shape [N, H, W, C] (Encoder memory output)
-        memory_mask: torch.BoolTensor,
-        step: int
-    ):
+    def encode(self, img: torch.FloatTensor, feats_lengths: torch.LongTensor) -> Tuple[torch.Tensor, torch.BoolTensor]:
+        """
+        Runs the backbone and the encoders on the images (N, 3, 48, W) whose features are valid up to
+        `feats_lengths` (N,). Returns the encoded features (N, S, E) and their padding mask (N, S).
+        """
+        memory = self.backbone(img)
+        memory = einops.rearrange(memory, 'N C 1 W -> N W C')
+        input_mask = torch.arange(memory.size(1), device = img.device)[None, :] >= feats_lengths[:, None]
+        memory = self.encoders(memory, input_mask) # N, W, Dim
+        return memory, input_mask
 
+    def decode_step(self, tokens: torch.LongTensor, cache: DecoderKVCache, step: int) -> torch.Tensor:
+        """
+        Runs the decoders on the tokens (N, k) of the hypotheses at position `step` and returns their
+        outputs (N, k, E). The keys and values of the tokens are added to `cache`.
+        """
         layer: nn.TransformerDecoderLayer
-        tgt = embd  # N, 1, E for the last token embedding
-
+        tgt = self.embd(tokens)
         for l, layer in enumerate(self.decoders):
-            combined_activations = cached_activations[:, l, :step, :]  # N, T, E
-            combined_activations = torch.cat([combined_activations, tgt], dim=1)  # N, T+1, E
-            cached_activations[:, l, step, :] = tgt.squeeze(1)
-
-            # Update cache and perform self attention
-            tgt = tgt + layer.self_attn(layer.norm1(tgt), layer.norm1(combined_activations), layer.norm1(combined_activations), q_offset=step)[0]
-            tgt = tgt + layer.multihead_attn(layer.norm2(tgt), memory, memory, key_padding_mask=memory_mask, q_offset=step)[0]
+            tgt = tgt + cache.self_attention(l, layer.self_attn, layer.norm1(tgt), step)
+            tgt = tgt + cache.cross_attention(l, layer.multihead_attn, layer.norm2(tgt), step)
             tgt = tgt + layer._ff_block(layer.norm3(tgt))
-
-        cached_activations[:, l+1, step, :] = tgt.squeeze(1) # Append the new activations
-
-        return tgt.squeeze_(1), cached_activations
+        return tgt
 
     def forward(self,
         img: torch.FloatTensor,
@@ -580,208 +581,98 @@ class OCR(nn.Module):
             self.color_pred_fg_ind(color_feats), \
             self.color_pred_bg_ind(color_feats)
 
-    def infer_beam_batch(self, img: torch.FloatTensor, img_widths: List[int], beams_k: int = 5, start_tok = 1, end_tok = 2, pad_tok = 0, max_finished_hypos: int = 2, max_seq_length = 384):
-        N, C, H, W = img.shape
-        assert H == 48 and C == 3
-        memory = self.backbone(img)
-        memory = einops.rearrange(memory, 'N C 1 W -> N W C')
-        valid_feats_length = [(x + 3) // 4 + 2 for x in img_widths]
-        input_mask = torch.zeros(N, memory.size(1), dtype = torch.bool).to(img.device)
-        for i, l in enumerate(valid_feats_length):
-            input_mask[i, l:] = True
-        for layer in self.encoders :
-            memory = layer(layer, src = memory, src_key_padding_mask = input_mask)
-        hypos = [Hypothesis(img.device, start_tok, end_tok, pad_tok, i, len(self.decoders), 320) for i in range(N)]
-        # N, E
-        decoded = next_token_batch(hypos, memory, input_mask, self.decoders, self.embd)
-        # N, n_chars
-        pred_char_logprob = self.pred(self.pred1(decoded)).log_softmax(-1)
-        # N, k
-        pred_chars_values, pred_chars_index = torch.topk(pred_char_logprob, beams_k, dim = 1)
-        new_hypos: List[Hypothesis] = []
-        finished_hypos = defaultdict(list)
-        for i in range(N):
-            for k in range(beams_k):
-                new_hypos.append(hypos[i].extend(pred_chars_index[i, k], pred_chars_values[i, k]))
-        hypos = new_hypos
-        for ixx in range(max_seq_length):
-            # N * k, E
-            decoded = next_token_batch(hypos, memory, torch.stack([input_mask[hyp.memory_idx] for hyp in hypos]) , self.decoders, self.embd)
-            # N * k, n_chars
-            pred_char_logprob = self.pred(self.pred1(decoded)).log_softmax(-1)
-            # N * k, k
-            pred_chars_values, pred_chars_index = torch.topk(pred_char_logprob, beams_k, dim = 1)
-            hypos_per_sample = defaultdict(list)
-            h: Hypothesis
-            for i, h in enumerate(hypos):
-                for k in range(beams_k):
-                    hypos_per_sample[h.memory_idx].append(h.extend(pred_chars_index[i, k], pred_chars_values[i, k]))
-            hypos = []
-            # hypos_per_sample now contains N * k^2 hypos
-            for i in hypos_per_sample.keys():
-                cur_hypos: List[Hypothesis] = hypos_per_sample[i]
-                cur_hypos = sorted(cur_hypos, key = lambda a: a.sort_key())[: beams_k + 1]
-                #print(cur_hypos[0].out_idx[-1])
-                to_added_hypos = []
-                sample_done = False
-                for h in cur_hypos:
-                    if h.seq_end():
-                        finished_hypos[i].append(h)
-                        if len(finished_hypos[i]) >= max_finished_hypos:
-                            sample_done = True
-                            break
-                    else:
-                        if len(to_added_hypos) < beams_k:
-                            to_added_hypos.append(h)
-                if not sample_done:
-                    hypos.extend(to_added_hypos)
-            if len(hypos) == 0:
-                break
-        # add remaining hypos to finished
-        for i in range(N):
-            if i not in finished_hypos:
-                cur_hypos: List[Hypothesis] = hypos_per_sample[i]
-                cur_hypo = sorted(cur_hypos, key = lambda a: a.sort_key())[0]
-                finished_hypos[i].append(cur_hypo)
-        assert len(finished_hypos) == N
-        result = []
-        for i in range(N):
-            cur_hypos = finished_hypos[i]
-            cur_hypo = sorted(cur_hypos, key = lambda a: a.sort_key())[0]
-            decoded = cur_hypo.output()
-            color_feats = self.color_pred1(decoded)
-            fg_pred, bg_pred, fg_ind_pred, bg_ind_pred = \
-                self.color_pred_fg(color_feats), \
-                self.color_pred_bg(color_feats), \
-                self.color_pred_fg_ind(color_feats), \
-                self.color_pred_bg_ind(color_feats)
-            result.append((cur_hypo.out_idx[1:], cur_hypo.prob(), fg_pred[0], bg_pred[0], fg_ind_pred[0], bg_ind_pred[0]))
-        return result
-
     def infer_beam_batch_tensor(self, img: torch.FloatTensor, img_widths: List[int], beams_k: int = 5, start_tok = 1, end_tok = 2, pad_tok = 0, max_finished_hypos: int = 2, max_seq_length = 384):
+        """
+        Beam search with `beams_k` hypotheses per image, `beams_k = 1` decodes greedily. An image
+        leaves the batch once `max_finished_hypos` of its hypotheses have ended. Returns the char
+        indices, their probability and the fg/bg colour predictions of the best hypothesis per image.
+        """
         N, C, H, W = img.shape
         assert H == 48 and C == 3
-
-        memory = self.backbone(img)
-        memory = einops.rearrange(memory, 'N C 1 W -> N W C')
-        valid_feats_length = [(x + 3) // 4 + 2 for x in img_widths]
-        input_mask = torch.zeros(N, memory.size(1), dtype = torch.bool).to(img.device)
-        
-        for i, l in enumerate(valid_feats_length):
-            input_mask[i, l:] = True
-        memory = self.encoders(memory, input_mask) # N, W, Dim
-
-        out_idx = torch.full((N, 1), start_tok, dtype=torch.long, device=img.device)  # Shape [N, 1]
-        cached_activations = torch.zeros(N, len(self.decoders)+1, max_seq_length, 320, device=img.device)  # [N, L, S, E]
-        log_probs = torch.zeros(N, 1, device=img.device)  # Shape [N, 1]        # N, E
-        idx_embedded = self.embd(out_idx[:, -1:]) 
-
-        decoded, cached_activations = self.decoders(idx_embedded, cached_activations, memory, input_mask, 0)
-        pred_char_logprob = self.pred(self.pred1(decoded)).log_softmax(-1)   # N, n_chars
-        pred_chars_values, pred_chars_index = torch.topk(pred_char_logprob, beams_k, dim = 1)  # N, k
-
-        out_idx = torch.cat([out_idx.unsqueeze(1).expand(-1, beams_k, -1), pred_chars_index.unsqueeze(-1)], dim=-1).reshape(-1, 2)  # Shape [N * k, 2]
-        log_probs = pred_chars_values.view(-1, 1)  # Shape [N * k, 1]
-        memory = memory.repeat_interleave(beams_k, dim=0)
-        input_mask = input_mask.repeat_interleave(beams_k, dim=0)
-        cached_activations = cached_activations.repeat_interleave(beams_k, dim=0)
-        batch_index = torch.arange(N).repeat_interleave(beams_k, dim=0).to(img.device)
-
-        finished_hypos = defaultdict(list)
-        N_remaining = N
-
-        for step in range(1, max_seq_length):
-            idx_embedded = self.embd(out_idx[:, -1:])
-            decoded, cached_activations = self.decoders(idx_embedded, cached_activations, memory, input_mask, step)
-            pred_char_logprob = self.pred(self.pred1(decoded)).log_softmax(-1)  # Shape [N * k, dict_size]
-            pred_chars_values, pred_chars_index = torch.topk(pred_char_logprob, beams_k, dim=1)  # [N * k, k]
-
-            finished = out_idx[:, -1] == end_tok
-            pred_chars_values[finished] = 0
-            pred_chars_index[finished] = end_tok
-
-            # Extend hypotheses
-            new_out_idx = out_idx.unsqueeze(1).expand(-1, beams_k, -1)  # Shape [N * k, k, seq_len]
-            new_out_idx = torch.cat([new_out_idx, pred_chars_index.unsqueeze(-1)], dim=-1)  # Shape [N * k, k, seq_len + 1]
-            new_out_idx = new_out_idx.view(-1, step + 2)  # Reshape to [N * k^2, seq_len + 1]
-            new_log_probs = log_probs.unsqueeze(1).expand(-1, beams_k, -1) + pred_chars_values.unsqueeze(-1)  # Shape [N * k^2, 1]
-            new_log_probs = new_log_probs.view(-1, 1)  # [N * k^2, 1]
-
-            # Sort and select top-k hypotheses per sample
-            new_out_idx = new_out_idx.view(N_remaining, -1, step + 2)  # [N, k^2, seq_len + 1]
-            new_log_probs = new_log_probs.view(N_remaining, -1)  # [N, k^2]
-            batch_topk_log_probs, batch_topk_indices = new_log_probs.topk(beams_k, dim=1)  # [N, k]
-            
-            # Gather the top-k hypotheses based on log probabilities
-            expanded_topk_indices = batch_topk_indices.unsqueeze(-1).expand(-1, -1, new_out_idx.shape[-1])  # Shape [N, k, seq_len + 1]
-            out_idx = torch.gather(new_out_idx, 1, expanded_topk_indices).reshape(-1, step + 2)  # [N * k, seq_len + 1]
-            log_probs = batch_topk_log_probs.view(-1, 1)  # Reshape to [N * k, 1]
-
-            # Check for finished sequences
-            finished = (out_idx[:, -1] == end_tok)  # Check if the last token is the end token
-            finished = finished.view(N_remaining, beams_k)  # Reshape to [N, k]
-            finished_counts = finished.sum(dim=1)  # Count the number of finished hypotheses per sample
-            finished_batch_indices = (finished_counts >= max_finished_hypos).nonzero(as_tuple=False).squeeze()
-
-            if finished_batch_indices.numel() == 0:
+        K = beams_k
+        max_finished_hypos = min(max_finished_hypos, K)
+
+        feats_lengths = torch.tensor([(x + 3) // 4 + 2 for x in img_widths], dtype = torch.long, device = img.device)
+        memory, input_mask = self.encode(img, feats_lengths)
+
+        cache = DecoderKVCache(self.decoders, memory, input_mask, K, max_seq_length)
+        # N, k, T + 1
+        out_idx = torch.full((N, K, max_seq_length + 1), pad_tok, dtype = torch.long, device = img.device)
+        out_idx[:, :, 0] = start_tok
+        # All hypotheses start out the same, only the first one is extended in the first step
+        log_probs = torch.full((N, K), float('-inf'), device = img.device)
+        log_probs[:, 0] = 0
+        finished = torch.zeros(N, K, dtype = torch.bool, device = img.device)
+        # Decoder outputs, the colours of the chars are predicted from them
+        decoded = memory.new_zeros(N, K, max_seq_length, memory.size(2))
+        # A finished hypothesis is carried over once, unchanged
+        finished_values = torch.full((K,), float('-inf'), device = img.device)
+        finished_values[0] = 0
+        batch_index = torch.arange(N, device = img.device)
+        beam_index = torch.arange(K, device = img.device)
+        finished_hypos = {}
+
+        for step in range(max_seq_length):
+            n = out_idx.size(0)
+            decoded[:, :, step] = self.decode_step(out_idx[:, :, step], cache, step)
+            pred_char_logprob = self.pred(self.pred1(decoded[:, :, step])).log_softmax(-1)  # n, k, n_chars
+            pred_chars_values, pred_chars_index = torch.topk(pred_char_logprob, K, dim = -1)  # n, k, k
+            pred_chars_values = torch.where(finished[..., None], finished_values, pred_chars_values)
+            pred_chars_index = pred_chars_index.masked_fill(finished[..., None], end_tok)
+
+            # Select the top k of the k * k extended hypotheses of every sample
+            log_probs, topk = (log_probs[..., None] + pred_chars_values).view(n, K * K).topk(K, dim = 1)
+            parents = topk // K
+            next_idx = pred_chars_index.view(n, K * K).gather(1, topk)
+            if not torch.equal(parents, beam_index.expand(n, -1)):
+                samples = torch.arange(n, device = img.device)[:, None]
+                out_idx = out_idx[samples, parents]
+                decoded[:, :, : step + 1] = decoded[samples, parents, : step + 1]
+                finished = finished.gather(1, parents)
+                cache.reorder(parents, step)
+            out_idx[:, :, step + 1] = next_idx
+            finished |= next_idx == end_tok
+
+            done = finished.sum(dim = 1) >= max_finished_hypos
+            if step == max_seq_length - 1:
+                done[:] = True
+            if not done.any():
                 continue
-
-            if finished_batch_indices.dim() == 0:
-                finished_batch_indices = finished_batch_indices.unsqueeze(0)
-            
-            for idx in finished_batch_indices:
-                batch_log_probs = batch_topk_log_probs[idx]
-                best_beam_idx = batch_log_probs.argmax()
-                finished_hypos[batch_index[beams_k * idx].item()] = \
-                    out_idx[idx * beams_k + best_beam_idx], \
-                    torch.exp(batch_log_probs[best_beam_idx]).item(), \
-                    cached_activations[idx * beams_k + best_beam_idx] 
-
-            remaining_indexs = []
-            for i in range(N_remaining):
-                if i not in finished_batch_indices:
-                    for j in range(beams_k):
-                        remaining_indexs.append(i * beams_k + j)
-
-            if not remaining_indexs:
+            for i in done.nonzero(as_tuple = True)[0].tolist():
+                # The hypotheses are sorted, take the best finished one or the best one otherwise
+                beam = int(finished[i].int().argmax())
+                length = step + 1
+                if finished[i, beam]:
+                    length = int((out_idx[i, beam, 1:] == end_tok).int().argmax()) + 1
+                finished_hypos[batch_index[i].item()] = \
+                    out_idx[i, beam, 1: length + 1], \
+                    torch.exp(log_probs[i, beam]).item(), \
+                    decoded[i, beam, : length]
+            remaining = (~done).nonzero(as_tuple = True)[0]
+            if remaining.numel() == 0:
                 break
-
-            N_remaining = int(len(remaining_indexs) / beams_k)
-            out_idx = out_idx.index_select(0, torch.tensor(remaining_indexs, device=img.device))
-            log_probs = log_probs.index_select(0, torch.tensor(remaining_indexs, device=img.device))
-            memory = memory.index_select(0, torch.tensor(remaining_indexs, device=img.device))
-            cached_activations = cached_activations.index_select(0, torch.tensor(remaining_indexs, device=img.device))
-            input_mask = input_mask.index_select(0, torch.tensor(remaining_indexs, device=img.device))
-            batch_index = batch_index.index_select(0, torch.tensor(remaining_indexs, device=img.device))
-
-        # Ensure we have the correct number of finished hypotheses for each sample
-        if len(finished_hypos) < N: # Fallback if not enough finished hypos
-            for i in range(N):
-                if i not in finished_hypos:
-                    # Select the best hypothesis available at the end of beam search
-                    sample_indices = (batch_index == i).nonzero(as_tuple=True)[0]
-                    if sample_indices.numel() > 0:
-                        best_hypo_index = sample_indices[0] # Take the first one as fallback
-                        finished_hypos[i] = out_idx[best_hypo_index], torch.exp(log_probs[best_hypo_index]).item(), cached_activations[best_hypo_index]
-                    else:
-                        # If no hypothesis is available at all (very unlikely, but for robustness)
-                        finished_hypos[i] = (torch.tensor([end_tok], device=img.device), 0.0, torch.zeros(cached_activations.shape[1:], device=img.device)) # Dummy hypo
+            out_idx = out_idx[remaining]
+            log_probs = log_probs[remaining]
+            finished = finished[remaining]
+            decoded = decoded[remaining]
+            batch_index = batch_index[remaining]
+            cache.select(remaining)
 
         assert len(finished_hypos) == N
 
-        # Final output processing and color predictions
-        result = []
+        # Colour predictions of all images at once
+        lengths = [len(finished_hypos[i][0]) for i in range(N)]
+        chars = torch.full((N, max(lengths)), end_tok, dtype = torch.long, device = img.device)
+        decoded = memory.new_zeros(N, max(lengths), memory.size(2))
         for i in range(N):
-            final_idx, prob, decoded = finished_hypos[i] 
-            color_feats = self.color_pred1(decoded[-1].unsqueeze(0))
-            fg_pred, bg_pred, fg_ind_pred, bg_ind_pred = \
-                self.color_pred_fg(color_feats), \
-                self.color_pred_bg(color_feats), \
-                self.color_pred_fg_ind(color_feats), \
-                self.color_pred_bg_ind(color_feats)
-            result.append((final_idx[1:], prob, fg_pred[0], bg_pred[0], fg_ind_pred[0], bg_ind_pred[0]))
+            chars[i, : lengths[i]] = finished_hypos[i][0]
+            decoded[i, : lengths[i]] = finished_hypos[i][2]
+        color_feats = self.color_pred1(decoded)
+        colors = average_char_colors(chars, self.color_pred_fg(color_feats), self.color_pred_bg(color_feats),
+                                     self.color_pred_fg_ind(color_feats), self.color_pred_bg_ind(color_feats), start_tok, end_tok)
+        chars, colors = chars.tolist(), colors.tolist()
 
-        return result
+        return [(chars[i][: lengths[i]], finished_hypos[i][1], colors[i][: 3], colors[i][3:]) for i in range(N)]
 
 import numpy as np
 
@@ -820,19 +711,12 @@ def test_infer() :
     img_torch = einops.rearrange((torch.from_numpy(img) / 127.5 - 1.0), 'h w c -> 1 c h w')
 
     with torch.no_grad() :
-        idx, prob, fg_pred, bg_pred, fg_ind_pred, bg_ind_pred = model.infer_beam_batch(img_torch, [new_w], 5, max_seq_length = 32)[0]
+        idx, prob, fg, bg = model.infer_beam_batch_tensor(img_torch, [new_w], 5, max_seq_length = 32)[0]
         txt = ''
         for i in idx :
             txt += dictionary[i]
         print(txt, prob)
-        for chid, fg, bg, fg_ind, bg_ind in zip(idx, fg_pred[0], bg_pred[0], fg_ind_pred[0], bg_ind_pred[0]) :
-            has_fg = (fg_ind[1] > fg_ind[0]).item()
-            has_bg = (bg_ind[1] > bg_ind[0]).item()
-            if has_fg :
-                fg = np.clip((fg * 255).numpy(), 0, 255)
-            if has_bg :
-                bg = np.clip((bg * 255).numpy(), 0, 255)
-            print(f'{dictionary[chid]} {fg if has_fg else "None"} {bg if has_bg else "None"}')
+        print(f'fg: {fg} bg: {bg}')
 
 if __name__ == "__main__":
     test_infer()
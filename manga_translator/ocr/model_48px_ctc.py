@@ -11,8 +11,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from manga_translator.config import OcrConfig
-from .common import OfflineOCR
-from ..utils import TextBlock, Quadrilateral, AvgMeter, chunks
+from .common import OfflineOCR, plan_batches
+from ..utils import TextBlock, Quadrilateral, AvgMeter
 from ..utils.bubble import is_ignore
 
 class Model48pxCTCOCR(OfflineOCR):
@@ -60,24 +60,26 @@ class Model48pxCTCOCR(OfflineOCR):
         del self.model
 
     async def _infer(self, image: np.ndarray, textlines: List[Quadrilateral], config: OcrConfig, verbose: bool = False) -> List[TextBlock]:
+        return (await self._infer_batch([image], [textlines], config, verbose))[0]
+
+    async def _infer_batch(self, images: List[np.ndarray], textlines: List[List[Quadrilateral]], config: OcrConfig, verbose: bool = False) -> List[List[TextBlock]]:
         text_height = 48
-        max_chunk_size = 16
         ignore_bubble = config.ignore_bubble
 
-        quadrilaterals = list(self._generate_text_direction(textlines))
-        region_imgs = [q.get_transformed_region(image, d, text_height) for q, d in quadrilaterals]
-        out_regions = []
-
-        perm = range(len(region_imgs))
-        is_quadrilaterals = False
-        if len(quadrilaterals) > 0:
-            if isinstance(quadrilaterals[0][0], Quadrilateral):
-                is_quadrilaterals = True
-                # Sort regions based on width
-                perm = sorted(range(len(region_imgs)), key = lambda x: region_imgs[x].shape[1])
+        # The textlines of all pages are batched together
+        lines = []
+        region_imgs = []
+        for page, (image, page_textlines) in enumerate(zip(images, textlines)):
+            for q, d in self._generate_text_direction(page_textlines):
+                region_imgs.append(q.get_transformed_region(image, d, text_height))
+                lines.append((page, q, d))
+        is_quadrilaterals = [len(page_textlines) > 0 and isinstance(page_textlines[0], Quadrilateral) for page_textlines in textlines]
+        # The lines of a text block are appended to it in order, so they are not sorted by width
+        sort = not any(isinstance(q, TextBlock) for _, q, _ in lines)
+        out_regions = [[] for _ in images]
 
         ix = 0
-        for indices in chunks(perm, max_chunk_size):
+        for indices in plan_batches([region_img.shape[1] for region_img in region_imgs], text_height, config.batch_pixels, sort=sort):
             N = len(indices)
             widths = [region_imgs[i].shape[1] for i in indices]
             max_width = (4 * (max(widths) + 7) // 4) + 128
@@ -92,7 +94,7 @@ class Model48pxCTCOCR(OfflineOCR):
                 region[i, :, : W, :]=tmp
                 if verbose:
                     os.makedirs('result/ocrs/', exist_ok=True)
-                    if quadrilaterals[idx][1] == 'v':
+                    if lines[idx][2] == 'v':
                         cv2.imwrite(f'result/ocrs/{ix}.png', cv2.rotate(cv2.cvtColor(region[i, :, :, :], cv2.COLOR_RGB2BGR), cv2.ROTATE_90_CLOCKWISE))
                     else:
                         cv2.imwrite(f'result/ocrs/{ix}.png', cv2.cvtColor(region[i, :, :, :], cv2.COLOR_RGB2BGR))
@@ -138,7 +140,7 @@ class Model48pxCTCOCR(OfflineOCR):
                 bg = int(total_bg())
                 bb = int(total_bb())
                 self.logger.info(f'prob: {prob} {txt} fg: ({fr}, {fg}, {fb}) bg: ({br}, {bg}, {bb})')
-                cur_region = quadrilaterals[indices[i]][0]
+                page, cur_region, _ = lines[indices[i]]
                 if isinstance(cur_region, Quadrilateral):
                     cur_region.text = txt
                     cur_region.prob = prob
@@ -152,11 +154,10 @@ class Model48pxCTCOCR(OfflineOCR):
                     cur_region.text.append(txt)
                     cur_region.update_font_colors(np.array([fr, fg, fb]), np.array([br, bg, bb]))
 
-                out_regions.append(cur_region)
+                out_regions[page].append(cur_region)
 
-        if is_quadrilaterals:
-            return out_regions
-        return textlines
+        return [page_regions if page_is_quadrilaterals else page_textlines
+                for page_regions, page_is_quadrilaterals, page_textlines in zip(out_regions, is_quadrilaterals, textlines)]
 
 
 class PositionalEncoding(nn.Module):
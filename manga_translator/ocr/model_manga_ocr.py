@@ -1,4 +1,3 @@
-import itertools
 import math
 from typing import Callable, List, Set, Optional, Tuple, Union
 from collections import defaultdict, Counter
@@ -8,7 +7,6 @@ import cv2
 from PIL import Image
 import numpy as np
 import einops
-import networkx as nx
 from shapely.geometry import Polygon
 
 import torch
@@ -19,23 +17,20 @@ from .common import OfflineOCR
 from .model_48px import OCR
 from ..config import OcrConfig
 from ..textline_merge import split_text_region
-from ..utils import TextBlock, Quadrilateral, quadrilateral_can_merge_region, chunks
-from ..utils.generic import AvgMeter
+from ..utils import TextBlock, Quadrilateral, quadrilateral_can_merge_region, neighbouring_quadrilaterals, connected_components, chunks
 
 async def merge_bboxes(bboxes: List[Quadrilateral], width: int, height: int) -> Tuple[List[Quadrilateral], int]:
-    # step 1: divide into multiple text region candidates
-    G = nx.Graph()
-    for i, box in enumerate(bboxes):
-        G.add_node(i, box=box)
-    for ((u, ubox), (v, vbox)) in itertools.combinations(enumerate(bboxes), 2):
+    # step 1: divide into multiple text region candidates, only textlines close to each other can be merged
+    edges = []
+    for u, v in neighbouring_quadrilaterals(bboxes):
         # if quadrilateral_can_merge_region_coarse(ubox, vbox):
-        if quadrilateral_can_merge_region(ubox, vbox, aspect_ratio_tol=1.3, font_size_ratio_tol=2,
+        if quadrilateral_can_merge_region(bboxes[u], bboxes[v], aspect_ratio_tol=1.3, font_size_ratio_tol=2,
                                           char_gap_tolerance=1, char_gap_tolerance2=3):
-            G.add_edge(u, v)
+            edges.append((u, v))
 
     # step 2: postprocess - further split each region
     region_indices: List[Set[int]] = []
-    for node_set in nx.algorithms.components.connected_components(G):
+    for node_set in connected_components(len(bboxes), edges):
          region_indices.extend(split_text_region(bboxes, node_set, width, height))
 
     # step 3: return regions
@@ -186,42 +181,12 @@ class ModelMangaOCR(OfflineOCR):
             if self.use_gpu:
                 image_tensor = image_tensor.to(self.device)
             with torch.no_grad():
-                ret = self.model.infer_beam_batch(image_tensor, widths, beams_k = 5, max_seq_length = 255)
-            for i, (pred_chars_index, prob, fg_pred, bg_pred, fg_ind_pred, bg_ind_pred) in enumerate(ret):
+                ret = self.model.infer_beam_batch_tensor(image_tensor, widths, beams_k = config.beams_k, max_seq_length = 255)
+            for i, (pred_chars_index, prob, (fr, fg, fb), (br, bg, bb)) in enumerate(ret):
+                # The threshold is meant for the average probability per char
+                prob = prob ** (1 / (len(pred_chars_index) + 1))
                 if prob < 0.2:
                     continue
-                has_fg = (fg_ind_pred[:, 1] > fg_ind_pred[:, 0])
-                has_bg = (bg_ind_pred[:, 1] > bg_ind_pred[:, 0])
-                fr = AvgMeter()
-                fg = AvgMeter()
-                fb = AvgMeter()
-                br = AvgMeter()
-                bg = AvgMeter()
-                bb = AvgMeter()
-                for chid, c_fg, c_bg, h_fg, h_bg in zip(pred_chars_index, fg_pred, bg_pred, has_fg, has_bg) :
-                    ch = self.model.dictionary[chid]
-                    if ch == '<S>':
-                        continue
-                    if ch == '</S>':
-                        break
-                    if h_fg.item() :
-                        fr(int(c_fg[0] * 255))
-                        fg(int(c_fg[1] * 255))
-                        fb(int(c_fg[2] * 255))
-                    if h_bg.item() :
-                        br(int(c_bg[0] * 255))
-                        bg(int(c_bg[1] * 255))
-                        bb(int(c_bg[2] * 255))
-                    else :
-                        br(int(c_fg[0] * 255))
-                        bg(int(c_fg[1] * 255))
-                        bb(int(c_fg[2] * 255))
-                fr = min(max(int(fr()), 0), 255)
-                fg = min(max(int(fg()), 0), 255)
-                fb = min(max(int(fb()), 0), 255)
-                br = min(max(int(br()), 0), 255)
-                bg = min(max(int(bg()), 0), 255)
-                bb = min(max(int(bb()), 0), 255)
                 cur_region = quadrilaterals[indices[i]][0]
                 if isinstance(cur_region, Quadrilateral):
                     cur_region.prob = prob
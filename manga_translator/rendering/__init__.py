@@ -116,6 +116,7 @@ async def dispatch(
             # set render_mask to 1 for the region that is inside dst_points
             cv2.fillConvexPoly(render_mask, dst_points.astype(np.int32), 1)
         img = render(img, region, dst_points, hyphenate, line_spacing, disable_font_border)
+    text_render.save_glyph_atlas()
     return img
 
 def render(
@@ -265,11 +266,18 @@ def render(
     #src_pts[:, 1] = np.clip(np.round(src_pts[:, 1]), 0, enlarged_h * 2)
 
     M, _ = cv2.findHomography(src_points, dst_points, cv2.RANSAC, 5.0)
-    rgba_region = cv2.warpPerspective(box, M, (img.shape[1], img.shape[0]), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    # Only the bounding rect of the destination (clipped to the page) is warped into, by moving the
+    # origin of the homography to its top left corner
     x, y, w, h = cv2.boundingRect(dst_points.astype(np.int32))
-    canvas_region = rgba_region[y:y+h, x:x+w, :3]
-    mask_region = rgba_region[y:y+h, x:x+w, 3:4].astype(np.float32) / 255.0
-    img[y:y+h, x:x+w] = np.clip((img[y:y+h, x:x+w].astype(np.float32) * (1 - mask_region) + canvas_region.astype(np.float32) * mask_region), 0, 255).astype(np.uint8)
+    x1, y1 = max(x, 0), max(y, 0)
+    x2, y2 = min(x + w, img.shape[1]), min(y + h, img.shape[0])
+    if x2 <= x1 or y2 <= y1:
+        return img
+    M = np.array([[1, 0, -x1], [0, 1, -y1], [0, 0, 1]], dtype=np.float64) @ M
+    rgba_region = cv2.warpPerspective(box, M, (x2 - x1, y2 - y1), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    alpha = rgba_region[:, :, 3:4].astype(np.uint16)
+    img_region = img[y1:y2, x1:x2]
+    img_region[:] = (img_region * (255 - alpha) + rgba_region[:, :, :3] * alpha + 127) // 255
     return img
 
 async def dispatch_eng_render(img_canvas: np.ndarray, original_img: np.ndarray, text_regions: List[TextBlock], font_path: str = '', line_spacing: int = 0, disable_font_border: bool = False) -> np.ndarray:
@@ -280,4 +288,6 @@ async def dispatch_eng_render(img_canvas: np.ndarray, original_img: np.ndarray,
         font_path = os.path.join(BASE_PATH, 'fonts/comic shanns 2.ttf')
     text_render.set_font(font_path)
 
-    return render_textblock_list_eng(img_canvas, text_regions, line_spacing=line_spacing, size_tol=1.2, original_img=original_img, downscale_constraint=0.8,disable_font_border=disable_font_border)
+    img = render_textblock_list_eng(img_canvas, text_regions, line_spacing=line_spacing, size_tol=1.2, original_img=original_img, downscale_constraint=0.8,disable_font_border=disable_font_border)
+    text_render.save_glyph_atlas()
+    return img
@@ -3,8 +3,13 @@ import re
 import cv2
 import numpy as np
 import freetype
+import collections
 import functools
+import glob
+import hashlib
 import logging
+import threading
+import uuid
 from pathlib import Path
 from typing import Tuple, Optional, List
 from hyphen import Hyphenator
@@ -163,6 +168,7 @@ FALLBACK_FONTS = [
     os.path.join(BASE_PATH, 'fonts/msgothic.ttc'),
 ]
 FONT_SELECTION: List[freetype.Face] = []
+FONT_SELECTION_PATHS: List[str] = []
 font_cache = {}
 def get_cached_font(path: str) -> freetype.Face:
     path = path.replace('\\', '/')
@@ -173,61 +179,265 @@ def get_cached_font(path: str) -> freetype.Face:
     return font_cache[path]
 
 def set_font(font_path: str):
-    global FONT_SELECTION
+    global FONT_SELECTION, FONT_SELECTION_PATHS
     if font_path:
         selection = [font_path] + FALLBACK_FONTS
     else:
         selection = FALLBACK_FONTS
     FONT_SELECTION = [get_cached_font(p) for p in selection]
+    FONT_SELECTION_PATHS = [p.replace('\\', '/') for p in selection]
 
 class namespace:
     pass
 
+# Metrics of a glyph in the order they are stored in the glyph atlas
+GLYPH_METRICS = ('advance.x', 'advance.y', 'bitmap_left', 'bitmap_top', 'metrics.vertBearingX', 'metrics.vertBearingY',
+                 'metrics.horiBearingX', 'metrics.horiBearingY', 'metrics.horiAdvance', 'metrics.vertAdvance')
+
 class Glyph:
-    def __init__(self, glyph):
+    """
+    Metrics and ready to blit bitmap of a rendered character. `bitmap.array` is None for characters
+    without a valid bitmap (spaces, etc.), `bitmap.buffer` is then empty.
+    """
+    def __init__(self, metrics: List[int], array: Optional[np.ndarray], rows: int, width: int):
         self.bitmap = namespace()
-        self.bitmap.buffer = glyph.bitmap.buffer
-        self.bitmap.rows = glyph.bitmap.rows
-        self.bitmap.width = glyph.bitmap.width
+        self.bitmap.array = array
+        self.bitmap.buffer = array.ravel() if array is not None else np.empty(0, dtype=np.uint8)
+        self.bitmap.rows = rows
+        self.bitmap.width = width
         self.advance = namespace()
-        self.advance.x = glyph.advance.x
-        self.advance.y = glyph.advance.y
-        self.bitmap_left = glyph.bitmap_left
-        self.bitmap_top = glyph.bitmap_top
         self.metrics = namespace()
-        self.metrics.vertBearingX = glyph.metrics.vertBearingX
-        self.metrics.vertBearingY = glyph.metrics.vertBearingY
-        self.metrics.horiBearingX = glyph.metrics.horiBearingX
-        self.metrics.horiBearingY = glyph.metrics.horiBearingY
-        self.metrics.horiAdvance = glyph.metrics.horiAdvance
-        self.metrics.vertAdvance = glyph.metrics.vertAdvance
-
-@functools.lru_cache(maxsize = 1024, typed = True)
-def get_char_glyph(cdpt: str, font_size: int, direction: int) -> Glyph:
-    global FONT_SELECTION
+        (self.advance.x, self.advance.y, self.bitmap_left, self.bitmap_top,
+         self.metrics.vertBearingX, self.metrics.vertBearingY, self.metrics.horiBearingX,
+         self.metrics.horiBearingY, self.metrics.horiAdvance, self.metrics.vertAdvance) = metrics
+
+    @classmethod
+    def from_slot(cls, glyph) -> 'Glyph':
+        bitmap = glyph.bitmap
+        array = None
+        if bitmap.rows * bitmap.width > 0 and len(bitmap.buffer) == bitmap.rows * bitmap.width:
+            array = np.array(bitmap.buffer, dtype=np.uint8).reshape((bitmap.rows, bitmap.width))
+        metrics = [glyph.advance.x, glyph.advance.y, glyph.bitmap_left, glyph.bitmap_top,
+                   glyph.metrics.vertBearingX, glyph.metrics.vertBearingY, glyph.metrics.horiBearingX,
+                   glyph.metrics.horiBearingY, glyph.metrics.horiAdvance, glyph.metrics.vertAdvance]
+        return cls(metrics, array, bitmap.rows, bitmap.width)
+
+    def metric_values(self) -> List[int]:
+        return [self.advance.x, self.advance.y, self.bitmap_left, self.bitmap_top,
+                self.metrics.vertBearingX, self.metrics.vertBearingY, self.metrics.horiBearingX,
+                self.metrics.horiBearingY, self.metrics.horiAdvance, self.metrics.vertAdvance]
+
+class GlyphAtlas:
+    """
+    Keeps the rasterized glyph and stroke bitmaps of every font on disk, so that later runs do not
+    have to rasterize them with FreeType again. The files of a font are named after a hash of its
+    path, size and modification time, so changed fonts get a new atlas.
+
+    Every `save` writes only the bitmaps added since the previous one into a new chunk file. The
+    chunks of a font are merged into a single file once there are more than `_MAX_CHUNKS` of them
+    when the font's atlas is loaded. A chunk holds an int64 `index` with one record per bitmap
+    (see `_RECORD`) and all bitmaps concatenated in the uint8 array `pixels`.
+
+    At most `_MAX_BYTES` of saved bitmaps are kept in memory, the least recently used ones are
+    dropped and rasterized again when they are needed.
+    """
+
+    # kind (0 glyph, 1 stroke), codepoint, font size, direction, stroke radius, rows, width,
+    # offset into pixels (-1 without bitmap), followed by the glyph metrics
+    _RECORD = 8
+    _MAX_CHUNKS = 16
+    _MAX_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # keys of the bitmaps in the chunks of every loaded font
+        self._fonts = {}
+        # (font path, key) -> entry, least recently used first
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+        # entries of every font that were added since the last save
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _prefix(self, font_path: str) -> str:
+        stat = os.stat(font_path)
+        digest = hashlib.sha1(f'{os.path.abspath(font_path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, f'{Path(font_path).stem}-{digest}')
+
+    def _chunks(self, font_path: str) -> List[str]:
+        return sorted(glob.glob(glob.escape(self._prefix(font_path)) + '*.npz'))
+
+    def _load(self, font_path: str) -> set:
+        """Reads the chunks of `font_path` into the cache the first time, returns the keys stored in them"""
+        keys = self._fonts.get(font_path)
+        if keys is not None:
+            return keys
+        entries = {}
+        chunks = self._chunks(font_path)
+        for path in chunks:
+            try:
+                with np.load(path) as data:
+                    index, pixels = data['index'], data['pixels']
+                for record in index:
+                    kind, codepoint, size, direction, radius, rows, width, offset = (int(v) for v in record[:self._RECORD])
+                    # copied so the pixels of a chunk are freed once its bitmaps are dropped from the cache
+                    array = pixels[offset:offset + rows * width].reshape((rows, width)).copy() if offset >= 0 else None
+                    entries[(kind, codepoint, size, direction, radius)] = ([int(v) for v in record[self._RECORD:]], array, rows, width)
+            except Exception as e:
+                logger.warning(f'Could not read glyph atlas {path}: {e}')
+        if len(chunks) > self._MAX_CHUNKS:
+            self._write(font_path, entries)
+            for path in chunks:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # merged by another process at the same time
+                    pass
+        for key, entry in entries.items():
+            self._cache_entry(font_path, key, entry)
+        self._fonts[font_path] = keys = set(entries)
+        return keys
+
+    def _cache_entry(self, font_path: str, key: Tuple[int, int, int, int, int], entry: tuple):
+        replaced = self._cache.pop((font_path, key), None)
+        if replaced is not None and replaced[1] is not None:
+            self._cache_bytes -= replaced[1].nbytes
+        self._cache[(font_path, key)] = entry
+        self._cache_bytes += entry[1].nbytes if entry[1] is not None else 0
+        while self._cache_bytes > self._MAX_BYTES:
+            _, (_, evicted, _, _) = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted.nbytes if evicted is not None else 0
+
+    def get(self, font_path: str, key: Tuple[int, int, int, int, int]):
+        with self._lock:
+            self._load(font_path)
+            pending = self._pending.get(font_path, {}).get(key)
+            if pending is not None:
+                return pending
+            entry = self._cache.get((font_path, key))
+            if entry is not None:
+                self._cache.move_to_end((font_path, key))
+            return entry
+
+    def put(self, font_path: str, key: Tuple[int, int, int, int, int], metrics: List[int], array: Optional[np.ndarray], rows: int, width: int):
+        with self._lock:
+            entry = (metrics, array, rows, width)
+            if key in self._load(font_path):
+                # dropped from the cache, but already saved
+                if (font_path, key) not in self._cache:
+                    self._cache_entry(font_path, key, entry)
+            else:
+                self._pending.setdefault(font_path, {})[key] = entry
+
+    def _write(self, font_path: str, entries: dict):
+        """Writes the bitmaps of `entries` into a new chunk of `font_path`"""
+        index = np.zeros((len(entries), self._RECORD + len(GLYPH_METRICS)), dtype=np.int64)
+        offset = 0
+        for i, (key, (metrics, array, rows, width)) in enumerate(entries.items()):
+            index[i, :self._RECORD] = (*key, rows, width, offset if array is not None else -1)
+            index[i, self._RECORD:self._RECORD + len(metrics)] = metrics
+            if array is not None:
+                offset += array.size
+        pixels = np.concatenate([a.ravel() for _, a, _, _ in entries.values() if a is not None] or [np.empty(0, dtype=np.uint8)])
+        # chunk names are unique, so processes sharing the directory never write the same file
+        path = f'{self._prefix(font_path)}.{uuid.uuid4().hex[:16]}.npz'
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, index=index, pixels=pixels)
+        os.replace(path + '.tmp', path)
+
+    def save(self):
+        with self._lock:
+            for font_path, entries in self._pending.items():
+                self._write(font_path, entries)
+                self._fonts[font_path].update(entries)
+                for key, entry in entries.items():
+                    self._cache_entry(font_path, key, entry)
+            self._pending.clear()
+
+GLYPH_ATLAS: Optional[GlyphAtlas] = None
+
+def set_glyph_atlas(atlas: Optional[GlyphAtlas]):
+    global GLYPH_ATLAS
+    GLYPH_ATLAS = atlas
+
+def save_glyph_atlas():
+    if GLYPH_ATLAS is not None:
+        GLYPH_ATLAS.save()
+
+def select_font(cdpt: str) -> int:
+    """Returns the index of the first font of the selection that has `cdpt`, or of the last font"""
     for i, face in enumerate(FONT_SELECTION):
-        if face.get_char_index(cdpt) == 0 and i != len(FONT_SELECTION) - 1:
-            continue
-        if direction == 0:
-            face.set_pixel_sizes(0, font_size)
-        elif direction == 1:
-            face.set_pixel_sizes(font_size, 0)
-        face.load_char(cdpt)
-        return Glyph(face.glyph)
+        if face.get_char_index(cdpt) != 0:
+            return i
+    return len(FONT_SELECTION) - 1
+
+def _set_pixel_sizes(face: freetype.Face, font_size: int, direction: int):
+    if direction == 0:
+        face.set_pixel_sizes(0, font_size)
+    elif direction == 1:
+        face.set_pixel_sizes(font_size, 0)
+
+def _atlas_key(kind: int, cdpt: str, font_size: int, direction: int, stroke_radius: int):
+    if GLYPH_ATLAS is None or len(cdpt) != 1:
+        return None
+    return (kind, ord(cdpt), font_size, direction, stroke_radius)
+
+def get_char_glyph(cdpt: str, font_size: int, direction: int) -> Glyph:
+    i = select_font(cdpt)
+    return _get_char_glyph(FONT_SELECTION_PATHS[i], cdpt, font_size, direction)
+
+@functools.lru_cache(maxsize = 4096, typed = True)
+def _get_char_glyph(font_path: str, cdpt: str, font_size: int, direction: int) -> Glyph:
+    key = _atlas_key(0, cdpt, font_size, direction, 0)
+    if key is not None:
+        entry = GLYPH_ATLAS.get(font_path, key)
+        if entry is not None:
+            return Glyph(*entry)
+    face = get_cached_font(font_path)
+    _set_pixel_sizes(face, font_size, direction)
+    face.load_char(cdpt)
+    glyph = Glyph.from_slot(face.glyph)
+    if key is not None:
+        GLYPH_ATLAS.put(font_path, key, glyph.metric_values(), glyph.bitmap.array, glyph.bitmap.rows, glyph.bitmap.width)
+    return glyph
 
-#@functools.lru_cache(maxsize = 1024, typed = True)
 def get_char_border(cdpt: str, font_size: int, direction: int):
-    global FONT_SELECTION
-    for i, face in enumerate(FONT_SELECTION):
-        if face.get_char_index(cdpt) == 0 and i != len(FONT_SELECTION) - 1:
-            continue
-        if direction == 0:
-            face.set_pixel_sizes(0, font_size)
-        elif direction == 1:
-            face.set_pixel_sizes(font_size, 0)
-        face.load_char(cdpt, freetype.FT_LOAD_DEFAULT | freetype.FT_LOAD_NO_BITMAP)
-        slot_border = face.glyph
-        return slot_border.get_glyph()
+    face = FONT_SELECTION[select_font(cdpt)]
+    _set_pixel_sizes(face, font_size, direction)
+    face.load_char(cdpt, freetype.FT_LOAD_DEFAULT | freetype.FT_LOAD_NO_BITMAP)
+    slot_border = face.glyph
+    return slot_border.get_glyph()
+
+def get_char_border_bitmap(cdpt: str, font_size: int, direction: int, stroke_radius: int) -> Optional[np.ndarray]:
+    """
+    Returns the bitmap of the outline of `cdpt` stroked with `stroke_radius` (in 1/64 pixels),
+    or None if it has no valid bitmap.
+    """
+    i = select_font(cdpt)
+    return _get_char_border_bitmap(FONT_SELECTION_PATHS[i], cdpt, font_size, direction, stroke_radius)
+
+@functools.lru_cache(maxsize = 4096, typed = True)
+def _get_char_border_bitmap(font_path: str, cdpt: str, font_size: int, direction: int, stroke_radius: int) -> Optional[np.ndarray]:
+    key = _atlas_key(1, cdpt, font_size, direction, stroke_radius)
+    if key is not None:
+        entry = GLYPH_ATLAS.get(font_path, key)
+        if entry is not None:
+            return entry[1]
+    face = get_cached_font(font_path)
+    _set_pixel_sizes(face, font_size, direction)
+    face.load_char(cdpt, freetype.FT_LOAD_DEFAULT | freetype.FT_LOAD_NO_BITMAP)
+    glyph_border = face.glyph.get_glyph()
+    stroker = freetype.Stroker()
+    stroker.set(stroke_radius, freetype.FT_STROKER_LINEJOIN_ROUND, freetype.FT_STROKER_LINECAP_ROUND, 0)
+    glyph_border.stroke(stroker, destroy=True)
+    bitmap_b = glyph_border.to_bitmap(freetype.FT_RENDER_MODE_NORMAL, freetype.Vector(0, 0), True).bitmap
+    array = None
+    if bitmap_b.rows * bitmap_b.width > 0 and len(bitmap_b.buffer) == bitmap_b.rows * bitmap_b.width:
+        array = np.array(bitmap_b.buffer, dtype=np.uint8).reshape((bitmap_b.rows, bitmap_b.width))
+    if key is not None:
+        GLYPH_ATLAS.put(font_path, key, [], array, bitmap_b.rows, bitmap_b.width)
+    return array
 
 # def get_char_kerning(cdpt, prev, font_size: int, direction: int):
 #     global FONT_SELECTION
@@ -355,9 +565,7 @@ def put_char_vertical(font_size: int, cdpt: str, pen_l: Tuple[int, int], canvas_
     # Here char_offset_y should be the final vertical advance  
     char_offset_y = slot.metrics.vertAdvance >> 6  
 
-    # 将位图缓冲区转换为NumPy数组  
-    # Convert bitmap buffer to NumPy array  
-    bitmap_char = np.array(bitmap.buffer, dtype=np.uint8).reshape((char_bitmap_rows, char_bitmap_width))  
+    bitmap_char = bitmap.array  
 
     # --- 计算原始字符在画布上的放置位置 (左上角) ---  
     # --- Calculate the placement position of the original character on canvas (top-left corner) ---  
@@ -393,33 +601,14 @@ def put_char_vertical(font_size: int, cdpt: str, pen_l: Tuple[int, int], canvas_
             
     # --- 处理描边 / Process border ---  
     if border_size > 0:  
-        # 获取字符描边  
-        # Get character border  
-        glyph_border = get_char_border(cdpt, font_size, 1)  
-        stroker = freetype.Stroker()  
-        
-        # 设置描边半径和样式  
-        # Set stroke radius and style  
-        stroke_radius = 64 * max(int(0.07 * font_size), 1)  # 基于字体大小的比例值 / Proportional value based on font size  
-        stroker.set(stroke_radius, freetype.FT_STROKER_LINEJOIN_ROUND, freetype.FT_STROKER_LINECAP_ROUND, 0)  
-        
-        # 应用描边效果  
-        # Apply stroke effect  
-        glyph_border.stroke(stroker, destroy=True)  
-        
-        # 渲染描边字形到位图  
-        # Render stroked glyph to bitmap  
-        blyph = glyph_border.to_bitmap(freetype.FT_RENDER_MODE_NORMAL, freetype.Vector(0, 0), True)  
-        bitmap_b = blyph.bitmap  # 这是描边后的 bitmap 对象 / This is the bitmap object after stroking  
-
-        # --- 获取描边位图信息 / Get border bitmap information ---  
-        border_bitmap_rows = bitmap_b.rows  
-        border_bitmap_width = bitmap_b.width  
+        # 获取字符描边位图（描边半径基于字体大小）  
+        # Get the stroked character bitmap (stroke radius proportional to the font size)  
+        stroke_radius = 64 * max(int(0.07 * font_size), 1)  
+        bitmap_border = get_char_border_bitmap(cdpt, font_size, 1, stroke_radius)  
 
-        if border_bitmap_rows * border_bitmap_width > 0 and len(bitmap_b.buffer) == border_bitmap_rows * border_bitmap_width:  
-            # 将描边位图缓冲区转换为NumPy数组  
-            # Convert border bitmap buffer to NumPy array  
-            bitmap_border = np.array(bitmap_b.buffer, dtype=np.uint8).reshape((border_bitmap_rows, border_bitmap_width))  
+        if bitmap_border is not None:  
+            # --- 获取描边位图信息 / Get border bitmap information ---  
+            border_bitmap_rows, border_bitmap_width = bitmap_border.shape  
 
             # --- 计算描边位图放置位置，使其中心与原始字符位图中心对齐 ---  
             # --- Calculate border bitmap placement position to align its center with the original character bitmap center ---  
@@ -886,9 +1075,7 @@ def put_char_horizontal(font_size: int, cdpt: str, pen_l: Tuple[int, int], canva
         return char_offset_x  # Return advance for empty/invalid bitmap 对于无效或空位图直接返回步进
 
     # --- For valid bitmap, proceed with rendering ---
-    # 将位图缓冲区转换为 numpy 数组
-    # Convert bitmap buffer to numpy array
-    bitmap_char = np.array(bitmap.buffer, dtype=np.uint8).reshape((bitmap.rows, bitmap.width))
+    bitmap_char = bitmap.array
 
     # --- Calculate character placement ---
     # pen[0] is horizontal origin (cursor x)
@@ -933,38 +1120,15 @@ def put_char_horizontal(font_size: int, cdpt: str, pen_l: Tuple[int, int], canva
     # --- Handle stroke rendering (if border_size > 0) ---
     # 处理描边渲染 (如果 border_size > 0)
     if border_size > 0:
-        # Get glyph outline for stroke 获取用于描边的字形轮廓
-        glyph_border = get_char_border(cdpt, font_size, 0)  # Same horizontal orientation 同样水平方向
-        
-        # Configure stroker 配置描边器
-        stroker = freetype.Stroker()
+        # Get the stroked glyph bitmap, cached per font, character, size, direction and radius
+        # 获取描边后的字形位图（按字体、字符、大小、方向和半径缓存）
         stroke_radius = 64 * max(int(0.07 * font_size), 1)  # In 1/64 pixel units 单位: 1/64 像素
-        stroker.set(stroke_radius, 
-                   freetype.FT_STROKER_LINEJOIN_ROUND,  # Round joins 圆角连接
-                   freetype.FT_STROKER_LINECAP_ROUND,   # Round line caps 圆头线帽
-                   0)
-        
-        # Apply stroke 应用描边
-        glyph_border.stroke(stroker, destroy=True)
-        
-        # Render stroked glyph to bitmap 将描边后的字形渲染到位图
-        blyph = glyph_border.to_bitmap(freetype.FT_RENDER_MODE_NORMAL, 
-                                      freetype.Vector(0, 0), True)
-        bitmap_b = blyph.bitmap  # Stroked bitmap 描边后的位图
-
-        # --- Process stroke bitmap ---
-        border_bitmap_rows = bitmap_b.rows
-        border_bitmap_width = bitmap_b.width
+        bitmap_border = get_char_border_bitmap(cdpt, font_size, 0, stroke_radius)
 
         # Only proceed if stroke bitmap is valid
         # 仅在描边位图有效时继续
-        if (border_bitmap_rows * border_bitmap_width > 0 and 
-            len(bitmap_b.buffer) == border_bitmap_rows * border_bitmap_width):
-            
-            # Convert stroke bitmap to numpy array
-            # 将描边位图缓冲区转为 numpy 数组
-            bitmap_border = np.array(bitmap_b.buffer, dtype=np.uint8
-                                   ).reshape((border_bitmap_rows, border_bitmap_width))
+        if bitmap_border is not None:
+            border_bitmap_rows, border_bitmap_width = bitmap_border.shape
 
             # --- Calculate stroke placement (center alignment logic) ---
             # 原始字符位图的尺寸
@@ -5,7 +5,7 @@ from collections import Counter
 import networkx as nx
 from shapely.geometry import Polygon
 
-from ..utils import TextBlock, Quadrilateral, quadrilateral_can_merge_region
+from ..utils import TextBlock, Quadrilateral, TextlineArray, quadrilateral_can_merge_region, neighbouring_quadrilaterals, connected_components
 
 def split_text_region(
         bboxes: List[Quadrilateral],
@@ -71,14 +71,11 @@ def split_text_region(
     else:
         # (split_u, split_v, _) = edges[0]
         # print(f'split between "{bboxes[split_u].pts}", "{bboxes[split_v].pts}"')
-        G = nx.Graph()
-        for idx in connected_region_indices:
-            G.add_node(idx)
         # Split out the most deviating bbox
-        for edge in edges[1:]:
-            G.add_edge(edge[0], edge[1])
+        local_indices = {idx: i for i, idx in enumerate(connected_region_indices)}
         ans = []
-        for node_set in nx.algorithms.components.connected_components(G):
+        for local_set in connected_components(len(connected_region_indices), [(local_indices[u], local_indices[v]) for u, v, _ in edges[1:]]):
+            node_set = {connected_region_indices[i] for i in local_set}
             ans.extend(split_text_region(bboxes, node_set, width, height))
         return ans
 
@@ -124,20 +121,18 @@ def merge_bboxes_text_region(bboxes: List[Quadrilateral], width, height):
     #             v += 1
     #     u += 1
 
-    # step 1: divide into multiple text region candidates
-    G = nx.Graph()
-    for i, box in enumerate(bboxes):
-        G.add_node(i, box=box)
-
-    for ((u, ubox), (v, vbox)) in itertools.combinations(enumerate(bboxes), 2):
+    # step 1: divide into multiple text region candidates, only textlines close to each other can be merged
+    lines = TextlineArray(bboxes)
+    edges = []
+    for u, v in neighbouring_quadrilaterals(lines):
         # if quadrilateral_can_merge_region_coarse(ubox, vbox):
-        if quadrilateral_can_merge_region(ubox, vbox, aspect_ratio_tol=1.3, font_size_ratio_tol=2,
+        if quadrilateral_can_merge_region(bboxes[u], bboxes[v], aspect_ratio_tol=1.3, font_size_ratio_tol=2,
                                           char_gap_tolerance=1, char_gap_tolerance2=3):
-            G.add_edge(u, v)
+            edges.append((u, v))
 
     # step 2: postprocess - further split each region
     region_indices: List[Set[int]] = []
-    for node_set in nx.algorithms.components.connected_components(G):
+    for node_set in connected_components(len(bboxes), edges):
          region_indices.extend(split_text_region(bboxes, node_set, width, height))
 
     # step 3: return regions
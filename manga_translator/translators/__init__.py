@@ -1,8 +1,9 @@
-from typing import Optional
+from typing import Optional, List
 
 import py3langid as langid
 
 from .common import *
+from .cache import TranslationCache
 from .baidu import BaiduTranslator
 from .deepseek import DeepseekTranslator
 # from .google import GoogleTranslator
@@ -23,8 +24,9 @@ from .qwen2 import Qwen2Translator, Qwen2BigTranslator
 from .groq import GroqTranslator
 from .gemini import GeminiTranslator
 from .custom_openai import CustomOpenAiTranslator
+from .common_gpt import CommonGPTTranslator
 from ..config import Translator, TranslatorConfig, TranslatorChain
-from ..utils import Context
+from ..utils import Context, ModelWrapper, model_residency
 
 OFFLINE_TRANSLATORS = {
     Translator.offline: SelectiveOfflineTranslator,
@@ -95,28 +97,45 @@ async def dispatch(chain: TranslatorChain, queries: List[str], translator_config
                 #translator = get_translator(key)
             #if translator is None:
             translator = get_translator(chain.translators[flag])
-            if isinstance(translator, OfflineTranslator):
-                await translator.load('auto', chain.langs[flag], device)
-                pass
-            if translator_config:
-                translator.parse_args(translator_config)
-            queries = await translator.translate('auto', chain.langs[flag], queries, use_mtpe)
-            await translator.unload(device)
+            async with model_residency.pinned(translator):
+                if isinstance(translator, OfflineTranslator):
+                    await translator.load('auto', chain.langs[flag], device)
+                if translator_config:
+                    translator.parse_args(translator_config)
+                queries = await translator.translate('auto', chain.langs[flag], queries, use_mtpe)
+                await translator.unload(device)
             flag+=1
         return queries
     if args is not None:
         args['translations'] = {}
     for key, tgt_lang in chain.chain:
         translator = get_translator(key)
-        if isinstance(translator, OfflineTranslator):
-            await translator.load('auto', tgt_lang, device)
-        if translator_config:
-            translator.parse_args(translator_config)
-        queries = await translator.translate('auto', tgt_lang, queries, use_mtpe)
+        async with model_residency.pinned(translator):
+            if isinstance(translator, OfflineTranslator):
+                await translator.load('auto', tgt_lang, device)
+            if translator_config:
+                translator.parse_args(translator_config)
+            queries = await translator.translate('auto', tgt_lang, queries, use_mtpe)
         if args is not None:
             args['translations'][tgt_lang] = queries
     return queries
 
+def within_request_limit(chain: TranslatorChain, queries: List[str]) -> bool:
+    """
+    Checks whether `queries` can be sent to every translator of `chain` in a single request.
+    GPT translators are checked with `withinTokenLimit`, other translators that define
+    `_MAX_TOKENS` are checked against half of it, assuming one token per character.
+    """
+    text = '\n'.join(queries)
+    for key, _ in chain.chain:
+        translator = get_translator(key)
+        if isinstance(translator, CommonGPTTranslator):
+            if not translator.withinTokenLimit(text):
+                return False
+        elif hasattr(translator, '_MAX_TOKENS') and len(text) > translator._MAX_TOKENS // 2:
+            return False
+    return True
+
 LANGDETECT_MAP = {
     'zh-cn': 'CHS',
     'zh-tw': 'CHT',
@@ -145,4 +164,7 @@ LANGDETECT_MAP = {
 }
 
 async def unload(key: Translator):
-    translator_cache.pop(key, None)
+    translator = translator_cache.pop(key, None)
+    if isinstance(translator, ModelWrapper):
+        # `OfflineTranslator.unload` takes a device it does not use
+        await ModelWrapper.unload(translator)
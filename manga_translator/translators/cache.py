@@ -0,0 +1,96 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import List, Optional
+
+
+class TranslationCache:
+    """
+    Persistent translation cache backed by a SQLite database.
+
+    Entries are addressed by a hash of the translator fingerprint (translator class and the
+    settings its output depends on), the language pair and the normalized query text. When more
+    than `max_entries` translations are stored the least recently used ones are evicted.
+    """
+
+    # SQLite limits the number of parameters of a single statement
+    _QUERY_CHUNK_SIZE = 500
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS translations ('
+                               'key TEXT PRIMARY KEY, translation TEXT NOT NULL, last_used REAL NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS translations_last_used ON translations (last_used)')
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return ' '.join(unicodedata.normalize('NFKC', query).split())
+
+    def _key(self, fingerprint: str, from_lang: str, to_lang: str, query: str) -> str:
+        data = '\0'.join((fingerprint, from_lang, to_lang, self.normalize(query)))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, fingerprint: str, from_lang: str, to_lang: str, queries: List[str]) -> List[Optional[str]]:
+        """
+        Returns the cached translation of every query, or None for the queries that are not cached.
+        """
+        keys = [self._key(fingerprint, from_lang, to_lang, q) for q in queries]
+        found = {}
+        with self._lock, self._conn:
+            for i in range(0, len(keys), self._QUERY_CHUNK_SIZE):
+                chunk = keys[i:i + self._QUERY_CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                found.update(self._conn.execute(
+                    f'SELECT key, translation FROM translations WHERE key IN ({placeholders})', chunk))
+            if found:
+                now = time.time()
+                self._conn.executemany('UPDATE translations SET last_used = ? WHERE key = ?',
+                                       [(now, key) for key in found])
+        translations = [found.get(key) for key in keys]
+        hits = len(translations) - translations.count(None)
+        self.hits += hits
+        self.misses += len(translations) - hits
+        return translations
+
+    def put(self, fingerprint: str, from_lang: str, to_lang: str, queries: List[str], translations: List[str]):
+        """
+        Stores the translations of `queries`. Empty translations are not cached.
+        """
+        now = time.time()
+        rows = [(self._key(fingerprint, from_lang, to_lang, q), t, now) for q, t in zip(queries, translations) if t]
+        if not rows:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO translations (key, translation, last_used) VALUES (?, ?, ?)', rows)
+            self._conn.execute('DELETE FROM translations WHERE key IN '
+                               '(SELECT key FROM translations ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                               (self.max_entries,))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM translations')
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
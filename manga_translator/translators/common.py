@@ -1,9 +1,12 @@
 import re
 import time
+import json
+import hashlib
 import asyncio
-from typing import List, Tuple
+from typing import List, Tuple, Optional
 from abc import abstractmethod
 
+from .cache import TranslationCache
 from ..utils import InfererModule, ModelWrapper, repeating_sequence, is_valuable_text
 
 try:
@@ -115,6 +118,9 @@ class CommonTranslator(InfererModule):
     # Will sleep for the rest of the minute if the request count is over this number.
     _MAX_REQUESTS_PER_MINUTE = -1
 
+    # Shared persistent cache consulted before sending queries to the translator. Disabled if None.
+    _CACHE: Optional[TranslationCache] = None
+
     def __init__(self):
         super().__init__()
         self.mtpe_adapter = MTPEAdapter()
@@ -169,6 +175,38 @@ class CommonTranslator(InfererModule):
 
         queries = [queries[i] for i in query_indices]
 
+        if self._CACHE is not None:
+            fingerprint = self._cache_fingerprint()
+            translations = self._CACHE.get(fingerprint, from_lang, to_lang, queries)
+            missing_indices = [i for i, trans in enumerate(translations) if trans is None]
+            if len(missing_indices) < len(queries):
+                self.logger.info(f'Translation cache: {len(queries) - len(missing_indices)} of {len(queries)} queries cached'
+                                 f' (hit rate {self._CACHE.hit_rate:.0%})')
+            if missing_indices:
+                missing_queries = [queries[i] for i in missing_indices]
+                missing_translations = await self._translate_queries(from_lang, to_lang, missing_queries)
+                self._CACHE.put(fingerprint, from_lang, to_lang, missing_queries, missing_translations)
+                for i, trans in zip(missing_indices, missing_translations):
+                    translations[i] = trans
+        else:
+            translations = await self._translate_queries(from_lang, to_lang, queries)
+
+        if use_mtpe:
+            translations = await self.mtpe_adapter.dispatch(queries, translations)
+
+        # Merge with the queries without text
+        for i, trans in enumerate(translations):
+            final_translations[query_indices[i]] = trans
+            self.logger.info(f'{i}: {queries[i]} => {trans}')
+
+        return final_translations
+
+    async def _translate_queries(self, from_lang: str, to_lang: str, queries: List[str]) -> List[str]:
+        """
+        Translates queries that all contain text, bypassing the translation cache.
+        """
+        # Invalid translations are repeated with modified queries, keep the caller's list intact
+        queries = list(queries)
         translations = [''] * len(queries)
         untranslated_indices = list(range(len(queries)))
         for i in range(1 + self._INVALID_REPEAT_COUNT): # Repeat until all translations are considered valid
@@ -212,16 +250,31 @@ class CommonTranslator(InfererModule):
         if to_lang == 'ARA':
             import arabic_reshaper
             translations = [arabic_reshaper.reshape(t) for t in translations]
+        return translations
 
-        if use_mtpe:
-            translations = await self.mtpe_adapter.dispatch(queries, translations)
-
-        # Merge with the queries without text
-        for i, trans in enumerate(translations):
-            final_translations[query_indices[i]] = trans
-            self.logger.info(f'{i}: {queries[i]} => {trans}')
+    def _cache_fingerprint(self) -> str:
+        """
+        Identifies the translator and the settings its output depends on (see `_cache_settings`)
+        in the translation cache.
+        """
+        settings = json.dumps(self._cache_settings(), sort_keys=True, ensure_ascii=False, default=str)
+        return f'{self.__class__.__name__}:{hashlib.sha256(settings.encode("utf-8")).hexdigest()[:16]}'
 
-        return final_translations
+    def _cache_settings(self) -> dict:
+        """
+        Returns the settings the output of the translator depends on: its model and glossary.
+        Should be extended by translators whose output can be changed through other settings.
+        """
+        settings = {}
+        if isinstance(getattr(self, 'model', None), str):
+            settings['model'] = self.model
+        elif getattr(self, '_TRANSLATOR_MODEL', None):
+            settings['model'] = self._TRANSLATOR_MODEL
+        elif getattr(self, '_MODEL_MAPPING', None):
+            settings['model'] = sorted(str(m.get('hash')) for m in self._MODEL_MAPPING.values())
+        if getattr(self, 'glossary_entries', None):
+            settings['glossary'] = self.glossary_entries
+        return settings
 
     @abstractmethod
     async def _translate(self, from_lang: str, to_lang: str, queries: List[str]) -> List[str]:
@@ -174,6 +174,15 @@ class ConfigGPT:
         self.langSamples = None # Cache chat/json_samples[to_lang]
         self._json_sample = None
 
+    def _cache_settings(self) -> dict:
+        # Prompts, samples and sampling parameters all influence the translation, the config key
+        # also names the model
+        settings = super()._cache_settings()
+        settings['config_key'] = self._CONFIG_KEY
+        if self.config is not None:
+            settings['config'] = OmegaConf.to_container(self.config) if OmegaConf.is_config(self.config) else self.config
+        return settings
+
     def _config_get(self, key: str, default=None):
         if not self.config:
             return default
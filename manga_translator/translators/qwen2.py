@@ -11,7 +11,8 @@ from .config_gpt import ConfigGPT  # Import the `gpt_config` parsing parent clas
 # https://github.com/zyddnys/manga-image-translator/issues/680#issue-2428018275
 # manga_translator/translators/chatgpt.py
 
-class Qwen2Translator(OfflineTranslator, ConfigGPT):
+# ConfigGPT comes first so that its settings make it into the translation cache fingerprint
+class Qwen2Translator(ConfigGPT, OfflineTranslator):
     _LANGUAGE_CODE_MAP = {
         'CHS': 'Simplified Chinese',
         'CHT': 'Traditional Chinese',
@@ -6,6 +6,7 @@ from .waifu2x import Waifu2xUpscaler
 from .esrgan import ESRGANUpscaler
 from .esrgan_pytorch import ESRGANUpscalerPytorch
 from ..config import Upscaler
+from ..utils import model_residency
 
 UPSCALERS = {
     Upscaler.waifu2x: Waifu2xUpscaler,
@@ -31,9 +32,12 @@ async def dispatch(upscaler_key: Upscaler, image_batch: List[Image.Image], upsca
     if upscale_ratio == 1:
         return image_batch
     upscaler = get_upscaler(upscaler_key)
-    if isinstance(upscaler, OfflineUpscaler):
-        await upscaler.load(device)
-    return await upscaler.upscale(image_batch, upscale_ratio)
+    async with model_residency.pinned(upscaler):
+        if isinstance(upscaler, OfflineUpscaler):
+            await upscaler.load(device)
+        return await upscaler.upscale(image_batch, upscale_ratio)
 
 async def unload(upscaler_key: Upscaler):
-    upscaler_cache.pop(upscaler_key, None)
+    upscaler = upscaler_cache.pop(upscaler_key, None)
+    if isinstance(upscaler, OfflineUpscaler):
+        await upscaler.unload()
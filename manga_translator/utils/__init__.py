@@ -5,3 +5,4 @@ from .textblock import *
 from .inference import *
 from .threading import *
 from .bubble import is_ignore
+from .artifacts import ArtifactStore
@@ -0,0 +1,136 @@
+import functools
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from .generic import Quadrilateral
+from .log import get_logger
+from .textblock import TextBlock
+
+logger = get_logger('ArtifactStore')
+
+# Classes whose instances can be stored as artifacts. They are restored by setting their attributes
+# directly, so that no constructor logic (e.g. point sorting) runs twice.
+_ARTIFACT_CLASSES = {cls.__name__: cls for cls in (Quadrilateral, TextBlock)}
+
+
+class _Encoder:
+    """
+    Turns artifacts into a JSON-serializable tree. Numpy arrays are collected separately and
+    replaced by references, so that they can be stored in the npz file next to the JSON.
+    """
+
+    def __init__(self):
+        self.arrays: Dict[str, np.ndarray] = {}
+
+    def encode(self, value: Any) -> Any:
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, np.ndarray):
+            name = f'a{len(self.arrays)}'
+            self.arrays[name] = value
+            return {'__ndarray__': name}
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, list):
+            return [self.encode(v) for v in value]
+        if isinstance(value, tuple):
+            return {'__tuple__': [self.encode(v) for v in value]}
+        if isinstance(value, dict):
+            if not all(isinstance(k, str) for k in value):
+                raise TypeError('Artifact dicts must have string keys')
+            return {'__dict__': {k: self.encode(v) for k, v in value.items()}}
+        if _ARTIFACT_CLASSES.get(type(value).__name__) is type(value):
+            cls = type(value)
+            # Cached properties are recomputed on demand and may hold unsupported types (e.g. shapely polygons)
+            state = {k: self.encode(v) for k, v in vars(value).items()
+                     if not isinstance(getattr(cls, k, None), functools.cached_property)}
+            return {'__object__': cls.__name__, 'state': state}
+        raise TypeError(f'Unsupported artifact type: {type(value).__name__}')
+
+
+def _decode(value: Any, arrays) -> Any:
+    if isinstance(value, list):
+        return [_decode(v, arrays) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if '__ndarray__' in value:
+        return arrays[value['__ndarray__']]
+    if '__tuple__' in value:
+        return tuple(_decode(v, arrays) for v in value['__tuple__'])
+    if '__dict__' in value:
+        return {k: _decode(v, arrays) for k, v in value['__dict__'].items()}
+    if '__object__' in value:
+        cls = _ARTIFACT_CLASSES[value['__object__']]
+        obj = cls.__new__(cls)
+        obj.__dict__.update({k: _decode(v, arrays) for k, v in value['state'].items()})
+        return obj
+    raise ValueError(f'Malformed artifact value: {value}')
+
+
+class ArtifactStore:
+    """
+    Stores the intermediate results of pipeline stages on disk, addressed by the key of the stage
+    that produced them. A stage key is derived from the key of the previous stage and the settings
+    of the stage itself (see `make_key`), so changing the settings of a stage invalidates the
+    results of that stage and of all the stages after it.
+
+    Each entry is an npz file holding the numpy arrays and a JSON description of the remaining
+    values. Nothing is unpickled on load, so a shared or downloaded cache directory can't run code.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        h = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                h.update(str(part.shape).encode('utf-8'))
+                h.update(np.ascontiguousarray(part).data)
+            else:
+                h.update(str(part).encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _file_path(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key + '.npz')
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._file_path(key))
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with np.load(self._file_path(key), allow_pickle=False) as f:
+                arrays = {name: f[name] for name in f.files}
+            return _decode(json.loads(str(arrays.pop('__json__'))), arrays)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warn(f'Ignoring unreadable artifact {key}: {e}')
+            return None
+
+    def save(self, key: str, artifacts: Dict[str, Any]):
+        encoder = _Encoder()
+        try:
+            tree = encoder.encode(artifacts)
+        except TypeError as e:
+            logger.warn(f'Not storing artifact {key}: {e}')
+            return
+        path = self._file_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so that readers never see partially written artifacts
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, __json__=np.array(json.dumps(tree)), **encoder.arrays)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
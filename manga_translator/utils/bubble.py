@@ -83,3 +83,26 @@ def is_ignore(region_img, ignore_bubble = 0):
         return True
     return False
 
+
+def flat_background_color(image, ring_mask, tolerance = 24, min_ratio = 0.97):
+    """
+    Same principle as `is_ignore`: the pixels around a text block tell whether it sits on a plain bubble.
+    Instead of the ratio of black pixels on the border of the text box, the ratio of pixels of the ring
+    `ring_mask` around the text that are within `tolerance` of their median colour is calculated, so
+    that plain white, black and gray backgrounds are recognized alike.
+
+    params：
+    image -- np.array, RGB image
+    ring_mask -- np.array, boolean mask of the pixels around the text block
+    return：
+    The median colour as np.uint8 array if the ratio is at least `min_ratio`, else None (textured background)
+    """
+    pixels = image[ring_mask]
+    if len(pixels) == 0:
+        return None
+    color = np.median(pixels, axis=0)
+    distance = np.abs(pixels.astype(np.int16) - color.astype(np.int16)).max(axis=-1)
+    ratio = np.count_nonzero(distance <= tolerance) / len(pixels)
+    if ratio < min_ratio:
+        return None
+    return color.astype(np.uint8)
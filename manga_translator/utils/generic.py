@@ -1,8 +1,9 @@
 import os
-from typing import List, Callable, Tuple, Optional
+from typing import List, Callable, Tuple, Optional, Union
 import numpy as np
 import cv2
 import functools
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import tqdm
 import requests
@@ -479,43 +480,48 @@ class Quadrilateral(object):
         min_coord = np.min(kq, axis = 0)
         return BBox(min_coord[0], min_coord[1], max_coord[0] - min_coord[0], max_coord[1] - min_coord[1], self.text, self.prob, self.fg_r, self.fg_g, self.fg_b, self.bg_r, self.bg_g, self.bg_b)
 
-    def get_transformed_region(self, img, direction, textheight) -> np.ndarray:
+    def get_transformation(self, img_shape, direction, textheight) -> Tuple[Tuple[int, int, int, int], np.ndarray, Tuple[int, int]]:
+        """
+        Returns the crop (x1, y1, x2, y2) of the image that holds the textline, the perspective transform
+        from that crop to the straightened textline and the (width, height) of the result. Vertical
+        textlines are rotated by 90° counterclockwise as part of the transform.
+        """
         [l1a, l1b, l2a, l2b] = [a.astype(np.float32) for a in self.structure]
         v_vec = l1b - l1a
         h_vec = l2b - l2a
         ratio = np.linalg.norm(v_vec) / np.linalg.norm(h_vec)
 
         src_pts = self.pts.astype(np.int64).copy()
-        im_h, im_w = img.shape[:2]
+        im_h, im_w = img_shape[:2]
 
         x1, y1, x2, y2 = src_pts[:, 0].min(), src_pts[:, 1].min(), src_pts[:, 0].max(), src_pts[:, 1].max()
-        x1 = np.clip(x1, 0, im_w)
-        y1 = np.clip(y1, 0, im_h)
-        x2 = np.clip(x2, 0, im_w)
-        y2 = np.clip(y2, 0, im_h)
+        x1 = int(np.clip(x1, 0, im_w))
+        y1 = int(np.clip(y1, 0, im_h))
+        x2 = int(np.clip(x2, 0, im_w))
+        y2 = int(np.clip(y2, 0, im_h))
         # cv2.warpPerspective could overflow if image size is too large, better crop it here
-        img_croped = img[y1: y2, x1: x2]
-
-        
         src_pts[:, 0] -= x1
         src_pts[:, 1] -= y1
 
-        self.assigned_direction = direction
         if direction == 'h':
             h = max(int(textheight), 2)
             w = max(int(round(textheight / ratio)), 2)
-            dst_pts = np.array([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]]).astype(np.float32)
-            M, _ = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
-            region = cv2.warpPerspective(img_croped, M, (w, h))
-            return region
-        elif direction == 'v':
+        else:
             w = max(int(textheight), 2)
             h = max(int(round(textheight * ratio)), 2)
-            dst_pts = np.array([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]]).astype(np.float32)
-            M, _ = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
-            region = cv2.warpPerspective(img_croped, M, (w, h))
-            region = cv2.rotate(region, cv2.ROTATE_90_COUNTERCLOCKWISE)
-            return region
+        dst_pts = np.array([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]]).astype(np.float32)
+        # 4 point correspondences determine the transform exactly, no need for RANSAC
+        M = cv2.getPerspectiveTransform(src_pts.astype(np.float32), dst_pts)
+        if direction == 'h':
+            return (x1, y1, x2, y2), M, (w, h)
+        # rotate counterclockwise: (x, y) -> (y, w - 1 - x)
+        rotation = np.array([[0, 1, 0], [-1, 0, w - 1], [0, 0, 1]], dtype=np.float64)
+        return (x1, y1, x2, y2), rotation @ M, (h, w)
+
+    def get_transformed_region(self, img, direction, textheight) -> np.ndarray:
+        (x1, y1, x2, y2), M, size = self.get_transformation(img.shape, direction, textheight)
+        self.assigned_direction = direction
+        return cv2.warpPerspective(img[y1: y2, x1: x2], M, size)
 
     @functools.cached_property
     def is_axis_aligned(self) -> bool:
@@ -635,6 +641,108 @@ class Quadrilateral(object):
     def copy(self, new_pts: np.ndarray):
         return Quadrilateral(new_pts, self.text, self.prob, *self.fg_colors, *self.bg_colors)
 
+def warp_textlines(img: np.ndarray, transformations: List[Tuple[Tuple[int, int, int, int], np.ndarray, Tuple[int, int]]],
+                   out: np.ndarray, threads: int = 1):
+    """
+    Warps the textlines described by `transformations` (see `Quadrilateral.get_transformation`) directly
+    into the rows of the preallocated batch `out` of shape (N, H, W, C), left aligned. With `threads` > 1
+    the textlines are warped on a thread pool, OpenCV releases the GIL while warping.
+    """
+    def warp(i):
+        (x1, y1, x2, y2), M, (w, h) = transformations[i]
+        cv2.warpPerspective(img[y1: y2, x1: x2], M, (w, h), dst=out[i, :h, :w])
+
+    if threads > 1 and len(transformations) > 1:
+        with ThreadPoolExecutor(min(threads, len(transformations))) as executor:
+            list(executor.map(warp, range(len(transformations))))
+    else:
+        for i in range(len(transformations)):
+            warp(i)
+
+class TextlineArray(object):
+    """
+    Stores the points of N textlines in one contiguous (N, 4, 2) array and computes the geometry of
+    all of them in one vectorized pass. The quadrilaterals become views into the array: their `pts`
+    are rows of `pts` and their cached geometry properties are filled in from the results here, so
+    the per-textline code that uses them does not recompute them one by one.
+    """
+    def __init__(self, quads: List[Quadrilateral]):
+        self.quads = list(quads)
+        if not self.quads:
+            self.pts = np.zeros((0, 4, 2), dtype=np.int64)
+        else:
+            self.pts = np.array([q.pts for q in self.quads])
+        pts = self.pts
+
+        self.structure = np.stack([
+            ((pts[:, 0] + pts[:, 1]) / 2).astype(int),
+            ((pts[:, 2] + pts[:, 3]) / 2).astype(int),
+            ((pts[:, 1] + pts[:, 2]) / 2).astype(int),
+            ((pts[:, 3] + pts[:, 0]) / 2).astype(int),
+        ], axis=1)
+        structure = self.structure.astype(np.float32)
+        v1 = structure[:, 1] - structure[:, 0]
+        v2 = structure[:, 3] - structure[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            norm1 = np.sqrt((v1 * v1).sum(axis=1))
+            norm2 = np.sqrt((v2 * v2).sum(axis=1))
+            self.aspect_ratios = norm2 / norm1
+            self.font_sizes = np.minimum(norm2, norm1)
+            unit1 = v1 / norm1[:, None]
+            unit2 = v2 / norm2[:, None]
+            self.valid = np.abs(np.arccos((unit1 * unit2).sum(axis=1)) * 180 / np.pi - 90) < 10
+            self.cosangles = unit1[:, 0].astype(np.float64)
+            self.angles = np.fmod(np.arccos(self.cosangles) + np.pi, np.pi)
+        self.axis_aligned = (np.abs(unit1[:, 1]) < 1e-2) | (np.abs(unit1[:, 0]) < 1e-2)
+        self.approximate_axis_aligned = (np.abs(unit1) < 0.05).any(axis=1) | (np.abs(unit2) < 0.05).any(axis=1)
+        self.centroids = pts.mean(axis=1)
+        self.mins = pts.min(axis=1)
+        self.maxs = pts.max(axis=1)
+        self.areas = self._convex_hull_areas(pts.astype(np.float64))
+
+        for i, q in enumerate(self.quads):
+            if q.pts.dtype == pts.dtype:
+                q.pts = pts[i]
+            q.__dict__.update(
+                structure=list(self.structure[i]),
+                valid=self.valid[i],
+                aspect_ratio=self.aspect_ratios[i],
+                font_size=self.font_sizes[i],
+                is_axis_aligned=bool(self.axis_aligned[i]),
+                is_approximate_axis_aligned=bool(self.approximate_axis_aligned[i]),
+                cosangle=self.cosangles[i],
+                angle=self.angles[i],
+                centroid=self.centroids[i],
+                area=self.areas[i],
+            )
+
+    @staticmethod
+    def _convex_hull_areas(pts: np.ndarray) -> np.ndarray:
+        # The convex hull of 4 points is either one of the 3 quadrilaterals through all of them
+        # (any self-intersecting one is smaller) or, if a point lies inside the others, a triangle
+        def cross(a, b, c):
+            return (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0])
+        p0, p1, p2, p3 = pts[:, 0], pts[:, 1], pts[:, 2], pts[:, 3]
+        candidates = [
+            np.abs(cross(p0, p1, p2) + cross(p0, p2, p3)) / 2,
+            np.abs(cross(p0, p1, p3) + cross(p0, p3, p2)) / 2,
+            np.abs(cross(p0, p2, p1) + cross(p0, p1, p3)) / 2,
+            np.abs(cross(p0, p1, p2)) / 2,
+            np.abs(cross(p0, p1, p3)) / 2,
+            np.abs(cross(p0, p2, p3)) / 2,
+            np.abs(cross(p1, p2, p3)) / 2,
+        ]
+        return np.max(candidates, axis=0)
+
+    def __len__(self) -> int:
+        return len(self.quads)
+
+    def __getitem__(self, idx) -> Quadrilateral:
+        return self.quads[idx]
+
+    def __iter__(self):
+        return iter(self.quads)
+
 # def merge_quadrilaterals(q1: Quadrilateral, q2: Quadrilateral):
 #     min_rect = np.array(Polygon([*q1.pts, *q2.pts]).minimum_rotated_rectangle.exterior.coords[:4])
 #     if q1.centroid[0] < q2.centroid[0] or q1.centroid[1] < q1.centroid[1]:
@@ -775,6 +883,73 @@ def quadrilateral_can_merge_region_coarse(a: Quadrilateral, b: Quadrilateral, di
         return False
     return True
 
+def neighbouring_quadrilaterals(bboxes: Union[List[Quadrilateral], TextlineArray], discard_connection_gap = 2) -> List[Tuple[int, int]]:
+    """
+    Returns the index pairs (u, v), u < v, of the quadrilaterals whose bounding boxes are at most
+    `discard_connection_gap` times the smaller font size apart. Pairs that are further apart can never
+    pass `quadrilateral_can_merge_region` with the same `discard_connection_gap`, since the distance
+    of two bounding boxes never exceeds the distance of the quadrilaterals themselves.
+
+    The boxes are put into a uniform grid so that only the boxes of nearby cells are compared.
+    """
+    if len(bboxes) < 2:
+        return []
+    lines = bboxes if isinstance(bboxes, TextlineArray) else TextlineArray(bboxes)
+    mins, maxs = lines.mins.astype(np.float64), lines.maxs.astype(np.float64)
+    font_sizes = lines.font_sizes.astype(np.float64)
+    gaps = discard_connection_gap * font_sizes
+    # every box has to be found from the cells its own extended box covers
+    extended_mins, extended_maxs = mins - gaps[:, None], maxs + gaps[:, None]
+    cell_size = max(float(np.median((extended_maxs - extended_mins).max(axis=1))), 1.)
+
+    grid = {}
+    cells_min = np.floor(mins / cell_size).astype(np.int64)
+    cells_max = np.floor(maxs / cell_size).astype(np.int64)
+    for i, ((cx1, cy1), (cx2, cy2)) in enumerate(zip(cells_min, cells_max)):
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                grid.setdefault((cx, cy), []).append(i)
+
+    pairs = set()
+    query_min = np.floor(extended_mins / cell_size).astype(np.int64)
+    query_max = np.floor(extended_maxs / cell_size).astype(np.int64)
+    for u, ((cx1, cy1), (cx2, cy2)) in enumerate(zip(query_min, query_max)):
+        candidates = set()
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                candidates.update(grid.get((cx, cy), ()))
+        candidates = np.array([v for v in candidates if v > u], dtype=np.int64)
+        if len(candidates) == 0:
+            continue
+        dx = np.maximum(0, np.maximum(mins[candidates, 0] - maxs[u, 0], mins[u, 0] - maxs[candidates, 0]))
+        dy = np.maximum(0, np.maximum(mins[candidates, 1] - maxs[u, 1], mins[u, 1] - maxs[candidates, 1]))
+        close = np.hypot(dx, dy) <= discard_connection_gap * np.minimum(font_sizes[u], font_sizes[candidates])
+        pairs.update((u, int(v)) for v in candidates[close])
+    return sorted(pairs)
+
+def connected_components(num_nodes: int, edges: List[Tuple[int, int]]) -> List[set]:
+    """
+    Union-find over the nodes 0..num_nodes-1. Returns the node sets of the connected components,
+    ordered by their smallest node like `networkx.connected_components`.
+    """
+    parent = list(range(num_nodes))
+
+    def find(x: int) -> int:
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for u, v in edges:
+        ru, rv = find(u), find(v)
+        if ru != rv:
+            parent[max(ru, rv)] = min(ru, rv)
+
+    components = {}
+    for x in range(num_nodes):
+        components.setdefault(find(x), set()).add(x)
+    return list(components.values())
+
 def findNextPowerOf2(n):
     i = 0
     while n != 0:
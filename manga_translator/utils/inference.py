@@ -3,11 +3,19 @@ import stat
 import sys
 import tempfile
 import re
+import gc
+import inspect
+import asyncio
+import itertools
+import threading
 import torch
 import shutil
 import filecmp
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from functools import cached_property
+from typing import Dict, List, Tuple
 
 from .generic import (
     BASE_PATH,
@@ -95,6 +103,12 @@ class ModelWrapper(ABC):
     _MODEL_SUB_DIR = ''
     _MODEL_MAPPING = {}
     _KEY = ''
+    # 'onnx' runs the models that support it through ONNX Runtime when they are loaded on the CPU,
+    # with the given intra and inter op threads (0 lets ONNX Runtime decide)
+    _BACKEND = 'torch'
+    _ONNX_THREADS = (0, 0)
+    # How deep `memory_footprint` looks for modules in the attributes of the wrapper
+    _FOOTPRINT_DEPTH = 4
 
     def __init__(self):
         os.makedirs(self.model_dir, exist_ok=True)
@@ -116,6 +130,20 @@ class ModelWrapper(ABC):
     def _get_file_path(self, *args) -> str:
         return os.path.join(self.model_dir, *args)
 
+    def _use_onnx(self, device: str) -> bool:
+        return self._BACKEND == 'onnx' and device == 'cpu'
+
+    def _load_onnx(self, module: torch.nn.Module, example_inputs: Tuple[torch.Tensor, ...], weights_file: str,
+                   input_names: List[str], output_names: List[str], dynamic_axes: Dict[str, Dict[int, str]],
+                   graph_file: str = None) -> 'OnnxModule':
+        '''
+        Returns `module` run through ONNX Runtime. Its graph is cached as `graph_file` next to
+        `weights_file` (by default under the name of the weights with the extension .onnx).
+        '''
+        graph_file = graph_file or os.path.splitext(weights_file)[0] + '.onnx'
+        return OnnxModule(module, example_inputs, self._get_file_path(graph_file), self._get_file_path(weights_file),
+                          input_names, output_names, dynamic_axes, *self._ONNX_THREADS)
+
     def _get_used_gpu_memory(self) -> bool:
         '''
         Gets the total amount of GPU memory used by model (Can be used in the future
@@ -334,11 +362,55 @@ class ModelWrapper(ABC):
         if not self.is_loaded():
             await self._load(*args, **kwargs, device=device)
             self._loaded = True
+            await model_residency.loaded(self)
+        else:
+            model_residency.used(self)
 
     async def unload(self):
         if self.is_loaded():
             await self._unload()
             self._loaded = False
+            model_residency.unloaded(self)
+
+    def memory_footprint(self) -> Tuple[int, int]:
+        '''
+        Returns the bytes of RAM and VRAM taken up by the loaded model. Counts the parameters and
+        buffers of the torch modules and the graphs of the ONNX modules among the attributes, also
+        inside containers and objects that wrap them like pipelines do. Can be overwritten for other
+        runtimes.
+        '''
+        modules = []
+        ram = vram = 0
+        visited = set()
+        pending = [(value, 0) for value in vars(self).values()]
+        while pending:
+            value, depth = pending.pop()
+            if id(value) in visited or isinstance(value, (str, bytes, int, float, torch.Tensor, ModelWrapper)):
+                continue
+            visited.add(id(value))
+            if isinstance(value, OnnxModule):
+                ram += value.nbytes
+            elif isinstance(value, torch.nn.Module):
+                modules.append(value)
+            elif depth < self._FOOTPRINT_DEPTH:
+                if isinstance(value, (list, tuple, set)):
+                    pending.extend((v, depth + 1) for v in value)
+                elif isinstance(value, dict):
+                    pending.extend((v, depth + 1) for v in value.values())
+                elif hasattr(value, '__dict__') and not isinstance(value, type):
+                    pending.extend((v, depth + 1) for v in vars(value).values())
+        seen = set()
+        for module in modules:
+            for tensor in itertools.chain(module.parameters(), module.buffers()):
+                key = (tensor.device, tensor.data_ptr())
+                if key in seen:
+                    continue
+                seen.add(key)
+                if tensor.device.type == 'cpu':
+                    ram += tensor.numel() * tensor.element_size()
+                else:
+                    vram += tensor.numel() * tensor.element_size()
+        return ram, vram
 
     async def infer(self, *args, **kwargs):
         '''
@@ -360,3 +432,198 @@ class ModelWrapper(ABC):
     @abstractmethod
     async def _infer(self, *args, **kwargs):
         pass
+
+
+class OnnxModule:
+    """
+    Runs a torch module through ONNX Runtime on the CPU. It is called with torch tensors like the
+    module and returns torch tensors. The module is exported to `path` once and again whenever the
+    weights at `weights_path` are newer than the exported graph.
+    """
+
+    def __init__(self, module: torch.nn.Module, example_inputs: Tuple[torch.Tensor, ...], path: str, weights_path: str,
+                 input_names: List[str], output_names: List[str], dynamic_axes: Dict[str, Dict[int, str]],
+                 intra_op_threads: int = 0, inter_op_threads: int = 0):
+        import onnxruntime as ort
+
+        if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(weights_path):
+            self._export(module, example_inputs, path, input_names, output_names, dynamic_axes)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = input_names
+        self.nbytes = os.path.getsize(path)
+
+    @staticmethod
+    def _export(module: torch.nn.Module, example_inputs: Tuple[torch.Tensor, ...], path: str,
+                input_names: List[str], output_names: List[str], dynamic_axes: Dict[str, Dict[int, str]]):
+        get_logger('OnnxModule').info(f'Exporting {path}')
+        # Exported under a temporary name so that other processes never load a partial graph
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        # The exporter restores the training mode of the module on all its submodules afterwards
+        module.eval()
+        kwargs = {}
+        # Newer torch versions default to the dynamo exporter, which handles the dynamic axes differently
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            kwargs['dynamo'] = False
+        try:
+            with torch.no_grad():
+                torch.onnx.export(module, example_inputs, tmp_path, input_names=input_names, output_names=output_names,
+                                  dynamic_axes=dynamic_axes, opset_version=17, **kwargs)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def __call__(self, *inputs: torch.Tensor):
+        feeds = {name: tensor.detach().cpu().numpy() for name, tensor in zip(self.input_names, inputs)}
+        outputs = [torch.from_numpy(output) for output in self.session.run(None, feeds)]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+class ModelResidency:
+    """
+    Keeps track of the loaded models and the memory they take up. Once the loaded models exceed the
+    RAM or VRAM budget the least recently used ones are unloaded, with a TTL a model is also
+    unloaded once it has not been used for that long. Pinned models (see `pinned`) are never unloaded.
+
+    `ModelWrapper.load` and `ModelWrapper.unload` report to the global `model_residency`. They may
+    be called from the worker threads of the pipeline, so the bookkeeping happens under a lock.
+    """
+
+    def __init__(self):
+        self.ram_budget = 0
+        self.vram_budget = 0
+        self.ttl = 0
+        self._lock = threading.Condition()
+        # model -> (RAM bytes, VRAM bytes), least recently used first
+        self._models: OrderedDict[ModelWrapper, Tuple[int, int]] = OrderedDict()
+        self._pins: Dict[ModelWrapper, int] = {}
+        self._evicting = set()
+        self._timers: Dict[ModelWrapper, threading.Timer] = {}
+        self.logger = get_logger(self.__class__.__name__)
+
+    def configure(self, ram_budget: int = 0, vram_budget: int = 0, ttl: float = 0):
+        """Sets the budgets in bytes and the TTL in seconds, 0 means unlimited"""
+        with self._lock:
+            self.ram_budget = ram_budget
+            self.vram_budget = vram_budget
+            self.ttl = ttl
+            for model in self._models:
+                self._schedule_expiry(model)
+
+    def usage(self) -> Tuple[int, int]:
+        """Returns the bytes of RAM and VRAM taken up by the loaded models"""
+        with self._lock:
+            return sum(ram for ram, _ in self._models.values()), sum(vram for _, vram in self._models.values())
+
+    @asynccontextmanager
+    async def pinned(self, *models):
+        """
+        Keeps the given models from being unloaded while the block runs, arguments that are not a
+        `ModelWrapper` are ignored. If one of them is being unloaded right now this waits until it
+        is, so that loading it in the block loads it again.
+        """
+        models = [model for model in models if isinstance(model, ModelWrapper)]
+        while True:
+            with self._lock:
+                if not self._evicting.intersection(models):
+                    for model in models:
+                        self._pins[model] = self._pins.get(model, 0) + 1
+                        self._cancel_expiry(model)
+                    break
+            # The unloading may run on this event loop, so the loop must not be blocked while waiting for it
+            await asyncio.to_thread(self._wait_for_eviction, models)
+        try:
+            yield
+        finally:
+            with self._lock:
+                for model in models:
+                    self._pins[model] -= 1
+                    if not self._pins[model]:
+                        del self._pins[model]
+                        self._schedule_expiry(model)
+
+    def _wait_for_eviction(self, models: List['ModelWrapper']):
+        with self._lock:
+            self._lock.wait_for(lambda: not self._evicting.intersection(models))
+
+    async def loaded(self, model: 'ModelWrapper'):
+        ram, vram = model.memory_footprint()
+        self.logger.debug(f'{model._key} loaded: {ram / 2**20:.0f} MB RAM, {vram / 2**20:.0f} MB VRAM')
+        with self._lock:
+            self._models[model] = (ram, vram)
+            self._schedule_expiry(model)
+            victims = self._select_victims(model)
+        await self._evict(victims)
+
+    def used(self, model: 'ModelWrapper'):
+        with self._lock:
+            if model in self._models:
+                self._models.move_to_end(model)
+                self._schedule_expiry(model)
+
+    def unloaded(self, model: 'ModelWrapper'):
+        with self._lock:
+            self._models.pop(model, None)
+            self._cancel_expiry(model)
+
+    def _select_victims(self, keep: 'ModelWrapper') -> List['ModelWrapper']:
+        ram, vram = self.usage()
+        victims = []
+        for model, (model_ram, model_vram) in self._models.items():
+            if (not self.ram_budget or ram <= self.ram_budget) and (not self.vram_budget or vram <= self.vram_budget):
+                break
+            if model is keep or model in self._pins or model in self._evicting:
+                continue
+            victims.append(model)
+            ram -= model_ram
+            vram -= model_vram
+        if (self.ram_budget and ram > self.ram_budget) or (self.vram_budget and vram > self.vram_budget):
+            self.logger.warning(f'Loaded models exceed the memory budget: {ram / 2**20:.0f} MB RAM, {vram / 2**20:.0f} MB VRAM')
+        self._evicting.update(victims)
+        return victims
+
+    async def _evict(self, victims: List['ModelWrapper']):
+        if not victims:
+            return
+        try:
+            for model in victims:
+                self.logger.info(f'Unloading {model._key}')
+                # Called through the base class as translators overwrite `unload` with another signature
+                await ModelWrapper.unload(model)
+        finally:
+            with self._lock:
+                self._evicting.difference_update(victims)
+                self._lock.notify_all()
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def _schedule_expiry(self, model: 'ModelWrapper'):
+        self._cancel_expiry(model)
+        if self.ttl and model in self._models and model not in self._pins:
+            timer = threading.Timer(self.ttl, self._expire, (model,))
+            timer.daemon = True
+            self._timers[model] = timer
+            timer.start()
+
+    def _cancel_expiry(self, model: 'ModelWrapper'):
+        timer = self._timers.pop(model, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _expire(self, model: 'ModelWrapper'):
+        with self._lock:
+            # the timer may have been replaced after it fired
+            if self._timers.get(model) is not threading.current_thread() or model in self._evicting:
+                return
+            del self._timers[model]
+            self._evicting.add(model)
+        asyncio.run(self._evict([model]))
+
+
+model_residency = ModelResidency()
@@ -41,12 +41,22 @@ def parse_arguments():
                         help='Print debug info and save intermediate images in result folder')
     parser.add_argument('--start-instance', action='store_true',
                         help='If a translator should be launched automatically')
+    parser.add_argument('--instances', default=1, type=int,
+                        help='Number of translators to launch, they listen on the ports after --port and share the cores')
     parser.add_argument('--ignore-errors', action='store_true', help='Skip image on encountered error.')
     parser.add_argument('--nonce', default=os.getenv('MT_WEB_NONCE', ''), type=str, help='Nonce for securing internal web server communication')
     parser.add_argument('--models-ttl', default='0', type=int, help='models TTL in memory in seconds')
+    parser.add_argument('--models-ram-budget', default=0, type=int, help='RAM in MB the loaded models of each translator may take up, the least recently used ones are unloaded beyond it (0 means unlimited)')
+    parser.add_argument('--models-vram-budget', default=0, type=int, help='VRAM in MB the loaded models of each translator may take up, the least recently used ones are unloaded beyond it (0 means unlimited)')
     parser.add_argument('--pre-dict', default=None, type=file_path, help='Path to the pre-translation dictionary file')
     parser.add_argument('--post-dict', default=None, type=file_path, help='Path to the post-translation dictionary file')    
+    parser.add_argument('--result-cache-size', default=512, type=int, help='Memory in MB used to cache translation results of repeated requests, 0 disables the cache')
+    parser.add_argument('--result-cache-ttl', default=3600, type=int, help='Seconds a cached translation result is kept')
+    parser.add_argument('--metrics', action='store_true', help='Expose the stage timings and queue state in the Prometheus format at /metrics')
     g = parser.add_mutually_exclusive_group()
     g.add_argument('--use-gpu', action='store_true', help='Turn on/off gpu (auto switch between mps and cuda)')
     g.add_argument('--use-gpu-limited', action='store_true', help='Turn on/off gpu (excluding offline translator)')
+    parser.add_argument('--backend', default='torch', choices=['torch', 'onnx'], help='Run the default detector, the 48px OCR and the LaMa inpainters through ONNX Runtime when they are on the CPU')
+    parser.add_argument('--onnx-intra-op-threads', default=0, type=int, help='Threads ONNX Runtime uses within an operator of each translator (0 lets ONNX Runtime decide)')
+    parser.add_argument('--onnx-inter-op-threads', default=0, type=int, help='Threads ONNX Runtime uses to run independent operators in parallel (0 lets ONNX Runtime decide)')
     return parser.parse_args()
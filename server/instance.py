@@ -1,57 +1,176 @@
-from asyncio import Event, Lock
-from typing import List
+import asyncio
+import logging
+import subprocess
+from asyncio import Event
+from collections import deque
+from typing import Deque, Dict, List, Optional
 
-from PIL import Image
-from pydantic import BaseModel
+import aiohttp
+from pydantic import BaseModel, PrivateAttr
 
 from manga_translator import Config
 from server.sent_data_internal import fetch_data_stream, NotifyType, fetch_data
 
+logger = logging.getLogger('uvicorn.error')
+
 class ExecutorInstance(BaseModel):
     ip: str
     port: int
     busy: bool = False
 
+    # one keep-alive connection pool per executor, shared by all requests sent to it
+    _session: Optional[aiohttp.ClientSession] = PrivateAttr(None)
+    # only set for the executors started by this server, which are restarted if they crash
+    _process: Optional[subprocess.Popen] = PrivateAttr(None)
+    _process_args: Optional[dict] = PrivateAttr(None)
+    _healthy: bool = PrivateAttr(True)
+
+    @property
+    def url(self) -> str:
+        return "http://"+self.ip+":"+str(self.port)
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=4))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
     def free_executor(self):
         self.busy = False
 
-    async def sent(self, image: Image, config: Config):
-        return await fetch_data("http://"+self.ip+":"+str(self.port)+"/simple_execute/translate", image, config)
+    async def sent(self, image: bytes, config: Config, headers: Optional[Dict[str, str]] = None) -> bytes:
+        return await fetch_data(self.session(), self.url+"/simple_execute/translate", image, config, headers)
+
+    async def sent_stream(self, image: bytes, config: Config, sender: NotifyType, headers: Optional[Dict[str, str]] = None):
+        await fetch_data_stream(self.session(), self.url+"/execute/translate", image, config, sender, headers)
+
+    def start_process(self, cmds: List[str], **popen_kwargs):
+        self._process_args = dict(args=cmds, **popen_kwargs)
+        self._process = subprocess.Popen(**self._process_args)
+        self._healthy = False
+
+    def restart_process(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        self._process = subprocess.Popen(**self._process_args)
+        self._healthy = False
 
-    async def sent_stream(self, image: Image, config: Config, sender: NotifyType):
-        await fetch_data_stream("http://"+self.ip+":"+str(self.port)+"/execute/translate", image, config, sender)
+    def terminate_process(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+
+    def process_exited(self) -> bool:
+        return self._process is not None and self._process.poll() is not None
+
+    async def is_alive(self, timeout: float = 5) -> bool:
+        if self.process_exited():
+            return False
+        try:
+            async with self.session().get(self.url+"/is_locked", timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
 
 class Executors:
+    """
+    Hands out the registered executors. Free executors are kept in a deque, so acquiring and
+    releasing one takes constant time. `monitor` checks the health of the executors, restarts the
+    ones started by this server if they crash and drops the crashed ones that registered themselves.
+    """
+
     def __init__(self):
         self.list: List[ExecutorInstance] = []
-        self.lock: Lock = Lock()
+        self.free: Deque[ExecutorInstance] = deque()
         self.event = Event()
+        self.headers: Dict[str, str] = {}
 
     def register(self, instance: ExecutorInstance):
         self.list.append(instance)
+        if instance._healthy:
+            self._release(instance)
 
-    def free_executors(self) -> int:
-        return len([item for item in self.list if not item.busy])
+    def _release(self, instance: ExecutorInstance):
+        instance.free_executor()
+        self.free.append(instance)
+        self.event.set()
+        self.event.clear()
 
-    async def _find_instance(self):
-        while True:
-            instance = next((x for x in self.list if x.busy == False), None)
-            if instance is not None:
-                return instance
-            #todo: cricial error: warn should never happen
-            await self.event.wait()
+    def free_executors(self) -> int:
+        return len(self.free)
 
     async def find_executor(self) -> ExecutorInstance:
-        async with self.lock:  # Using async with for lock management
-            instance = await self._find_instance()
-            instance.busy = True
-            return instance
+        while not self.free:
+            await self.event.wait()
+        instance = self.free.popleft()
+        instance.busy = True
+        return instance
 
     async def free_executor(self, instance: ExecutorInstance):
         from server.myqueue import task_queue
-        instance.free_executor()
-        self.event.set()
-        self.event.clear()
+        if instance._healthy and instance in self.list:
+            self._release(instance)
+        else:
+            instance.free_executor()
         await task_queue.update_event()
 
+    def _mark_unhealthy(self, instance: ExecutorInstance):
+        instance._healthy = False
+        if instance in self.free:
+            self.free.remove(instance)
+
+    def mark_failed(self, instance: ExecutorInstance):
+        """Keeps an executor whose request failed out of the free list until `monitor` finds it healthy again"""
+        logger.warning(f"Request to executor {instance.url} failed")
+        self._mark_unhealthy(instance)
+        if instance._process_args is not None and instance.process_exited():
+            logger.warning(f"Executor {instance.url} exited with code {instance._process.returncode}, restarting it")
+            instance.restart_process()
+
+    async def check_health(self):
+        for instance in list(self.list):
+            # a busy executor is blocked by the translation, only its process is checked
+            healthy = not instance.process_exited() if instance.busy else await instance.is_alive()
+            if healthy:
+                if not instance._healthy:
+                    logger.info(f"Executor {instance.url} is ready")
+                    instance._healthy = True
+                    if not instance.busy:
+                        await self.free_executor(instance)
+                continue
+            if instance._process_args is not None:
+                if instance.process_exited():
+                    logger.warning(f"Executor {instance.url} exited with code {instance._process.returncode}, restarting it")
+                    self._mark_unhealthy(instance)
+                    instance.restart_process()
+                elif instance._healthy:
+                    # still starting up or temporarily unresponsive, it is used again once it answers
+                    logger.warning(f"Executor {instance.url} is not responding")
+                    self._mark_unhealthy(instance)
+            else:
+                logger.warning(f"Executor {instance.url} is not responding, removing it")
+                self._mark_unhealthy(instance)
+                self.list.remove(instance)
+                await instance.close()
+
+    async def monitor(self, interval: float = 10):
+        from server.myqueue import task_queue
+        while True:
+            await self.check_health()
+            await task_queue.remove_disconnected()
+            # executors that are starting up are polled more often
+            await asyncio.sleep(1 if any(not instance._healthy for instance in self.list) else interval)
+
+    async def close(self):
+        for instance in self.list:
+            await instance.close()
+
+    def terminate(self):
+        for instance in self.list:
+            instance.terminate_process()
+
 executor_instances: Executors = Executors()
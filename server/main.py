@@ -1,27 +1,37 @@
+import asyncio
 import io
 import os
 import secrets
 import shutil
 import signal
-import subprocess
 import sys
 from argparse import Namespace
+from contextlib import asynccontextmanager
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 
 from fastapi import FastAPI, Request, HTTPException, Header, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, HTMLResponse
+from fastapi.responses import StreamingResponse, HTMLResponse, PlainTextResponse
 from pathlib import Path
 
 from manga_translator import Config
 from server.instance import ExecutorInstance, executor_instances
+from server.metrics import stage_metrics
 from server.myqueue import task_queue
-from server.request_extraction import get_ctx, while_streaming, TranslateRequest
-from server.to_json import to_translation, TranslationResponse
-
-app = FastAPI()
+from server.request_extraction import get_result, while_streaming, TranslateRequest
+from server.result_cache import result_cache, CacheStats, TranslationResult
+from server.to_json import TranslationResponse
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    executor_monitor = asyncio.create_task(executor_instances.monitor())
+    yield
+    executor_monitor.cancel()
+    await executor_instances.close()
+
+app = FastAPI(lifespan=lifespan)
 nonce = None
 
 app.add_middleware(
@@ -39,81 +49,71 @@ async def register_instance(instance: ExecutorInstance, req: Request, req_nonce:
     instance.ip = req.client.host
     executor_instances.register(instance)
 
-def transform_to_image(ctx):
-    img_byte_arr = io.BytesIO()
-    ctx.result.save(img_byte_arr, format="PNG")
-    return img_byte_arr.getvalue()
+def transform_to_image(result: TranslationResult):
+    return result.png
 
-def transform_to_json(ctx):
-    return to_translation(ctx).model_dump_json().encode("utf-8")
+def transform_to_json(result: TranslationResult):
+    return result.translation.model_dump_json().encode("utf-8")
 
-def transform_to_bytes(ctx):
-    return to_translation(ctx).to_bytes()
+def transform_to_bytes(result: TranslationResult):
+    return result.translation.to_bytes()
 
 @app.post("/translate/json", response_model=TranslationResponse, tags=["api", "json"],response_description="json strucure inspired by the ichigo translator extension")
 async def json(req: Request, data: TranslateRequest):
-    ctx = await get_ctx(req, data.config, data.image)
-    return to_translation(ctx)
+    result = await get_result(req, data.config, data.image)
+    return result.translation
 
 @app.post("/translate/bytes", response_class=StreamingResponse, tags=["api", "json"],response_description="custom byte structure for decoding look at examples in 'examples/response.*'")
 async def bytes(req: Request, data: TranslateRequest):
-    ctx = await get_ctx(req, data.config, data.image)
-    return StreamingResponse(content=to_translation(ctx).to_bytes())
+    result = await get_result(req, data.config, data.image)
+    return StreamingResponse(content=result.translation.to_bytes())
 
 @app.post("/translate/image", response_description="the result image", tags=["api", "json"],response_class=StreamingResponse)
 async def image(req: Request, data: TranslateRequest) -> StreamingResponse:
-    ctx = await get_ctx(req, data.config, data.image)
-    img_byte_arr = io.BytesIO()
-    ctx.result.save(img_byte_arr, format="PNG")
-    img_byte_arr.seek(0)
-
-    return StreamingResponse(img_byte_arr, media_type="image/png")
+    result = await get_result(req, data.config, data.image)
+    return StreamingResponse(io.BytesIO(result.png), media_type="image/png")
 
-@app.post("/translate/json/stream", response_class=StreamingResponse,tags=["api", "json"], response_description="A stream over elements with strucure(1byte status, 4 byte size, n byte data) status code are 0,1,2,3,4 0 is result data, 1 is progress report, 2 is error, 3 is waiting queue position, 4 is waiting for translator instance")
+@app.post("/translate/json/stream", response_class=StreamingResponse,tags=["api", "json"], response_description="A stream over elements with strucure(1byte status, 4 byte size, n byte data) status code are 0,1,2,3,4,5 0 is result data, 1 is progress report, 2 is error, 3 is waiting queue position, 4 is waiting for translator instance, 5 is the timing of a finished stage as json")
 async def stream_json(req: Request, data: TranslateRequest) -> StreamingResponse:
     return await while_streaming(req, transform_to_json, data.config, data.image)
 
-@app.post("/translate/bytes/stream", response_class=StreamingResponse, tags=["api", "json"],response_description="A stream over elements with strucure(1byte status, 4 byte size, n byte data) status code are 0,1,2,3,4 0 is result data, 1 is progress report, 2 is error, 3 is waiting queue position, 4 is waiting for translator instance")
+@app.post("/translate/bytes/stream", response_class=StreamingResponse, tags=["api", "json"],response_description="A stream over elements with strucure(1byte status, 4 byte size, n byte data) status code are 0,1,2,3,4,5 0 is result data, 1 is progress report, 2 is error, 3 is waiting queue position, 4 is waiting for translator instance, 5 is the timing of a finished stage as json")
 async def stream_bytes(req: Request, data: TranslateRequest)-> StreamingResponse:
     return await while_streaming(req, transform_to_bytes,data.config, data.image)
 
-@app.post("/translate/image/stream", response_class=StreamingResponse, tags=["api", "json"], response_description="A stream over elements with strucure(1byte status, 4 byte size, n byte data) status code are 0,1,2,3,4 0 is result data, 1 is progress report, 2 is error, 3 is waiting queue position, 4 is waiting for translator instance")
+@app.post("/translate/image/stream", response_class=StreamingResponse, tags=["api", "json"], response_description="A stream over elements with strucure(1byte status, 4 byte size, n byte data) status code are 0,1,2,3,4,5 0 is result data, 1 is progress report, 2 is error, 3 is waiting queue position, 4 is waiting for translator instance, 5 is the timing of a finished stage as json")
 async def stream_image(req: Request, data: TranslateRequest) -> StreamingResponse:
     return await while_streaming(req, transform_to_image, data.config, data.image)
 
 @app.post("/translate/with-form/json", response_model=TranslationResponse, tags=["api", "form"],response_description="json strucure inspired by the ichigo translator extension")
 async def json_form(req: Request, image: UploadFile = File(...), config: str = Form("{}")):
     img = await image.read()
-    ctx = await get_ctx(req, Config.parse_raw(config), img)
-    return to_translation(ctx)
+    result = await get_result(req, Config.parse_raw(config), img)
+    return result.translation
 
 @app.post("/translate/with-form/bytes", response_class=StreamingResponse, tags=["api", "form"],response_description="custom byte structure for decoding look at examples in 'examples/response.*'")
 async def bytes_form(req: Request, image: UploadFile = File(...), config: str = Form("{}")):
     img = await image.read()
-    ctx = await get_ctx(req, Config.parse_raw(config), img)
-    return StreamingResponse(content=to_translation(ctx).to_bytes())
+    result = await get_result(req, Config.parse_raw(config), img)
+    return StreamingResponse(content=result.translation.to_bytes())
 
 @app.post("/translate/with-form/image", response_description="the result image", tags=["api", "form"],response_class=StreamingResponse)
 async def image_form(req: Request, image: UploadFile = File(...), config: str = Form("{}")) -> StreamingResponse:
     img = await image.read()
-    ctx = await get_ctx(req, Config.parse_raw(config), img)
-    img_byte_arr = io.BytesIO()
-    ctx.result.save(img_byte_arr, format="PNG")
-    img_byte_arr.seek(0)
-
-    return StreamingResponse(img_byte_arr, media_type="image/png")
+    result = await get_result(req, Config.parse_raw(config), img)
+    return StreamingResponse(io.BytesIO(result.png), media_type="image/png")
 
-@app.post("/translate/with-form/json/stream", response_class=StreamingResponse, tags=["api", "form"],response_description="A stream over elements with strucure(1byte status, 4 byte size, n byte data) status code are 0,1,2,3,4 0 is result data, 1 is progress report, 2 is error, 3 is waiting queue position, 4 is waiting for translator instance")
+@app.post("/translate/with-form/json/stream", response_class=StreamingResponse, tags=["api", "form"],response_description="A stream over elements with strucure(1byte status, 4 byte size, n byte data) status code are 0,1,2,3,4,5 0 is result data, 1 is progress report, 2 is error, 3 is waiting queue position, 4 is waiting for translator instance, 5 is the timing of a finished stage as json")
 async def stream_json_form(req: Request, image: UploadFile = File(...), config: str = Form("{}")) -> StreamingResponse:
     img = await image.read()
     return await while_streaming(req, transform_to_json, Config.parse_raw(config), img)
 
-@app.post("/translate/with-form/bytes/stream", response_class=StreamingResponse,tags=["api", "form"], response_description="A stream over elements with strucure(1byte status, 4 byte size, n byte data) status code are 0,1,2,3,4 0 is result data, 1 is progress report, 2 is error, 3 is waiting queue position, 4 is waiting for translator instance")
+@app.post("/translate/with-form/bytes/stream", response_class=StreamingResponse,tags=["api", "form"], response_description="A stream over elements with strucure(1byte status, 4 byte size, n byte data) status code are 0,1,2,3,4,5 0 is result data, 1 is progress report, 2 is error, 3 is waiting queue position, 4 is waiting for translator instance, 5 is the timing of a finished stage as json")
 async def stream_bytes_form(req: Request, image: UploadFile = File(...), config: str = Form("{}"))-> StreamingResponse:
     img = await image.read()
     return await while_streaming(req, transform_to_bytes, Config.parse_raw(config), img)
 
-@app.post("/translate/with-form/image/stream", response_class=StreamingResponse, tags=["api", "form"], response_description="A stream over elements with strucure(1byte status, 4 byte size, n byte data) status code are 0,1,2,3,4 0 is result data, 1 is progress report, 2 is error, 3 is waiting queue position, 4 is waiting for translator instance")
+@app.post("/translate/with-form/image/stream", response_class=StreamingResponse, tags=["api", "form"], response_description="A stream over elements with strucure(1byte status, 4 byte size, n byte data) status code are 0,1,2,3,4,5 0 is result data, 1 is progress report, 2 is error, 3 is waiting queue position, 4 is waiting for translator instance, 5 is the timing of a finished stage as json")
 async def stream_image_form(req: Request, image: UploadFile = File(...), config: str = Form("{}")) -> StreamingResponse:
     img = await image.read()
     return await while_streaming(req, transform_to_image, Config.parse_raw(config), img)
@@ -122,6 +122,28 @@ async def stream_image_form(req: Request, image: UploadFile = File(...), config:
 async def queue_size() -> int:
     return len(task_queue.queue)
 
+@app.get("/cache-stats", response_model=CacheStats, tags=["api", "json"])
+async def cache_stats() -> CacheStats:
+    return result_cache.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse, tags=["api"])
+async def metrics() -> PlainTextResponse:
+    """Metrics in the Prometheus text format, only available with --metrics"""
+    if not stage_metrics.enabled:
+        raise HTTPException(404, detail="Metrics are disabled, start the server with --metrics")
+    cache = result_cache.stats()
+    counters = {
+        'manga_translator_result_cache_hits_total': cache.hits,
+        'manga_translator_result_cache_misses_total': cache.misses,
+    }
+    gauges = {
+        'manga_translator_queue_size': len(task_queue.queue),
+        'manga_translator_executors': len(executor_instances.list),
+        'manga_translator_executors_free': executor_instances.free_executors(),
+        'manga_translator_result_cache_bytes': cache.bytes,
+    }
+    return PlainTextResponse(stage_metrics.render(counters, gauges), media_type="text/plain; version=0.0.4")
+
 @app.get("/", response_class=HTMLResponse,tags=["ui"])
 async def index() -> HTMLResponse:
     script_directory = Path(__file__).parent
@@ -139,7 +161,7 @@ async def manual():
 def generate_nonce():
     return secrets.token_hex(16)
 
-def start_translator_client_proc(host: str, port: int, nonce: str, params: Namespace):
+def start_translator_client_proc(host: str, port: int, nonce: str, params: Namespace, threads: int = 0):
     cmds = [
         sys.executable,
         '-m', 'manga_translator',
@@ -152,57 +174,79 @@ def start_translator_client_proc(host: str, port: int, nonce: str, params: Names
         cmds.append('--use-gpu')
     if params.use_gpu_limited:
         cmds.append('--use-gpu-limited')
+    if params.backend != 'torch':
+        cmds.append('--backend=%s' % params.backend)
+    if params.onnx_intra_op_threads:
+        cmds.append('--onnx-intra-op-threads=%s' % params.onnx_intra_op_threads)
+    if params.onnx_inter_op_threads:
+        cmds.append('--onnx-inter-op-threads=%s' % params.onnx_inter_op_threads)
     if params.ignore_errors:
         cmds.append('--ignore-errors')
     if params.verbose:
         cmds.append('--verbose')
     if params.models_ttl:
         cmds.append('--models-ttl=%s' % params.models_ttl)
+    if params.models_ram_budget:
+        cmds.append('--models-ram-budget=%s' % params.models_ram_budget)
+    if params.models_vram_budget:
+        cmds.append('--models-vram-budget=%s' % params.models_vram_budget)
     if params.pre_dict: 
         cmds.extend(['--pre-dict', params.pre_dict]) 
-    if params.pre_dict: 
+    if params.post_dict:
         cmds.extend(['--post-dict', params.post_dict])         
     base_path = os.path.dirname(os.path.abspath(__file__))
     parent = os.path.dirname(base_path)
-    proc = subprocess.Popen(cmds, cwd=parent)
-    executor_instances.register(ExecutorInstance(ip=host, port=port))
+    env = None
+    if threads:
+        # keep the executors from oversubscribing the cores they share
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+    instance = ExecutorInstance(ip=host, port=port)
+    instance.start_process(cmds, cwd=parent, env=env)
+    executor_instances.register(instance)
+    return instance
+
+def start_translator_client_procs(host: str, port: int, nonce: str, params: Namespace):
+    """Starts `params.instances` executors on the ports following `port`, the cores are split between them"""
+    threads = max(1, (os.cpu_count() or 1) // params.instances) if params.instances > 1 else 0
+    for i in range(params.instances):
+        start_translator_client_proc(host, port + i, nonce, params, threads)
 
     def handle_exit_signals(signal, frame):
-        proc.terminate()
+        executor_instances.terminate()
         sys.exit(0)
 
     signal.signal(signal.SIGINT, handle_exit_signals)
     signal.signal(signal.SIGTERM, handle_exit_signals)
 
-    return proc
-
 def prepare(args):
     global nonce
     if args.nonce is None:
         nonce = os.getenv('MT_WEB_NONCE', generate_nonce())
     else:
         nonce = args.nonce
+    result_cache.max_bytes = args.result_cache_size * 1024 * 1024
+    result_cache.ttl = args.result_cache_ttl
+    stage_metrics.enabled = args.metrics
+    if nonce:
+        executor_instances.headers = {'X-Nonce': nonce}
+        task_queue.nonce = nonce
     if args.start_instance:
-        return start_translator_client_proc(args.host, args.port + 1, nonce, args)
+        start_translator_client_procs(args.host, args.port + 1, nonce, args)
+        return
     folder_name= "upload-cache"
     if os.path.exists(folder_name):
         shutil.rmtree(folder_name)
     os.makedirs(folder_name)
 
-#todo: restart if crash
-#todo: cache results
-#todo: cleanup cache
-
 if __name__ == '__main__':
     import uvicorn
     from args import parse_arguments
 
     args = parse_arguments()
     args.start_instance = True
-    proc = prepare(args)
+    prepare(args)
     print("Nonce: "+nonce)
     try:
         uvicorn.run(app, host=args.host, port=args.port)
     except Exception:
-        if proc:
-            proc.terminate()
+        executor_instances.terminate()
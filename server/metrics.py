@@ -0,0 +1,53 @@
+from typing import Dict, List, Tuple
+
+
+class StageMetrics:
+    """
+    Collects the stage timings of the translated images and renders them, together with the given
+    counters and gauges, in the Prometheus text format.
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.enabled = False
+        # stage -> (observations per bucket, sum of the durations, number of observations)
+        self._stages: Dict[str, Tuple[List[int], float, int]] = {}
+        self._pixels: Dict[str, int] = {}
+
+    def observe(self, timings: Dict[str, dict]):
+        if not self.enabled:
+            return
+        for stage, timing in timings.items():
+            buckets, total, count = self._stages.get(stage) or ([0] * len(self.BUCKETS), 0.0, 0)
+            for i, bound in enumerate(self.BUCKETS):
+                if timing['duration'] <= bound:
+                    buckets[i] += 1
+            self._stages[stage] = (buckets, total + timing['duration'], count + 1)
+            self._pixels[stage] = self._pixels.get(stage, 0) + timing.get('pixels', 0)
+
+    def render(self, counters: Dict[str, float], gauges: Dict[str, float]) -> str:
+        lines = [
+            '# HELP manga_translator_stage_duration_seconds Duration of the pipeline stages',
+            '# TYPE manga_translator_stage_duration_seconds histogram',
+        ]
+        for stage, (buckets, total, count) in sorted(self._stages.items()):
+            for bound, observations in zip(self.BUCKETS, buckets):
+                lines.append(f'manga_translator_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {observations}')
+            lines.append(f'manga_translator_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'manga_translator_stage_duration_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'manga_translator_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+        lines.append('# HELP manga_translator_stage_pixels_total Pixels processed by the pipeline stages')
+        lines.append('# TYPE manga_translator_stage_pixels_total counter')
+        for stage, pixels in sorted(self._pixels.items()):
+            lines.append(f'manga_translator_stage_pixels_total{{stage="{stage}"}} {pixels}')
+        for name, value in counters.items():
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {value}')
+        for name, value in gauges.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+stage_metrics = StageMetrics()
@@ -1,6 +1,10 @@
 import asyncio
+import bisect
+import io
+import itertools
 import os
-from typing import List, Optional
+import secrets
+from typing import Dict, List, Optional, Tuple
 
 from PIL import Image
 from fastapi import HTTPException
@@ -10,13 +14,27 @@ from manga_translator import Config
 from server.instance import executor_instances
 from server.sent_data_internal import NotifyType
 
+# priority classes a client can ask for with the X-Priority header, if it also sends the server nonce
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+
 class QueueElement:
     req: Request
-    image: Image.Image | str
+    image: bytes | str
+    """the encoded image as uploaded, or the path it is stored at"""
     config: Config
+    priority: int
+    client: str
+    """tasks of the same client are interleaved with the tasks of other clients"""
 
-    def __init__(self, req: Request, image: Image.Image, config: Config, length):
+    def __init__(self, req: Request, image: bytes, config: Config, length):
         self.req = req
+        self.priority = PRIORITIES['normal']
+        self.client = req.client.host if req.client else ''
+        # untrusted clients could pick a new id for every request to get a turn of their own
+        if task_queue.is_trusted(req):
+            self.priority = PRIORITIES.get(req.headers.get('X-Priority', 'normal').lower(), PRIORITIES['normal'])
+            self.client = req.headers.get('X-Client-Id') or self.client
+        self.key: Optional[Tuple[int, int, int]] = None
         if length > 10:
             #todo: store image in "upload-cache" folder
             self.image = image
@@ -27,6 +45,13 @@ class QueueElement:
     def get_image(self)-> Image:
         if isinstance(self.image, str):
             return Image.open(self.image)
+        else:
+            return Image.open(io.BytesIO(self.image))
+
+    def get_image_bytes(self) -> bytes:
+        if isinstance(self.image, str):
+            with open(self.image, 'rb') as f:
+                return f.read()
         else:
             return self.image
 
@@ -41,27 +66,74 @@ class QueueElement:
 
 
 class TaskQueue:
+    """
+    Orders the tasks by priority class first. Within a class the clients take turns: every task
+    gets the round after the previous task of its client, but never a round that was already
+    served, so a client that queues a whole chapter does not hold up the other clients.
+    """
+
     def __init__(self):
         self.queue: List[QueueElement] = []
         self.queue_event: asyncio.Event = asyncio.Event()
+        # sort keys (priority, round, sequence number) of the tasks in `queue`
+        self._keys: List[Tuple[int, int, int]] = []
+        self._last_round: Dict[Tuple[int, str], int] = {}
+        self._served_round: Dict[int, int] = {}
+        self._counter = itertools.count()
+        # requests that send this nonce in the X-Nonce header may choose their priority
+        self.nonce: Optional[str] = None
+
+    def is_trusted(self, req: Request) -> bool:
+        if not self.nonce:
+            return False
+        return secrets.compare_digest(req.headers.get('X-Nonce', '').encode('utf-8'), self.nonce.encode('utf-8'))
 
     def add_task(self, task: QueueElement):
-        self.queue.append(task)
+        group = (task.priority, task.client)
+        round = max(self._last_round.get(group, -1) + 1, self._served_round.get(task.priority, 0))
+        self._last_round[group] = round
+        task.key = (task.priority, round, next(self._counter))
+        pos = bisect.bisect(self._keys, task.key)
+        self._keys.insert(pos, task.key)
+        self.queue.insert(pos, task)
 
     def get_pos(self, task: QueueElement) -> Optional[int]:
-        try:
-            return self.queue.index(task)
-        except ValueError:
+        if task.key is None:
             return None
+        pos = bisect.bisect_left(self._keys, task.key)
+        if pos < len(self.queue) and self.queue[pos] is task:
+            return pos
+        return None
+
+    def discard(self, task: QueueElement) -> bool:
+        pos = self.get_pos(task)
+        if pos is None:
+            return False
+        del self._keys[pos]
+        del self.queue[pos]
+        return True
+
     async def update_event(self):
-        self.queue = [task for task in self.queue if not await task.is_client_disconnected()]
         self.queue_event.set()
         self.queue_event.clear()
 
     async def remove(self, task: QueueElement):
-        self.queue.remove(task)
+        if self.discard(task):
+            priority, round, _ = task.key
+            self._served_round[priority] = max(round, self._served_round.get(priority, 0))
         await self.update_event()
 
+    async def remove_disconnected(self):
+        """Drops the tasks of clients that went away, called periodically by the executor monitor"""
+        disconnected = [task for task in self.queue if await task.is_client_disconnected()]
+        for task in disconnected:
+            self.discard(task)
+        # the rounds of clients without queued tasks are not needed anymore
+        queued = {(task.priority, task.client) for task in self.queue}
+        self._last_round = {group: round for group, round in self._last_round.items() if group in queued}
+        if disconnected:
+            await self.update_event()
+
     async def wait_for_event(self):
         await self.queue_event.wait()
 
@@ -80,6 +152,7 @@ async def wait_in_queue(task: QueueElement, notify: NotifyType):
             notify(3, str(queue_pos).encode('utf-8'))
         if queue_pos < executor_instances.free_executors():
             if await task.is_client_disconnected():
+                task_queue.discard(task)
                 await task_queue.update_event()
                 if notify:
                     return
@@ -90,12 +163,20 @@ async def wait_in_queue(task: QueueElement, notify: NotifyType):
             await task_queue.remove(task)
             if notify:
                 notify(4, b"")
-            if notify:
-                await instance.sent_stream(task.image, task.config, notify)
-            else:
-                result = await instance.sent(task.image, task.config)
-
-            await executor_instances.free_executor(instance)
+            try:
+                if notify:
+                    await instance.sent_stream(task.get_image_bytes(), task.config, notify, executor_instances.headers)
+                else:
+                    result = await instance.sent(task.get_image_bytes(), task.config, executor_instances.headers)
+            except Exception as e:
+                if not isinstance(e, HTTPException):
+                    # the executor crashed or can't be reached, it is not handed out again until it's healthy
+                    executor_instances.mark_failed(instance)
+                if not notify:
+                    raise
+                notify(2, str(e).encode('utf-8'))
+            finally:
+                await executor_instances.free_executor(instance)
 
             if notify:
                 return
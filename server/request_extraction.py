@@ -13,6 +13,8 @@ from fastapi.responses import StreamingResponse
 
 from manga_translator import Config
 from server.myqueue import task_queue, wait_in_queue, QueueElement
+from server.metrics import stage_metrics
+from server.result_cache import result_cache, TranslationResult
 from server.streaming import notify, stream
 
 class TranslateRequest(BaseModel):
@@ -22,42 +24,70 @@ class TranslateRequest(BaseModel):
     config: Config = Config()
     """in case it is a multipart this needs to be a string(json.stringify)"""
 
-async def to_pil_image(image: Union[str, bytes]) -> Image.Image:
+async def to_image_bytes(image: Union[str, bytes]) -> bytes:
+    """Returns the encoded image of a multipart upload, base64 data url or url"""
     try:
         if isinstance(image, builtins.bytes):
-            image = Image.open(io.BytesIO(image))
             return image
         else:
             if re.match(r'^data:image/.+;base64,', image):
                 value = image.split(',', 1)[1]
-                image_data = b64decode(value)
-                image = Image.open(io.BytesIO(image_data))
-                return image
+                return b64decode(value)
             else:
                 response = requests.get(image)
-                image = Image.open(io.BytesIO(response.content))
-                return image
+                return response.content
     except Exception as e:
         raise HTTPException(status_code=422, detail=str(e))
 
+def to_pil_image(image_bytes: bytes) -> Image.Image:
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+        return image
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
-async def get_ctx(req: Request, config: Config, image: str|bytes):
-    image = await to_pil_image(image)
-    task = QueueElement(req, image, config, 0)
+async def cache_key(image_bytes: bytes, config: Config) -> str:
+    """Decodes and hashes the image in a worker thread, so that large uploads don't block the event loop"""
+    return await asyncio.to_thread(lambda: result_cache.key(to_pil_image(image_bytes), config))
 
-    task_queue.add_task(task)
 
-    return await wait_in_queue(task, None)
+async def get_result(req: Request, config: Config, image: str|bytes) -> TranslationResult:
+    """Answers repeated requests from the result cache, the others are queued for an executor"""
+    image_bytes = await to_image_bytes(image)
+    key = await cache_key(image_bytes, config)
+    result = result_cache.get(key)
+    if result is not None:
+        return result
 
-async def while_streaming(req: Request, transform, config: Config, image: bytes | str):
-    image = await to_pil_image(image)
-    task = QueueElement(req, image, config, 0)
+    task = QueueElement(req, image_bytes, config, 0)
     task_queue.add_task(task)
+    result = TranslationResult.from_message(await wait_in_queue(task, None))
+    stage_metrics.observe(result.timings)
+    result_cache.put(key, result)
+    return result
 
+async def while_streaming(req: Request, transform, config: Config, image: bytes | str):
+    image_bytes = await to_image_bytes(image)
+    key = await cache_key(image_bytes, config)
     messages = asyncio.Queue()
+    streaming_response = StreamingResponse(stream(messages), media_type="application/octet-stream")
+
+    result = result_cache.get(key)
+    if result is not None:
+        notify(0, result, transform, messages)
+        return streaming_response
+
+    def transform_result(data: bytes) -> bytes:
+        result = TranslationResult.from_message(data)
+        stage_metrics.observe(result.timings)
+        result_cache.put(key, result)
+        return transform(result)
 
     def notify_internal(code: int, data: bytes) -> None:
-        notify(code, data, transform, messages)
-    streaming_response = StreamingResponse(stream(messages), media_type="application/octet-stream")
+        notify(code, data, transform_result, messages)
+
+    task = QueueElement(req, image_bytes, config, 0)
+    task_queue.add_task(task)
     asyncio.create_task(wait_in_queue(task, notify_internal))
-    return streaming_response
\ No newline at end of file
+    return streaming_response
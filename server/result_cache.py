@@ -0,0 +1,114 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from PIL import Image
+from pydantic import BaseModel
+
+from manga_translator import Config
+from manga_translator.mode.protocol import decode_message
+from server.to_json import TranslationResponse, to_translation
+
+
+class TranslationResult:
+    """The parts of a translation result the endpoints respond with."""
+
+    def __init__(self, translation: TranslationResponse, png: bytes, timings: Optional[dict] = None):
+        self.translation = translation
+        self.png = png
+        self.timings = timings if timings is not None else {}
+
+    @classmethod
+    def from_message(cls, payload: bytes) -> 'TranslationResult':
+        """Decodes a result sent by an executor, see `manga_translator.mode.share.encode_result`"""
+        meta, buffers = decode_message(payload)
+        backgrounds = [buffers[f'background{i}'] for i in range(len(meta['regions']))]
+        return cls(to_translation(meta['regions'], backgrounds), buffers['result'].tobytes(), meta.get('timings', {}))
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.png) + sum(t.background.nbytes for t in self.translation.translations)
+
+
+class CacheStats(BaseModel):
+    entries: int
+    bytes: int
+    max_bytes: int
+    hits: int
+    misses: int
+    hit_rate: float
+
+
+class ResultCache:
+    """
+    In-memory cache of translation results, keyed by the content hash of the image and the
+    canonical JSON of the config. Entries expire after `ttl` seconds and the least recently used
+    ones are evicted once the cached results take up more than `max_bytes`. A `max_bytes` of 0
+    disables the cache.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, ttl: float = 3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries: OrderedDict[str, tuple[float, int, TranslationResult]] = OrderedDict()
+
+    @staticmethod
+    def key(image: Image.Image, config: Config) -> str:
+        h = hashlib.sha256()
+        h.update(f'{image.mode}:{image.size}'.encode('utf-8'))
+        h.update(image.tobytes())
+        h.update(config.model_dump_json().encode('utf-8'))
+        return h.hexdigest()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: str) -> Optional[TranslationResult]:
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, key: str, result: TranslationResult):
+        if not self.enabled:
+            return
+        self._expire()
+        size = result.nbytes
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, result)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in [key for key, (expires, _, _) in self._entries.items() if expires < now]:
+            self._remove(key)
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> CacheStats:
+        total = self.hits + self.misses
+        return CacheStats(entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes,
+                          hits=self.hits, misses=self.misses, hit_rate=self.hits / total if total else 0.0)
+
+
+result_cache = ResultCache()
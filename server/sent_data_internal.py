@@ -1,62 +1,39 @@
-import pickle
 from typing import Mapping, Optional, Callable
 
 import aiohttp
-from PIL.Image import Image
 from fastapi import HTTPException
 
 from manga_translator import Config
+from manga_translator.mode.protocol import FrameReader, encode_message
 
 NotifyType = Optional[Callable[[int, Optional[bytes]], None]]
 
-async def fetch_data_stream(url, image: Image, config: Config, sender: NotifyType, headers: Mapping[str, str] = {}):
-    attributes = {"image": image, "config": config}
-    data = pickle.dumps(attributes)
+def encode_request(image: bytes, config: Config) -> bytes:
+    """The encoded image is forwarded as uploaded, the executor decodes it"""
+    return encode_message({"config": config.model_dump_json()}, {"image": image})
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, data=data, headers=headers) as response:
-            if response.status == 200:
-                await process_stream(response, sender)
-            else:
-                raise HTTPException(response.status, detail=response.text())
+async def fetch_data_stream(session: aiohttp.ClientSession, url, image: bytes, config: Config, sender: NotifyType, headers: Optional[Mapping[str, str]] = None):
+    data = encode_request(image, config)
 
-async def fetch_data(url, image: Image, config: Config, headers: Mapping[str, str] = {}):
-    attributes = {"image": image, "config": config}
-    data = pickle.dumps(attributes)
+    async with session.post(url, data=data, headers=headers) as response:
+        if response.status == 200:
+            await process_stream(response, sender)
+        else:
+            raise HTTPException(response.status, detail=await response.text())
+
+async def fetch_data(session: aiohttp.ClientSession, url, image: bytes, config: Config, headers: Optional[Mapping[str, str]] = None) -> bytes:
+    data = encode_request(image, config)
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, data=data, headers=headers) as response:
-            if response.status == 200:
-                return pickle.loads(await response.read())
-            else:
-                raise HTTPException(response.status, detail=response.text())
+    async with session.post(url, data=data, headers=headers) as response:
+        if response.status == 200:
+            return await response.read()
+        else:
+            raise HTTPException(response.status, detail=await response.text())
 
 async def process_stream(response, sender: NotifyType):
-    buffer = b''
+    reader = FrameReader()
 
     async for chunk in response.content.iter_any():
-        if chunk:
-            buffer += chunk
-            buffer = handle_buffer(buffer, sender)
-
-
-
-def handle_buffer(buffer, sender: NotifyType):
-    while len(buffer) >= 5:
-        status, expected_size = extract_header(buffer)
-
-        if len(buffer) >= 5 + expected_size:
-            data = buffer[5:5 + expected_size]
+        for status, data in reader.feed(chunk):
             sender(status, data)
-            buffer = buffer[5 + expected_size:]
-        else:
-            break
-    return buffer
-
-
-def extract_header(buffer):
-    """Extract the status and expected size from the buffer."""
-    status = int.from_bytes(buffer[0:1], byteorder='big')
-    expected_size = int.from_bytes(buffer[1:5], byteorder='big')
-    return status, expected_size
-
+    reader.close()
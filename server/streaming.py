@@ -1,5 +1,6 @@
 import asyncio
-import pickle
+
+from manga_translator.mode.protocol import encode_frame
 
 async def stream(messages):
     while True:
@@ -8,11 +9,8 @@ async def stream(messages):
         if message[0] == 0 or message[0] == 2:
             break
 
-def notify(code: int, data: bytes, transform_to_bytes, messages: asyncio.Queue):
+def notify(code: int, data, transform_to_bytes, messages: asyncio.Queue):
     if code == 0:
-        result_bytes = transform_to_bytes(pickle.loads(data))
-        encoded_result = b'\x00' + len(result_bytes).to_bytes(4, 'big') + result_bytes
-        messages.put_nowait(encoded_result)
+        messages.put_nowait(encode_frame(code, transform_to_bytes(data)))
     else:
-        encoded_result =code.to_bytes(1, 'big') + len(data).to_bytes(4, 'big') + data
-        messages.put_nowait(encoded_result)
\ No newline at end of file
+        messages.put_nowait(encode_frame(code, data))
\ No newline at end of file
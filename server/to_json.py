@@ -1,14 +1,11 @@
 import base64
 import struct
-from typing import Dict, List, Annotated
+from typing import Any, Dict, List, Annotated
 
 import cv2
 import numpy as np
 from pydantic import BaseModel, Field, WithJsonSchema
 
-from manga_translator import Context
-from manga_translator.utils import TextBlock
-
 
 #input:PIL,
 #result:PIL
@@ -83,28 +80,8 @@ class TranslationResponse(BaseModel):
         items= [v.to_bytes() for v in self.translations]
         return struct.pack('i', len(items)) + b''.join(items)
 
-def to_translation(ctx: Context) -> TranslationResponse:
-    text_regions:list[TextBlock] = ctx.text_regions
-    inpaint = ctx.img_inpainted
-    translations:Dict[str, List[str]] = ctx.translations
-    results = []
-    for i, blk in enumerate(text_regions):
-        minX, minY, maxX, maxY = blk.xyxy
-        text_region = text_regions[i]
-        if 'translations' in ctx:
-            trans = {key: value[i] for key, value in translations.items()}
-        else:
-            trans = {}
-        trans[text_region.source_lang] = text_regions[i].text
-        text_region.adjust_bg_color = False
-        color1, color2 = text_region.get_font_colors()
-        results.append(Translation(text=trans,
-                    minX=int(minX),minY=int(minY),maxX=int(maxX),maxY=int(maxY),
-                    background=inpaint[minY:maxY, minX:maxX],
-                    is_bulleted_list=text_region.is_bulleted_list,
-                    text_color=TextColor(fg=color1.tolist(), bg=color2.tolist()),
-                    prob=text_region.prob,
-                    angle=text_region.angle
-        ))
-        #todo: background angle
+def to_translation(regions: List[Dict[str, Any]], backgrounds: List[np.ndarray]) -> TranslationResponse:
+    """Builds the response from the text regions and inpainted backgrounds sent by an executor"""
+    results = [Translation(**region, background=background) for region, background in zip(regions, backgrounds)]
+    #todo: background angle
     return TranslationResponse(translations=results)
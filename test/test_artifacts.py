@@ -0,0 +1,69 @@
+import os
+import pickle
+
+import numpy as np
+
+from manga_translator.utils import ArtifactStore, Quadrilateral, TextBlock
+
+
+def test_artifacts_round_trip(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    line = Quadrilateral(np.array([[10, 5], [40, 5], [40, 20], [10, 20]]), 'text', np.float32(0.9), 1, 2, 3, 4, 5, 6)
+    line.textlines.append(Quadrilateral(np.array([[0, 0], [5, 0], [5, 5], [0, 5]]), '', 0.5))
+    line.aabb  # fills a cached property
+    region = TextBlock([line.pts], ['text'], font_size=12, translation='texte', fg_color=np.array([1, 2, 3]),
+                       shadow_color=(1, 2, 3))
+    region.polygon_object  # cached shapely polygon, which the store can't serialize
+    mask = np.random.randint(0, 255, (20, 30), dtype=np.uint8)
+    artifacts = {'textlines': [line], 'text_regions': [region], 'mask': mask, 'mask_raw': None,
+                 'translations': {'ENG': ['text'], '__tuple__': ['key that looks like a tag']}}
+
+    key = ArtifactStore.make_key('page', mask)
+    assert not store.exists(key)
+    assert store.load(key) is None
+    store.save(key, artifacts)
+    assert store.exists(key)
+    loaded = store.load(key)
+
+    assert loaded['translations'] == artifacts['translations']
+    assert loaded['mask_raw'] is None
+    np.testing.assert_array_equal(loaded['mask'], mask)
+    assert loaded['mask'].dtype == mask.dtype
+
+    loaded_line = loaded['textlines'][0]
+    assert isinstance(loaded_line, Quadrilateral)
+    np.testing.assert_array_equal(loaded_line.pts, line.pts)
+    assert (loaded_line.text, loaded_line.direction) == (line.text, line.direction)
+    np.testing.assert_array_equal(loaded_line.fg_colors, line.fg_colors)
+    np.testing.assert_array_equal(loaded_line.bg_colors, line.bg_colors)
+    assert loaded_line.prob == np.float32(0.9)
+    assert [loaded_line.aabb.x, loaded_line.aabb.y, loaded_line.aabb.w, loaded_line.aabb.h] == \
+           [line.aabb.x, line.aabb.y, line.aabb.w, line.aabb.h]
+    np.testing.assert_array_equal(loaded_line.textlines[0].pts, line.textlines[0].pts)
+
+    loaded_region = loaded['text_regions'][0]
+    assert isinstance(loaded_region, TextBlock)
+    np.testing.assert_array_equal(loaded_region.lines, region.lines)
+    np.testing.assert_array_equal(loaded_region.fg_colors, region.fg_colors)
+    assert loaded_region.shadow_color == (1, 2, 3)
+    assert (loaded_region.translation, loaded_region.font_size, loaded_region.direction) == \
+           (region.translation, region.font_size, region.direction)
+    assert loaded_region.polygon_object.equals(region.polygon_object)
+
+
+def test_artifacts_are_not_pickled(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError('artifacts must not be pickled')
+    monkeypatch.setattr(pickle, 'load', fail)
+    monkeypatch.setattr(pickle, 'loads', fail)
+
+    store = ArtifactStore(str(tmp_path))
+    key = ArtifactStore.make_key('page')
+    store.save(key, {'img_inpainted': np.zeros((4, 4, 3), dtype=np.uint8)})
+    assert store.load(key)['img_inpainted'].shape == (4, 4, 3)
+
+    # an object array can only be restored by unpickling, so it's rejected instead
+    path = store._file_path(key)
+    np.savez(path, __json__=np.array('{"__ndarray__": "a0"}'), a0=np.array([object()], dtype=object))
+    assert os.path.exists(path)
+    assert store.load(key) is None
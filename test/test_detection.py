@@ -0,0 +1,141 @@
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from manga_translator.detection.default_utils import imgproc
+from manga_translator.detection.default_utils.DBNet_resnet34 import TextDetection as TextDetectionDefault
+from manga_translator.detection.default_utils.dbnet_utils import SegDetectorRepresenter
+from manga_translator.detection.none import NoneDetector
+from manga_translator.utils.inference import OnnxModule
+
+
+def boxes_from_bitmap_reference(det: SegDetectorRepresenter, pred, bitmap, dest_width, dest_height):
+    """The per-contour loop that `boxes_from_bitmap` replaced, without the zero rows of the skipped contours"""
+    height, width = bitmap.shape
+    contours, _ = cv2.findContours((bitmap * 255).astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    boxes, scores = [], []
+    for contour in contours[:det.max_candidates]:
+        contour = contour.squeeze(1)
+        points, sside = det.get_mini_boxes(contour)
+        if sside < det.min_size:
+            continue
+        score = det.box_score_fast(pred, contour)
+        if det.box_thresh > score:
+            continue
+        box = det.unclip(np.array(points), unclip_ratio=det.unclip_ratio).reshape(-1, 1, 2)
+        box, sside = det.get_mini_boxes(box)
+        if sside < det.min_size + 2:
+            continue
+        box = np.array(box)
+        box[:, 0] = np.clip(np.round(box[:, 0] / width * dest_width), 0, dest_width)
+        box[:, 1] = np.clip(np.round(box[:, 1] / height * dest_height), 0, dest_height)
+        startidx = box.sum(axis=1).argmin()
+        boxes.append(np.roll(box, 4 - startidx, 0).astype(np.int64))
+        scores.append(score)
+    return np.array(boxes, dtype=np.int64).reshape(-1, 4, 2), np.array(scores, dtype=np.float32)
+
+
+def random_prediction(seed: int, height: int = 480, width: int = 640):
+    """A smooth probability map whose thresholded blobs have holes, islands in holes and thin parts"""
+    rng = np.random.default_rng(seed)
+    pred = cv2.GaussianBlur(rng.random((height, width)).astype(np.float32), (0, 0), rng.uniform(1, 4))
+    pred = (pred - pred.min()) / (pred.max() - pred.min())
+    return pred
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_boxes_from_bitmap_matches_per_contour_loop(seed):
+    pred = random_prediction(seed)
+    det = SegDetectorRepresenter(thresh=0.5, box_thresh=0.55)
+    dest_height, dest_width = (pred.shape[0], pred.shape[1]) if seed % 2 else (pred.shape[0] * 2, pred.shape[1] * 3)
+    bitmap = det.binarize(pred)
+    expected_boxes, expected_scores = boxes_from_bitmap_reference(det, pred, bitmap, dest_width, dest_height)
+    boxes, scores = det.boxes_from_bitmap(pred, bitmap, dest_width, dest_height)
+
+    assert len(expected_boxes) > 10
+    np.testing.assert_array_equal(boxes, expected_boxes)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-6)
+
+
+def test_boxes_from_bitmap_scores_hole_contours():
+    pred = np.zeros((100, 100), dtype=np.float32)
+    pred[20:80, 20:80] = 0.9
+    pred[40:60, 40:60] = 0.1
+    det = SegDetectorRepresenter(thresh=0.5, box_thresh=0.2)
+    boxes, scores = det.boxes_from_bitmap(pred, det.binarize(pred), 100, 100)
+    # the fills of the ring and of the boundary of its hole, which cuts the corners of the hole, both cover
+    # the low predictions inside the hole
+    assert len(boxes) == 2
+    np.testing.assert_allclose(sorted(scores), [(0.9 * 80 + 0.1 * 400) / 480, (0.9 * 3200 + 0.1 * 400) / 3600], rtol=1e-5)
+    assert det.boxes_from_bitmap(pred, np.zeros_like(pred, dtype=bool), 100, 100)[0].shape == (0, 4, 2)
+
+
+def apply_filters_reference(image: np.ndarray, invert: bool, gamma_correct: bool) -> np.ndarray:
+    """The inversion and the float gamma correction that the combined lookup table replaced"""
+    if invert:
+        image = cv2.bitwise_not(image)
+    if gamma_correct:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        gamma = np.log(0.5 * 255) / np.log(np.mean(gray))
+        image = np.power(image, gamma).clip(0, 255).astype(np.uint8)
+    return image
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('invert, gamma_correct', [(True, False), (False, True), (True, True)])
+def test_filter_lookup_table_matches_float_path(seed, invert, gamma_correct):
+    rng = np.random.default_rng(seed)
+    # dark, bright and mid gray pages
+    image = rng.integers(0, 256, (rng.integers(400, 900), rng.integers(400, 900), 3), dtype=np.uint8)
+    image = (image * rng.uniform(0.2, 1) + rng.uniform(0, 50)).clip(0, 255).astype(np.uint8)
+    original = image.copy()
+    filtered, add_border = NoneDetector()._apply_filters(image, invert, gamma_correct, False)
+
+    assert not add_border
+    np.testing.assert_array_equal(filtered, apply_filters_reference(image, invert, gamma_correct))
+    np.testing.assert_array_equal(image, original)
+
+
+def test_add_border_matches_zero_canvas():
+    detector = NoneDetector()
+    image = np.random.default_rng(0).integers(0, 256, (120, 300, 3), dtype=np.uint8)
+    for target in (400, 200):
+        side = max(image.shape[0], image.shape[1], target)
+        expected = np.zeros((side, side, 3), dtype=np.uint8)
+        expected[:image.shape[0], :image.shape[1]] = image
+        np.testing.assert_array_equal(detector._add_border(image, target), expected)
+
+
+@pytest.mark.parametrize('shape', [(300, 200, 3), (1000, 1500, 3), (1024, 512, 3)])
+def test_resize_aspect_ratio_pads_with_zeros(shape):
+    image = np.random.default_rng(0).integers(0, 256, shape, dtype=np.uint8)
+    resized, ratio, size_heatmap, pad_w, pad_h = imgproc.resize_aspect_ratio(image, 1024, cv2.INTER_LINEAR)
+
+    target_h, target_w = int(round(shape[0] * ratio)), int(round(shape[1] * ratio))
+    expected = np.zeros((-(-target_h // 256) * 256, -(-target_w // 256) * 256, 3), dtype=np.uint8)
+    expected[:target_h, :target_w] = cv2.resize(image, (target_w, target_h), interpolation=cv2.INTER_LINEAR)
+    np.testing.assert_array_equal(resized, expected)
+    assert (pad_h, pad_w) == (expected.shape[0] - target_h, expected.shape[1] - target_w)
+    assert size_heatmap == (expected.shape[1] // 2, expected.shape[0] // 2)
+
+
+def test_onnx_dbnet_matches_torch(tmp_path):
+    pytest.importorskip('onnx')
+    torch.manual_seed(0)
+    model = TextDetectionDefault()
+    weights_path = tmp_path / 'detect.ckpt'
+    torch.save(model.state_dict(), weights_path)
+    # exported at one size and run at others like `DefaultDetector` does
+    onnx_model = OnnxModule(model, (torch.zeros(1, 3, 256, 256),), str(tmp_path / 'detect.onnx'), str(weights_path),
+                            ['image'], ['db', 'mask'],
+                            {name: {0: 'batch', 2: 'height', 3: 'width'} for name in ('image', 'db', 'mask')})
+    assert not model.training
+
+    for shape in [(1, 3, 256, 256), (2, 3, 512, 768)]:
+        image = torch.rand(shape) * 2 - 1
+        with torch.no_grad():
+            expected = model(image)
+        for result, reference in zip(onnx_model(image), expected):
+            assert result.shape == reference.shape
+            torch.testing.assert_close(result, reference, rtol=1e-4, atol=1e-4)
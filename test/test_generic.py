@@ -0,0 +1,93 @@
+import cv2
+import numpy as np
+import pytest
+
+from manga_translator.utils import Quadrilateral, TextlineArray, warp_textlines
+
+
+def random_quadrilaterals(seed: int, count: int, size: int = 2000):
+    """Rotated and axis aligned rectangles as well as skewed quadrilaterals, as a list of point arrays"""
+    rng = np.random.default_rng(seed)
+    pts = []
+    for i in range(count):
+        cx, cy = rng.uniform(0, size, 2)
+        w, h = rng.uniform(10, 400), rng.uniform(10, 80)
+        angle = 0 if i % 3 == 0 else rng.uniform(-np.pi, np.pi)
+        rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        corners = np.array([[-w, -h], [w, -h], [w, h], [-w, h]]) / 2 @ rotation.T + [cx, cy]
+        if i % 3 == 2:
+            corners += rng.uniform(-8, 8, (4, 2))
+        pts.append(corners.astype(np.int64))
+    return pts
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_textline_array_matches_quadrilateral_properties(seed):
+    pts = random_quadrilaterals(seed, 300)
+    expected = [Quadrilateral(p, '', 1) for p in pts]
+    lines = TextlineArray([Quadrilateral(p, '', 1) for p in pts])
+
+    for q, line in zip(expected, lines):
+        np.testing.assert_array_equal(line.pts, q.pts)
+        np.testing.assert_array_equal(np.array(line.structure), np.array(q.structure))
+        assert line.valid == q.valid
+        assert line.is_axis_aligned == q.is_axis_aligned
+        assert line.is_approximate_axis_aligned == q.is_approximate_axis_aligned
+        np.testing.assert_allclose(line.aspect_ratio, q.aspect_ratio, rtol=1e-6)
+        np.testing.assert_allclose(line.font_size, q.font_size, rtol=1e-6)
+        np.testing.assert_allclose(line.cosangle, q.cosangle, rtol=1e-6, atol=1e-7)
+        np.testing.assert_allclose(line.angle, q.angle, rtol=1e-6, atol=1e-6)
+        np.testing.assert_allclose(line.centroid, q.centroid)
+        np.testing.assert_allclose(line.area, q.area, rtol=1e-9)
+
+
+def test_textline_array_shares_points():
+    lines = TextlineArray([Quadrilateral(p, '', 1) for p in random_quadrilaterals(0, 3)])
+    assert all(np.shares_memory(line.pts, lines.pts) for line in lines)
+    assert len(TextlineArray([])) == 0
+
+
+def get_transformed_region_reference(q: Quadrilateral, img: np.ndarray, direction: str, textheight: int) -> np.ndarray:
+    """The per-line warp that `warp_textlines` replaced"""
+    [l1a, l1b, l2a, l2b] = [a.astype(np.float32) for a in q.structure]
+    ratio = np.linalg.norm(l1b - l1a) / np.linalg.norm(l2b - l2a)
+    src_pts = q.pts.astype(np.int64).copy()
+    im_h, im_w = img.shape[:2]
+    x1, y1, x2, y2 = src_pts[:, 0].min(), src_pts[:, 1].min(), src_pts[:, 0].max(), src_pts[:, 1].max()
+    x1, y1, x2, y2 = np.clip(x1, 0, im_w), np.clip(y1, 0, im_h), np.clip(x2, 0, im_w), np.clip(y2, 0, im_h)
+    img_croped = img[y1: y2, x1: x2]
+    src_pts[:, 0] -= x1
+    src_pts[:, 1] -= y1
+    if direction == 'h':
+        h = max(int(textheight), 2)
+        w = max(int(round(textheight / ratio)), 2)
+    else:
+        w = max(int(textheight), 2)
+        h = max(int(round(textheight * ratio)), 2)
+    dst_pts = np.array([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]]).astype(np.float32)
+    M, _ = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
+    region = cv2.warpPerspective(img_croped, M, (w, h))
+    if direction == 'v':
+        region = cv2.rotate(region, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return region
+
+
+@pytest.mark.parametrize('threads', [1, 4])
+def test_warp_textlines_matches_per_line_warps(threads):
+    rng = np.random.default_rng(0)
+    img = cv2.GaussianBlur(rng.integers(0, 256, (2000, 2000, 3), dtype=np.uint8), (9, 9), 3)
+    lines = [Quadrilateral(p, '', 1) for p in random_quadrilaterals(1, 60)]
+    directions = ['h' if i % 2 else 'v' for i in range(len(lines))]
+    transformations = [q.get_transformation(img.shape, d, 48) for q, d in zip(lines, directions)]
+    max_width = max(w for _, _, (w, _) in transformations)
+    out = np.zeros((len(lines), 48, max_width, 3), dtype=np.uint8)
+    warp_textlines(img, transformations, out, threads)
+
+    for q, d, row, (_, _, (w, h)) in zip(lines, directions, out, transformations):
+        expected = get_transformed_region_reference(q, img, d, 48)
+        assert expected.shape == (h, w, 3)
+        np.testing.assert_array_equal(row[:, w:], 0)
+        # the exact transform differs from the RANSAC estimate by rounding only
+        diff = np.abs(row[:, :w].astype(np.int64) - expected)
+        assert diff.mean() < 0.5 and np.percentile(diff, 99) <= 2
+        np.testing.assert_array_equal(row[:, :w], q.get_transformed_region(img, d, 48))
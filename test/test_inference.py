@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+import pytest
+import torch
+
+from manga_translator.utils import ModelWrapper, model_residency
+
+
+class ToyModel(ModelWrapper):
+    _MODEL_SUB_DIR = 'test'
+
+    def __init__(self, key: str, features: int = 256, unload_delay: float = 0):
+        super().__init__()
+        self._key = key
+        self.features = features
+        self.unload_delay = unload_delay
+
+    async def _load(self, device: str):
+        self.model = torch.nn.Linear(self.features, self.features, bias=False)
+
+    async def _unload(self):
+        await asyncio.sleep(self.unload_delay)
+        del self.model
+
+    async def _infer(self):
+        pass
+
+
+class Pipeline:
+    def __init__(self, model: torch.nn.Module):
+        self.model = model
+
+
+@pytest.fixture
+def residency():
+    yield model_residency
+    model_residency.configure()
+    for model in list(model_residency._models):
+        asyncio.run(ModelWrapper.unload(model))
+
+
+def test_memory_footprint_counts_nested_modules():
+    model = ToyModel('toy')
+    linear = torch.nn.Linear(100, 100)
+    shared = torch.nn.Linear(10, 10)
+    model.pipeline = Pipeline(linear)
+    model.heads = {'a': [shared], 'b': shared}
+    model.name = 'not a module'
+    assert model.memory_footprint() == ((100 * 100 + 100 + 10 * 10 + 10) * 4, 0)
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_models_are_unloaded(residency):
+    a, b, c = ToyModel('a'), ToyModel('b'), ToyModel('c')
+    size = 256 * 256 * 4
+    model_residency.configure(ram_budget=2 * size)
+    await a.load('cpu')
+    await b.load('cpu')
+    await a.load('cpu')
+    assert model_residency.usage() == (2 * size, 0)
+
+    await c.load('cpu')
+    assert a.is_loaded() and not b.is_loaded() and c.is_loaded()
+    assert model_residency.usage() == (2 * size, 0)
+
+    # pinned models stay loaded even when they are the least recently used ones
+    async with model_residency.pinned(a, 'not a model'):
+        await b.load('cpu')
+        assert a.is_loaded() and b.is_loaded() and not c.is_loaded()
+
+
+@pytest.mark.asyncio
+async def test_unused_models_expire(residency):
+    a, b = ToyModel('a'), ToyModel('b')
+    model_residency.configure(ttl=0.2)
+    await a.load('cpu')
+    async with model_residency.pinned(b):
+        await b.load('cpu')
+        await asyncio.sleep(0.6)
+        assert not a.is_loaded() and b.is_loaded()
+    await asyncio.sleep(0.6)
+    assert not b.is_loaded()
+    assert model_residency.usage() == (0, 0)
+
+
+@pytest.mark.asyncio
+async def test_pinning_waits_for_unloading_without_blocking_the_loop(residency):
+    a, b = ToyModel('a', unload_delay=0.3), ToyModel('b')
+    model_residency.configure(ram_budget=256 * 256 * 4)
+    await a.load('cpu')
+    # unloads a on this event loop while b is loaded
+    eviction = asyncio.create_task(b.load('cpu'))
+    while a not in model_residency._evicting:
+        await asyncio.sleep(0.01)
+
+    start = time.monotonic()
+    async with model_residency.pinned(a):
+        assert time.monotonic() - start > 0.1
+        assert not a.is_loaded() and b.is_loaded()
+        await a.load('cpu')
+        # b is unloaded instead of the pinned model
+        assert a.is_loaded() and not b.is_loaded()
+    await eviction
@@ -0,0 +1,194 @@
+import random
+
+import numpy as np
+import pytest
+import torch
+
+from manga_translator.config import Inpainter, InpainterConfig
+from manga_translator.inpainting import dispatch as dispatch_inpainting, prepare as prepare_inpainting
+from manga_translator.inpainting.common import CommonInpainter
+from manga_translator.inpainting.hybrid import HybridInpainter
+from manga_translator.inpainting.inpainting_lama_mpe import LamaFourier, LamaMPEInpainter, merge_overlapping_tiles
+from manga_translator.utils.bubble import flat_background_color
+
+
+def merge_overlapping_tiles_reference(tiles):
+    """The pairwise merge loop that `merge_overlapping_tiles` replaced"""
+    tiles = [list(tile) for tile in tiles]
+    merged = True
+    while merged:
+        merged = False
+        for a in range(len(tiles)):
+            for b in range(len(tiles) - 1, a, -1):
+                ta, tb = tiles[a], tiles[b]
+                if ta[0] < tb[1] and tb[0] < ta[1] and ta[2] < tb[3] and tb[2] < ta[3]:
+                    tiles[a] = [min(ta[0], tb[0]), max(ta[1], tb[1]), min(ta[2], tb[2]), max(ta[3], tb[3])]
+                    del tiles[b]
+                    merged = True
+    return [tuple(tile) for tile in tiles]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_merge_overlapping_tiles(seed):
+    rng = random.Random(seed)
+    tiles = []
+    for _ in range(rng.randint(0, 60)):
+        y, x = rng.randint(0, 2000), rng.randint(0, 1500)
+        tiles.append((y, y + rng.randint(1, 200), x, x + rng.randint(1, 200)))
+    assert sorted(merge_overlapping_tiles(tiles)) == sorted(merge_overlapping_tiles_reference(tiles))
+
+
+@pytest.mark.asyncio
+async def test_roi_inpainting_matches_full_page_outside_mask():
+    torch.manual_seed(0)
+    inpainter = LamaMPEInpainter()
+    # randomly initialized, only the handling of the tiles is tested
+    inpainter.model = LamaFourier(build_discriminator=False, use_mpe=False)
+    inpainter.model.eval()
+    inpainter.device = 'cpu'
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (600, 800, 3), dtype=np.uint8)
+    mask = np.zeros((600, 800), dtype=np.uint8)
+    mask[50:80, 60:200] = 255
+    mask[400:440, 500:540] = 255
+    empty_mask = np.zeros_like(mask)
+    original = image.copy()
+
+    full, _ = await inpainter._infer_batch([image, image], [mask, empty_mask], InpainterConfig(inpainting_roi=False))
+    roi, roi_empty = await inpainter._infer_batch([image, image], [mask, empty_mask], InpainterConfig(inpainting_roi=True))
+
+    np.testing.assert_array_equal(image, original)
+    outside = mask < 127
+    np.testing.assert_array_equal(roi[outside], full[outside])
+    np.testing.assert_array_equal(roi[outside], image[outside])
+    assert not np.array_equal(roi[~outside], image[~outside])
+    # a page without tiles is returned as a copy that the caller can draw on
+    assert roi_empty is not image
+    np.testing.assert_array_equal(roi_empty, image)
+
+
+@pytest.mark.asyncio
+async def test_tiles_of_similar_sizes_share_a_forward_pass(monkeypatch):
+    torch.manual_seed(0)
+    inpainter = LamaMPEInpainter()
+    inpainter.model = LamaFourier(build_discriminator=False, use_mpe=False)
+    inpainter.model.eval()
+    inpainter.device = 'cpu'
+    shapes = []
+    forward = inpainter._forward
+
+    def recording_forward(img_torch, mask_torch, config):
+        shapes.append(tuple(img_torch.shape))
+        return forward(img_torch, mask_torch, config)
+    monkeypatch.setattr(inpainter, '_forward', recording_forward)
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (1000, 1000, 3), dtype=np.uint8)
+    mask = np.zeros((1000, 1000), dtype=np.uint8)
+    # tiles of 150x170, 200x140 and 230x250 pixels with their context
+    mask[100:122, 100:142] = 255
+    mask[100:172, 500:512] = 255
+    mask[500:602, 100:222] = 255
+    # and one of 260x320
+    mask[700:800, 700:860] = 255
+
+    result = await inpainter._infer_batch([image], [mask], InpainterConfig(inpainting_roi=True))
+    assert sorted(shapes) == [(1, 3, 384, 384), (3, 3, 256, 256)]
+    outside = mask < 127
+    np.testing.assert_array_equal(result[0][outside], image[outside])
+    assert not np.array_equal(result[0][~outside], image[~outside])
+
+
+class RecordingInpainter(CommonInpainter):
+    """Stands in for the neural inpainter of the hybrid inpainter, fills the masked areas with a marker colour"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    async def _inpaint(self, image, mask, config, inpainting_size=1024, verbose=False):
+        self.calls.append((image.copy(), mask.copy()))
+        result = image.copy()
+        result[mask > 0] = (255, 0, 255)
+        return result
+
+
+def hybrid_page(background: np.ndarray):
+    """Two masked text blocks drawn on `background`, one in its left and one in its right half"""
+    image = background.copy()
+    mask = np.zeros(image.shape[:2], dtype=np.uint8)
+    for x in (40, 200):
+        image[60:80, x:x + 60] = 30
+        mask[58:82, x - 2:x + 62] = 255
+    return image, mask
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('color', [255, 0])
+async def test_hybrid_fills_flat_backgrounds(color):
+    inpainter = HybridInpainter()
+    inpainter.inpainter = RecordingInpainter()
+    background = np.full((150, 300, 3), color, dtype=np.uint8)
+    image, mask = hybrid_page(background)
+    textured_image, textured_mask = hybrid_page(np.random.default_rng(0).integers(0, 256, (150, 300, 3), dtype=np.uint8))
+
+    results = await inpainter.inpaint_batch([image, image], [mask, np.zeros_like(mask)], InpainterConfig())
+    # pages whose masked areas are all on flat backgrounds don't go through the neural inpainter
+    assert inpainter.inpainter.calls == []
+    np.testing.assert_array_equal(results[0], background)
+    np.testing.assert_array_equal(results[1], image)
+    assert results[1] is not image
+
+    result = await inpainter.inpaint(textured_image, textured_mask, InpainterConfig())
+    assert len(inpainter.inpainter.calls) == 1
+    np.testing.assert_array_equal(inpainter.inpainter.calls[0][1], textured_mask)
+    np.testing.assert_array_equal(result[textured_mask == 0], textured_image[textured_mask == 0])
+
+
+@pytest.mark.asyncio
+async def test_hybrid_passes_only_textured_areas_to_the_inner_inpainter():
+    inpainter = HybridInpainter()
+    inpainter.inpainter = RecordingInpainter()
+    rng = np.random.default_rng(1)
+    background = np.full((150, 300, 3), 250, dtype=np.uint8)
+    # the right half is a screentone, the left one a white bubble with a little noise
+    background[:, 150:] = rng.integers(0, 256, (150, 150, 3), dtype=np.uint8)
+    background[:, :150] -= rng.integers(0, 5, (150, 150, 3), dtype=np.uint8)
+    image, mask = hybrid_page(background)
+    original = image.copy()
+
+    pages = await inpainter.inpaint_batch([image, image], [mask, mask], InpainterConfig())
+    np.testing.assert_array_equal(image, original)
+    # each page with only the textured text block masked and the flat one already filled
+    assert len(inpainter.inpainter.calls) == 2
+    for (inner_image, inner_mask), result in zip(inpainter.inpainter.calls, pages):
+        expected_mask = mask.copy()
+        expected_mask[:, :150] = 0
+        np.testing.assert_array_equal(inner_mask, expected_mask)
+        fill = inner_image[58:82, 38:102]
+        assert (np.abs(fill.astype(int) - 248) <= 2).all() and (fill == fill[0, 0]).all()
+        np.testing.assert_array_equal(result[:, :150], inner_image[:, :150])
+        assert (result[expected_mask > 0] == (255, 0, 255)).all()
+
+
+def test_flat_background_color():
+    ring = np.zeros((20, 20), dtype=bool)
+    ring[:3] = True
+    image = np.full((20, 20, 3), 255, dtype=np.uint8)
+    image[5:] = 0
+    np.testing.assert_array_equal(flat_background_color(image, ring), [255, 255, 255])
+    np.testing.assert_array_equal(flat_background_color(255 - image, ring), [0, 0, 0])
+    image[0, :4] = 0
+    # more than 3% of the ring differs from the median
+    assert flat_background_color(image, ring) is None
+    assert flat_background_color(image, np.zeros_like(ring)) is None
+
+
+@pytest.mark.asyncio
+async def test_hybrid_inpainter_rejects_itself_as_inner_inpainter():
+    config = InpainterConfig(hybrid_inpainter=Inpainter.hybrid)
+    with pytest.raises(ValueError):
+        await prepare_inpainting(Inpainter.hybrid, 'cpu', config)
+    with pytest.raises(ValueError):
+        await dispatch_inpainting(Inpainter.hybrid, np.zeros((8, 8, 3), dtype=np.uint8), np.zeros((8, 8), dtype=np.uint8), config)
@@ -0,0 +1,120 @@
+from typing import List
+
+import cv2
+import numpy as np
+import pytest
+from shapely.geometry import Polygon
+
+from manga_translator.mask_refinement.text_mask_utils import complete_mask, extend_rect, refine_mask
+from manga_translator.utils import Quadrilateral
+
+
+def complete_mask_reference(img: np.ndarray, mask: np.ndarray, textlines: List[Quadrilateral], keep_threshold = 1e-2, dilation_offset = 0, kernel_size = 3):
+    """The full page implementation that `complete_mask` replaced"""
+    bboxes = [txtln.aabb.xywh for txtln in textlines]
+    polys = [Polygon(txtln.pts) for txtln in textlines]
+    for (x, y, w, h) in bboxes:
+        cv2.rectangle(mask, (x, y), (x + w, y + h), (0), 1)
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask)
+
+    M = len(textlines)
+    textline_ccs = [np.zeros_like(mask) for _ in range(M)]
+    iinfo = np.iinfo(labels.dtype)
+    textline_rects = np.full(shape = (M, 4), fill_value = [iinfo.max, iinfo.max, iinfo.min, iinfo.min], dtype = labels.dtype)
+    ratio_mat = np.zeros(shape = (num_labels, M), dtype = np.float32)
+    dist_mat = np.zeros(shape = (num_labels, M), dtype = np.float32)
+    valid = False
+    for label in range(1, num_labels):
+        if stats[label, cv2.CC_STAT_AREA] <= 9:
+            continue
+        x1 = stats[label, cv2.CC_STAT_LEFT]
+        y1 = stats[label, cv2.CC_STAT_TOP]
+        w1 = stats[label, cv2.CC_STAT_WIDTH]
+        h1 = stats[label, cv2.CC_STAT_HEIGHT]
+        area1 = stats[label, cv2.CC_STAT_AREA]
+        cc_pts = np.array([[x1, y1], [x1 + w1, y1], [x1 + w1, y1 + h1], [x1, y1 + h1]])
+        cc_poly = Polygon(cc_pts)
+        for tl_idx in range(M):
+            area2 = polys[tl_idx].area
+            overlapping_area = polys[tl_idx].intersection(cc_poly).area
+            ratio_mat[label, tl_idx] = overlapping_area / min(area1, area2)
+            dist_mat[label, tl_idx] = polys[tl_idx].distance(cc_poly.centroid)
+        avg = np.argmax(ratio_mat[label])
+        area2 = polys[avg].area
+        if area1 >= area2:
+            continue
+        if ratio_mat[label, avg] <= keep_threshold:
+            avg = np.argmin(dist_mat[label])
+            area2 = polys[avg].area
+            unit = max(min([textlines[avg].font_size, w1, h1]), 10)
+            if dist_mat[label, avg] >= 0.5 * unit:
+                continue
+        textline_ccs[avg][y1:y1+h1, x1:x1+w1][labels[y1:y1+h1, x1:x1+w1] == label] = 255
+        textline_rects[avg, 0] = min(textline_rects[avg, 0], x1)
+        textline_rects[avg, 1] = min(textline_rects[avg, 1], y1)
+        textline_rects[avg, 2] = max(textline_rects[avg, 2], x1 + w1)
+        textline_rects[avg, 3] = max(textline_rects[avg, 3], y1 + h1)
+        valid = True
+
+    if not valid:
+        return None
+    textline_rects[:, 2] -= textline_rects[:, 0]
+    textline_rects[:, 3] -= textline_rects[:, 1]
+
+    final_mask = np.zeros_like(mask)
+    img = cv2.bilateralFilter(img, 17, 80, 80)
+    for i, cc in enumerate(textline_ccs):
+        x1, y1, w1, h1 = textline_rects[i]
+        text_size = min(w1, h1, textlines[i].font_size)
+        x1, y1, w1, h1 = extend_rect(x1, y1, w1, h1, img.shape[1], img.shape[0], int(text_size * 0.1))
+        dilate_size = max((int((text_size + dilation_offset) * 0.3) // 2) * 2 + 1, 3)
+        kern = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (dilate_size, dilate_size))
+        cc_region = np.ascontiguousarray(cc[y1: y1 + h1, x1: x1 + w1])
+        if cc_region.size == 0:
+            continue
+        img_region = np.ascontiguousarray(img[y1: y1 + h1, x1: x1 + w1])
+        cc_region = refine_mask(img_region, cc_region)
+        cc[y1: y1 + h1, x1: x1 + w1] = cc_region
+        x2, y2, w2, h2 = extend_rect(x1, y1, w1, h1, img.shape[1], img.shape[0], -(-dilate_size // 2))
+        cc[y2:y2+h2, x2:x2+w2] = cv2.dilate(cc[y2:y2+h2, x2:x2+w2], kern)
+        final_mask[y2:y2+h2, x2:x2+w2] = cv2.bitwise_or(final_mask[y2:y2+h2, x2:x2+w2], cc[y2:y2+h2, x2:x2+w2])
+    kern = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
+    return cv2.dilate(final_mask, kern)
+
+
+def synthetic_page(seed: int, width: int = 900, height: int = 1200):
+    """A page with horizontal lines of text, their textlines and a detection mask with some noise in it"""
+    rng = np.random.default_rng(seed)
+    img = np.full((height, width, 3), 240, dtype=np.uint8)
+    img += rng.integers(0, 15, img.shape, dtype=np.uint8)
+    textlines = []
+    y = 60
+    while y < height - 60:
+        scale = rng.uniform(0.8, 2)
+        text = ''.join(rng.choice(list('ABCDEFGHKMNPRSTWXYZ'), rng.integers(4, 14)))
+        (w, h), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, 3)
+        x = int(rng.integers(10, max(width - w - 10, 11)))
+        cv2.putText(img, text, (x, y + h), cv2.FONT_HERSHEY_SIMPLEX, scale, (20, 20, 20), 3)
+        textlines.append(Quadrilateral(np.array([[x - 4, y - 4], [x + w + 4, y - 4], [x + w + 4, y + h + baseline],
+                                                 [x - 4, y + h + baseline]]), '', 1))
+        y += h + baseline + int(rng.integers(20, 80))
+    mask = ((img.min(axis=2) < 128) * 255).astype(np.uint8)
+    for _ in range(20):
+        nx, ny = rng.integers(0, width - 8), rng.integers(0, height - 8)
+        mask[ny: ny + rng.integers(2, 8), nx: nx + rng.integers(2, 8)] = 255
+    return img, mask, textlines
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_complete_mask_matches_full_page_implementation(seed):
+    img, mask, textlines = synthetic_page(seed)
+    for dilation_offset in (0, 20):
+        expected = complete_mask_reference(img.copy(), mask.copy(), textlines, dilation_offset=dilation_offset)
+        result = complete_mask(img.copy(), mask.copy(), textlines, dilation_offset=dilation_offset)
+        assert expected is not None and expected.any()
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_complete_mask_without_textlines():
+    img, mask, _ = synthetic_page(0)
+    assert complete_mask(img, mask, []) is None
@@ -0,0 +1,89 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from manga_translator import Config, Context
+from manga_translator.manga_translator import _timed_stage
+from manga_translator.mode.protocol import STATUS_PROGRESS, STATUS_TIMING, FrameReader
+from manga_translator.mode.share import MangaShare
+from server.metrics import StageMetrics
+
+
+@pytest.mark.asyncio
+async def test_stage_timings_are_streamed_as_timing_frames():
+    share = MangaShare({'host': '127.0.0.1', 'port': '5003', 'kernel_size': 3})
+
+    @_timed_stage('detection')
+    async def run_detection(self, config: Config, ctx: Context):
+        await self._report_progress('detection')
+
+    ctx = Context(input=Image.new('RGB', (30, 20)))
+    await run_detection(share.manga, Config(), ctx)
+
+    reader = FrameReader()
+    frames = []
+    while not share.progress_queue.empty():
+        frames.extend(reader.feed(await share.progress_queue.get()))
+    reader.close()
+    assert [status for status, _ in frames] == [STATUS_PROGRESS, STATUS_TIMING]
+    assert bytes(frames[0][1]) == b'detection'
+
+    timing = json.loads(bytes(frames[1][1]))
+    assert timing == {'stage': 'detection', **ctx.timings['detection']}
+    assert timing['pixels'] == 600 and timing['regions'] == 0
+    assert timing['end'] - timing['start'] == pytest.approx(timing['duration'], abs=1e-3)
+
+
+def test_stage_metrics_render_prometheus_histograms():
+    metrics = StageMetrics()
+    metrics.observe({'ocr': {'duration': 0.2, 'pixels': 100}})
+    # nothing is collected until the metrics are enabled
+    assert 'stage="ocr"' not in metrics.render({}, {})
+
+    metrics.enabled = True
+    metrics.observe({'ocr': {'duration': 0.2, 'pixels': 100}, 'detection': {'duration': 3}})
+    metrics.observe({'ocr': {'duration': 0.05, 'pixels': 50}})
+    metrics.observe({'ocr': {'duration': 100, 'pixels': 10}})
+    lines = metrics.render({'requests_total': 4}, {'queue_size': 2}).splitlines()
+
+    ocr = [line for line in lines if line.startswith('manga_translator_stage_duration_seconds') and 'stage="ocr"' in line]
+    assert ocr == [
+        'manga_translator_stage_duration_seconds_bucket{stage="ocr",le="0.05"} 1',
+        'manga_translator_stage_duration_seconds_bucket{stage="ocr",le="0.1"} 1',
+        'manga_translator_stage_duration_seconds_bucket{stage="ocr",le="0.25"} 2',
+        'manga_translator_stage_duration_seconds_bucket{stage="ocr",le="0.5"} 2',
+        'manga_translator_stage_duration_seconds_bucket{stage="ocr",le="1"} 2',
+        'manga_translator_stage_duration_seconds_bucket{stage="ocr",le="2.5"} 2',
+        'manga_translator_stage_duration_seconds_bucket{stage="ocr",le="5"} 2',
+        'manga_translator_stage_duration_seconds_bucket{stage="ocr",le="10"} 2',
+        'manga_translator_stage_duration_seconds_bucket{stage="ocr",le="30"} 2',
+        'manga_translator_stage_duration_seconds_bucket{stage="ocr",le="60"} 2',
+        'manga_translator_stage_duration_seconds_bucket{stage="ocr",le="+Inf"} 3',
+        'manga_translator_stage_duration_seconds_sum{stage="ocr"} 100.25',
+        'manga_translator_stage_duration_seconds_count{stage="ocr"} 3',
+    ]
+    assert 'manga_translator_stage_duration_seconds_bucket{stage="detection",le="2.5"} 0' in lines
+    assert 'manga_translator_stage_duration_seconds_bucket{stage="detection",le="5"} 1' in lines
+    assert 'manga_translator_stage_pixels_total{stage="ocr"} 160' in lines
+    assert 'manga_translator_stage_pixels_total{stage="detection"} 0' in lines
+    assert lines[-4:] == ['# TYPE requests_total counter', 'requests_total 4', '# TYPE queue_size gauge', 'queue_size 2']
+    # the stages are sorted so the output is stable
+    assert lines.index('manga_translator_stage_duration_seconds_count{stage="detection"} 1') < lines.index(ocr[0])
+
+
+def test_metrics_endpoint_needs_the_metrics_flag(monkeypatch):
+    from server.main import app
+    metrics = StageMetrics()
+    monkeypatch.setattr('server.main.stage_metrics', metrics)
+    client = TestClient(app)
+    assert client.get('/metrics').status_code == 404
+
+    metrics.enabled = True
+    metrics.observe({'inpainting': {'duration': 1.5}})
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    assert 'manga_translator_stage_duration_seconds_count{stage="inpainting"} 1' in response.text
+    assert 'manga_translator_queue_size 0' in response.text
@@ -0,0 +1,146 @@
+import numpy as np
+import pytest
+import torch
+
+from manga_translator.ocr.common import plan_batches
+from manga_translator.ocr.model_48px import OCR, DecoderKVCache, average_char_colors, generate_square_subsequent_mask
+from manga_translator.utils import chunks
+from manga_translator.utils.generic import AvgMeter
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_plan_batches(seed):
+    rng = np.random.default_rng(seed)
+    widths = [int(w) for w in rng.lognormal(5, 1, 300)]
+    budget = 1048576
+    batches = plan_batches(widths, 48, budget)
+
+    assert sorted(i for batch in batches for i in batch) == list(range(len(widths)))
+    order = [i for batch in batches for i in batch]
+    assert [widths[i] for i in order] == sorted(widths)
+    for batch, next_batch in zip(batches, batches[1:] + [None]):
+        batch_widths = [max(widths[i], 1) for i in batch]
+        assert len(batch) <= 64
+        assert len(batch) == 1 or len(batch) * max(batch_widths) * 48 <= budget
+        assert max(batch_widths) <= 2 * min(batch_widths)
+        if next_batch is not None:
+            # a batch is only closed when the next crop does not fit into it
+            grown = batch_widths + [max(widths[next_batch[0]], 1)]
+            assert len(grown) > 64 or len(grown) * max(grown) * 48 > budget or max(grown) > 2 * min(grown)
+
+
+def test_plan_batches_without_limits_matches_fixed_chunks():
+    """Without the pixel budget and the width ratio, the batches are the chunks of 16 sorted crops used before"""
+    rng = np.random.default_rng(0)
+    widths = [int(w) for w in rng.integers(1, 2000, 200)]
+    perm = sorted(range(len(widths)), key=lambda x: widths[x])
+    assert plan_batches(widths, 48, float('inf'), max_batch_size=16, bucket_ratio=float('inf')) == list(chunks(perm, 16))
+    # unsorted batches keep the order of the crops
+    assert plan_batches(widths, 48, float('inf'), max_batch_size=16, bucket_ratio=float('inf'), sort=False) == \
+           list(chunks(list(range(len(widths))), 16))
+
+
+def decode_uncached(model, memory, input_mask, tokens):
+    """Runs the decoders over the whole prefix like training does, without any cache"""
+    decoded = model.embd(tokens)
+    causal_mask = generate_square_subsequent_mask(tokens.size(1))
+    for layer in model.decoders:
+        decoded = layer(decoded, memory, tgt_mask=causal_mask, memory_key_padding_mask=input_mask)
+    return decoded
+
+
+def test_kv_cached_decoding_matches_uncached_decoder():
+    torch.manual_seed(0)
+    model = OCR([f'c{i}' for i in range(100)], 32)
+    model.eval()
+    widths = [300, 180]
+    N, K, T = len(widths), 3, 12
+    img = torch.rand(N, 3, 48, max(widths)) * 2 - 1
+    generator = torch.Generator().manual_seed(0)
+
+    with torch.no_grad():
+        feats_lengths = torch.tensor([(w + 3) // 4 + 2 for w in widths])
+        memory, input_mask = model.encode(img, feats_lengths)
+        cache = DecoderKVCache(model.decoders, memory, input_mask, K, T)
+        tokens = torch.ones(N, K, 1, dtype=torch.long)
+        for step in range(T):
+            out = model.decode_step(tokens[:, :, step], cache, step)
+            expected = decode_uncached(model, memory.repeat_interleave(K, 0), input_mask.repeat_interleave(K, 0),
+                                       tokens.view(N * K, -1))[:, step]
+            assert (out.view(N * K, -1) - expected).abs().max() < 1e-4
+            # continue random hypotheses like the beam search does when it reselects them
+            parents = torch.randint(0, K, (N, K), generator=generator)
+            cache.reorder(parents, step)
+            tokens = tokens[torch.arange(N)[:, None], parents]
+            tokens = torch.cat([tokens, torch.randint(3, 100, (N, K, 1), generator=generator)], dim=2)
+
+
+def test_greedy_beam_search_matches_uncached_decoder():
+    torch.manual_seed(1)
+    model = OCR([f'c{i}' for i in range(100)], 32)
+    model.eval()
+    widths = [256, 100]
+    img = torch.rand(len(widths), 3, 48, max(widths)) * 2 - 1
+
+    with torch.no_grad():
+        results = model.infer_beam_batch_tensor(img, widths, beams_k=1, max_seq_length=10)
+        feats_lengths = torch.tensor([(w + 3) // 4 + 2 for w in widths])
+        memory, input_mask = model.encode(img, feats_lengths)
+        for i, (chars, prob, fg, bg) in enumerate(results):
+            tokens = torch.ones(1, 1, dtype=torch.long)
+            log_prob = 0.
+            for _ in range(len(chars)):
+                decoded = decode_uncached(model, memory[i: i + 1], input_mask[i: i + 1], tokens)[:, -1]
+                logprobs = model.pred(model.pred1(decoded)).log_softmax(-1)
+                log_prob += logprobs.max().item()
+                tokens = torch.cat([tokens, logprobs.argmax(-1, keepdim=True)], dim=1)
+                if tokens[0, -1] == 2:
+                    break
+            assert chars == tokens[0, 1:].tolist()
+            assert prob == pytest.approx(np.exp(log_prob), rel=1e-4)
+            assert len(fg) == len(bg) == 3
+
+
+def average_char_colors_reference(chars, fg_pred, bg_pred, fg_ind_pred, bg_ind_pred, start_tok, end_tok):
+    """The per-char AvgMeter loop that `average_char_colors` replaced"""
+    has_fg = (fg_ind_pred[:, 1] > fg_ind_pred[:, 0])
+    has_bg = (bg_ind_pred[:, 1] > bg_ind_pred[:, 0])
+    fr, fg, fb, br, bg, bb = (AvgMeter() for _ in range(6))
+    for chid, c_fg, c_bg, h_fg, h_bg in zip(chars, fg_pred, bg_pred, has_fg, has_bg):
+        if chid == start_tok:
+            continue
+        if chid == end_tok:
+            break
+        if h_fg.item():
+            fr(int(c_fg[0] * 255))
+            fg(int(c_fg[1] * 255))
+            fb(int(c_fg[2] * 255))
+        if h_bg.item():
+            br(int(c_bg[0] * 255))
+            bg(int(c_bg[1] * 255))
+            bb(int(c_bg[2] * 255))
+        else:
+            br(int(c_fg[0] * 255))
+            bg(int(c_fg[1] * 255))
+            bb(int(c_fg[2] * 255))
+    return [min(max(int(meter()), 0), 255) for meter in (fr, fg, fb, br, bg, bb)]
+
+
+def test_average_char_colors_matches_per_char_loop():
+    generator = torch.Generator().manual_seed(0)
+    N, L = 64, 40
+    chars = torch.randint(0, 20, (N, L), generator=generator)
+    # a few lines without chars, only start tokens or with the end token first
+    chars[0] = 2
+    chars[1, :5] = 1
+    chars[1, 5] = 2
+    # predictions slightly out of range are clamped like before
+    fg_pred = torch.rand(N, L, 3, generator=generator) * 1.2 - 0.1
+    bg_pred = torch.rand(N, L, 3, generator=generator) * 1.2 - 0.1
+    fg_ind_pred = torch.randn(N, L, 2, generator=generator)
+    bg_ind_pred = torch.randn(N, L, 2, generator=generator)
+
+    colors = average_char_colors(chars, fg_pred, bg_pred, fg_ind_pred, bg_ind_pred, 1, 2).tolist()
+    for i in range(N):
+        assert colors[i] == average_char_colors_reference(chars[i].tolist(), fg_pred[i], bg_pred[i], fg_ind_pred[i],
+                                                          bg_ind_pred[i], 1, 2)
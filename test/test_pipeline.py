@@ -0,0 +1,180 @@
+import asyncio
+import threading
+import time
+from typing import List
+
+import pytest
+from PIL import Image
+
+from manga_translator.config import Config
+from manga_translator.manga_translator import MangaTranslator, _timed_stage
+from manga_translator.utils import Context
+
+
+class FakeStagesTranslator(MangaTranslator):
+    """Runs two offloaded fake stages instead of the models and records when they ran"""
+
+    def __init__(self):
+        super().__init__({'kernel_size': 3})
+        self.spans = []
+        self.hook_threads = set()
+
+        async def hook(*args):
+            self.hook_threads.add(threading.current_thread())
+        self.add_progress_hook(hook)
+        self.add_timing_hook(hook)
+
+    async def _preload_models(self, config: Config):
+        pass
+
+    def _sleep(self, stage: str, ctxs: List[Context]):
+        start = time.perf_counter()
+        time.sleep(0.3)
+        self.spans.append((stage, ctxs[0].input.width, start, time.perf_counter()))
+
+    @_timed_stage('detection', offload=True)
+    async def _run_detection_batch(self, config: Config, ctxs: List[Context]):
+        self._sleep('detection', ctxs)
+
+    @_timed_stage('rendering', offload=True)
+    async def _run_text_rendering(self, config: Config, ctx: Context):
+        self._sleep('rendering', [ctx])
+
+    async def _analyse_batch(self, config: Config, ctxs: List[Context]) -> List[Context]:
+        await self._report_progress('detection')
+        await self._run_detection_batch(config, ctxs)
+        return ctxs
+
+    async def _translate_batch_text(self, config: Config, pending: List[Context]) -> List[Context]:
+        return pending
+
+    async def _finish_batch(self, config: Config, pending: List[Context]):
+        for ctx in pending:
+            await self._run_text_rendering(config, ctx)
+            ctx.result = ctx.input
+
+
+@pytest.mark.asyncio
+async def test_pipelined_pages_run_concurrently():
+    translator = FakeStagesTranslator()
+    images = [Image.new('RGB', (width, 8)) for width in (1, 2, 3)]
+
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+    ticking = asyncio.create_task(ticker())
+    try:
+        ctxs = [ctx async for ctx in translator.translate_pipelined(images, Config(), depth=1, batch_size=1)]
+    finally:
+        ticking.cancel()
+
+    assert [ctx.result.width for ctx in ctxs] == [1, 2, 3]
+    # the event loop kept running while the stages were blocking
+    assert ticks > 20
+    # the hooks are called on the event loop
+    assert translator.hook_threads == {threading.current_thread()}
+
+    spans = {(stage, page): (start, end) for stage, page, start, end in translator.spans}
+    # the detection of a page overlaps with the rendering of the previous one
+    assert any(spans[('detection', page + 1)][0] < spans[('rendering', page)][1]
+               and spans[('rendering', page)][0] < spans[('detection', page + 1)][1] for page in (1, 2))
+    # calls of the same stage never overlap
+    for stage in ('detection', 'rendering'):
+        stage_spans = sorted(span for (s, _), span in spans.items() if s == stage)
+        assert all(end <= next_start for (_, end), (next_start, _) in zip(stage_spans, stage_spans[1:]))
+
+
+@pytest.mark.asyncio
+async def test_coalesce_translations_skips_empty_groups(monkeypatch):
+    async def dispatch_translation(*args, **kwargs):
+        raise AssertionError('translator called without pages')
+    monkeypatch.setattr('manga_translator.manga_translator.dispatch_translation', dispatch_translation)
+
+    translator = FakeStagesTranslator()
+    translator.coalesce_pages = 2
+    await translator._coalesce_translations(Config(), [])
+    assert translator.hook_threads == set()
+
+
+class FakeCoalescingTranslator(FakeStagesTranslator):
+    """Translates pages like the pipeline does, with a fake translator that records its calls"""
+
+    def __init__(self, coalesce_pages: int, extra_lines: int = 0):
+        super().__init__()
+        self.coalesce_pages = coalesce_pages
+        self.extra_lines = extra_lines
+        self.calls = []
+
+    async def dispatch_translation(self, chain, queries, translator_config, use_mtpe, ctx, device):
+        self.calls.append(list(queries))
+        translations = [query.upper() for query in queries] + ['extra'] * self.extra_lines
+        ctx.translations = {'ENG': translations}
+        return translations
+
+    async def _translate_batch_text(self, config: Config, pending: List[Context]) -> List[Context]:
+        return await MangaTranslator._translate_batch_text(self, config, pending)
+
+    async def _translate_text(self, config: Config, ctx: Context) -> bool:
+        if ctx.get('coalesced_translations') is None:
+            ctx.coalesced_translations = await self.dispatch_translation(None, [r.text for r in ctx.text_regions],
+                                                                         None, False, ctx, 'cpu')
+        return True
+
+
+def text_pages(*counts: int) -> List[Context]:
+    pages = []
+    for page, count in enumerate(counts):
+        ctx = Context(input=Image.new('RGB', (8, 8)))
+        ctx.text_regions = [Context(text=f'p{page}r{i}') for i in range(count)]
+        pages.append(ctx)
+    return pages
+
+
+@pytest.mark.asyncio
+async def test_coalesce_translations_scatters_the_lines(monkeypatch):
+    translator = FakeCoalescingTranslator(coalesce_pages=3)
+    monkeypatch.setattr('manga_translator.manga_translator.dispatch_translation', translator.dispatch_translation)
+    pages = text_pages(2, 0, 3)
+    await translator._translate_batch_text(Config(), pages)
+
+    assert translator.calls == [['p0r0', 'p0r1', 'p2r0', 'p2r1', 'p2r2']]
+    assert [ctx.coalesced_translations for ctx in pages] == [['P0R0', 'P0R1'], [], ['P2R0', 'P2R1', 'P2R2']]
+    assert [ctx.translations for ctx in pages] == [{'ENG': ['P0R0', 'P0R1']}, {'ENG': []},
+                                                   {'ENG': ['P2R0', 'P2R1', 'P2R2']}]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_translations_splits_groups(monkeypatch):
+    translator = FakeCoalescingTranslator(coalesce_pages=2)
+    monkeypatch.setattr('manga_translator.manga_translator.dispatch_translation', translator.dispatch_translation)
+    # a request holds up to 4 lines
+    monkeypatch.setattr('manga_translator.manga_translator.within_request_limit', lambda chain, queries: len(queries) <= 4)
+    pages = text_pages(1, 1, 1, 3, 2, 2)
+    await translator._translate_batch_text(Config(), pages)
+
+    assert translator.calls == [['p0r0', 'p1r0'], ['p2r0', 'p3r0', 'p3r1', 'p3r2'], ['p4r0', 'p4r1', 'p5r0', 'p5r1']]
+    assert [len(ctx.coalesced_translations) for ctx in pages] == [1, 1, 1, 3, 2, 2]
+    assert pages[3].coalesced_translations == ['P3R0', 'P3R1', 'P3R2']
+
+    # a page that doesn't fit next to the previous ones, but alone, is translated on its own
+    translator.calls.clear()
+    pages = text_pages(3, 3)
+    await translator._translate_batch_text(Config(), pages)
+    assert translator.calls == [['p0r0', 'p0r1', 'p0r2'], ['p1r0', 'p1r1', 'p1r2']]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_translations_falls_back_on_wrong_line_count(monkeypatch):
+    translator = FakeCoalescingTranslator(coalesce_pages=3, extra_lines=1)
+    monkeypatch.setattr('manga_translator.manga_translator.dispatch_translation', translator.dispatch_translation)
+    pages = text_pages(2, 1, 2)
+    await translator._translate_batch_text(Config(), pages)
+
+    # the coalesced call and then one call per page
+    assert translator.calls == [['p0r0', 'p0r1', 'p1r0', 'p2r0', 'p2r1'], ['p0r0', 'p0r1'], ['p1r0'], ['p2r0', 'p2r1']]
+    assert [ctx.coalesced_translations for ctx in pages] == [['P0R0', 'P0R1', 'extra'], ['P1R0', 'extra'],
+                                                             ['P2R0', 'P2R1', 'extra']]
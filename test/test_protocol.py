@@ -0,0 +1,106 @@
+import json
+import struct
+
+import numpy as np
+import pytest
+
+from manga_translator.mode.protocol import FrameReader, decode_message, encode_frame, encode_message
+
+
+def test_message_round_trip():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (40, 60, 3), dtype=np.uint8)
+    buffers = {
+        'image': image,
+        'float': rng.random((7, 5), dtype=np.float32),
+        'bool': rng.random(13) > 0.5,
+        # non-contiguous views are packed contiguously
+        'crop': image[5:30:2, 10:50, ::-1],
+        'transposed': rng.random((4, 6)).astype(np.float32).T,
+        'empty': np.zeros((0, 3), dtype=np.uint8),
+        'bytes': b'encoded png',
+        'bytearray': bytearray(b'\x00\x01\x02'),
+        'memoryview': memoryview(b'view'),
+    }
+    meta = {'config': '{"a": 1}', 'regions': [{'text': 'é'}]}
+    decoded_meta, decoded = decode_message(encode_message(meta, buffers))
+
+    assert decoded_meta == meta
+    assert list(decoded) == list(buffers)
+    for name, buffer in buffers.items():
+        expected = buffer if isinstance(buffer, np.ndarray) else np.frombuffer(buffer, np.uint8)
+        assert decoded[name].dtype == expected.dtype
+        np.testing.assert_array_equal(decoded[name], expected)
+    assert decoded['bytes'].tobytes() == b'encoded png'
+    assert decode_message(encode_message({'regions': []})) == ({'regions': []}, {})
+
+
+def test_decoded_buffers_are_views_into_the_payload():
+    payload = bytearray(encode_message({}, {'a': np.arange(10, dtype=np.int16)}))
+    _, buffers = decode_message(payload)
+    assert np.shares_memory(buffers['a'], np.frombuffer(payload, np.uint8))
+
+
+def frames_and_stream():
+    payloads = [(1, b'detection'), (5, json.dumps({'stage': 'ocr'}).encode()), (1, b''),
+                (0, encode_message({'regions': []}, {'result': b'x' * 1000}))]
+    return payloads, b''.join(encode_frame(status, payload) for status, payload in payloads)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 5, 7, 64, 100000])
+def test_frame_reader_reassembles_chunks(chunk_size):
+    payloads, stream = frames_and_stream()
+    reader = FrameReader()
+    frames = []
+    for i in range(0, len(stream), chunk_size):
+        frames.extend(reader.feed(stream[i:i + chunk_size]))
+    reader.close()
+    assert [(status, bytes(payload)) for status, payload in frames] == payloads
+
+
+def test_frame_reader_splits_at_every_boundary():
+    payloads, stream = frames_and_stream()
+    for split in range(len(stream) + 1):
+        reader = FrameReader()
+        frames = reader.feed(memoryview(stream)[:split]) + reader.feed(stream[split:])
+        reader.close()
+        assert [(status, bytes(payload)) for status, payload in frames] == payloads
+
+
+def test_frame_reader_rejects_truncated_streams():
+    _, stream = frames_and_stream()
+    # cut within a header and within a payload
+    for end in (len(stream) - 1, len(encode_frame(1, b'detection')) + 2):
+        reader = FrameReader()
+        reader.feed(stream[:end])
+        with pytest.raises(ValueError):
+            reader.close()
+
+
+def test_frame_reader_rejects_oversized_frames():
+    reader = FrameReader(max_size=100)
+    assert reader.feed(encode_frame(1, b'x' * 100)) == [(1, bytearray(b'x' * 100))]
+    with pytest.raises(ValueError):
+        reader.feed(struct.pack('>BI', 0, 101))
+    with pytest.raises(ValueError):
+        FrameReader().feed(struct.pack('>BI', 0, 2**32 - 1))
+
+
+def test_decode_message_rejects_malformed_messages():
+    message = encode_message({'a': 1}, {'image': np.zeros((10, 10), dtype=np.uint8)})
+    # truncated in the header length, the header and the buffers
+    for end in (2, 10, len(message) - 1):
+        with pytest.raises(ValueError):
+            decode_message(message[:end])
+
+    def with_buffers(descriptions):
+        header = json.dumps({'meta': {}, 'buffers': descriptions}).encode()
+        return struct.pack('>I', len(header)) + header + bytes(16)
+
+    for desc in [{'offset': 8, 'nbytes': 16, 'shape': [16]},
+                 {'offset': -1, 'nbytes': 4, 'shape': [4]},
+                 {'offset': 0, 'nbytes': 4, 'shape': [8]}]:
+        with pytest.raises(ValueError):
+            decode_message(with_buffers([{'name': 'a', 'dtype': '|u1', **desc}]))
+    with pytest.raises(ValueError):
+        decode_message(with_buffers([{'name': 'a', 'dtype': '|O', 'offset': 0, 'nbytes': 8, 'shape': [1]}]))
@@ -47,3 +47,125 @@ async def test_default_renderer():
 
     img_rendered = await dispatch_rendering(img, regions, hyphenate=False)
     save_result('default1.png', img_rendered, regions)
+
+
+def test_glyph_atlas_saves_incrementally(tmp_path, monkeypatch):
+    from manga_translator.rendering.text_render import GlyphAtlas
+
+    font_path = 'fonts/anime_ace_3.ttf'
+    atlas = GlyphAtlas(str(tmp_path))
+    glyph = np.arange(6, dtype=np.uint8).reshape(2, 3)
+    atlas.put(font_path, (0, ord('a'), 20, 0, 0), list(range(10)), glyph, 2, 3)
+    atlas.put(font_path, (1, ord('a'), 20, 0, 64), [], None, 0, 0)
+    atlas.save()
+    assert len(os.listdir(tmp_path)) == 1
+    # nothing new, nothing written
+    atlas.save()
+    assert len(os.listdir(tmp_path)) == 1
+
+    atlas.put(font_path, (0, ord('b'), 20, 0, 0), list(range(10)), glyph + 1, 2, 3)
+    atlas.save()
+    chunks = atlas._chunks(font_path)
+    assert len(chunks) == 2
+    with np.load(chunks[0]) as first, np.load(chunks[1]) as second:
+        assert sorted([len(first['index']), len(second['index'])]) == [1, 2]
+
+    loaded = GlyphAtlas(str(tmp_path))
+    metrics, array, rows, width = loaded.get(font_path, (0, ord('b'), 20, 0, 0))
+    assert (metrics, rows, width) == (list(range(10)), 2, 3)
+    np.testing.assert_array_equal(array, glyph + 1)
+    assert loaded.get(font_path, (1, ord('a'), 20, 0, 64))[1:] == (None, 0, 0)
+
+    # too many chunks are merged into one when the atlas is loaded
+    monkeypatch.setattr(GlyphAtlas, '_MAX_CHUNKS', 1)
+    merged = GlyphAtlas(str(tmp_path))
+    np.testing.assert_array_equal(merged.get(font_path, (0, ord('a'), 20, 0, 0))[1], glyph)
+    assert len(merged._chunks(font_path)) == 1
+    assert len(GlyphAtlas(str(tmp_path))._load(font_path)) == 3
+
+
+def test_glyph_atlas_keeps_at_most_max_bytes_in_memory(tmp_path, monkeypatch):
+    from manga_translator.rendering.text_render import GlyphAtlas
+
+    monkeypatch.setattr(GlyphAtlas, '_MAX_BYTES', 300)
+    font_path = 'fonts/anime_ace_3.ttf'
+    atlas = GlyphAtlas(str(tmp_path))
+    glyphs = {ord(c): np.full((10, 10), i, dtype=np.uint8) for i, c in enumerate('abcde')}
+    for codepoint, glyph in glyphs.items():
+        atlas.put(font_path, (0, codepoint, 20, 0, 0), [], glyph, 10, 10)
+    # unsaved bitmaps are kept until they are written
+    assert all(atlas.get(font_path, (0, codepoint, 20, 0, 0)) is not None for codepoint in glyphs)
+    atlas.save()
+    assert atlas._cache_bytes == 300 and len(atlas._cache) == 3
+
+    # the least recently used bitmaps were dropped
+    key = lambda c: (0, ord(c), 20, 0, 0)
+    assert atlas.get(font_path, key('a')) is None and atlas.get(font_path, key('b')) is None
+    assert atlas.get(font_path, key('c')) is not None
+    atlas.put(font_path, key('a'), [], glyphs[ord('a')], 10, 10)
+    assert atlas.get(font_path, key('d')) is None
+    np.testing.assert_array_equal(atlas.get(font_path, key('a'))[1], glyphs[ord('a')])
+    # a bitmap that is already saved isn't written again
+    atlas.save()
+    assert len(atlas._chunks(font_path)) == 1
+
+    # loading only keeps the last bitmaps of the chunks in memory
+    loaded = GlyphAtlas(str(tmp_path))
+    assert len(loaded._load(font_path)) == 5
+    assert loaded._cache_bytes == 300
+    np.testing.assert_array_equal(loaded.get(font_path, key('e'))[1], glyphs[ord('e')])
+
+
+def render_reference(img, box, dst_points):
+    """Warps the text box into a full page buffer and blends its bounding rect in floating point"""
+    src_points = np.array([[0, 0], [box.shape[1], 0], [box.shape[1], box.shape[0]], [0, box.shape[0]]]).astype(np.float32)
+    M, _ = cv2.findHomography(src_points, dst_points, cv2.RANSAC, 5.0)
+    rgba_region = cv2.warpPerspective(box, M, (img.shape[1], img.shape[0]), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    x, y, w, h = cv2.boundingRect(dst_points.astype(np.int32))
+    # negative coordinates wrapped around here before, the rect is clipped to the page instead
+    x1, y1, x2, y2 = max(x, 0), max(y, 0), x + w, y + h
+    img = img.copy()
+    canvas_region = rgba_region[y1:y2, x1:x2, :3]
+    mask_region = rgba_region[y1:y2, x1:x2, 3:4].astype(np.float32) / 255.0
+    img[y1:y2, x1:x2] = np.clip((img[y1:y2, x1:x2].astype(np.float32) * (1 - mask_region) + canvas_region.astype(np.float32) * mask_region), 0, 255).astype(np.uint8)
+    return img
+
+
+@pytest.mark.parametrize('dst_points', [
+    [[100, 80], [300, 80], [300, 180], [100, 180]],
+    [[120, 60], [310, 90], [290, 200], [100, 170]],
+    # clipped at the top left and at the bottom right of the page
+    [[-50, -30], [150, -30], [150, 70], [-50, 70]],
+    [[330, 200], [460, 230], [450, 330], [320, 300]],
+    # fully off the page
+    [[-300, 50], [-100, 50], [-100, 150], [-300, 150]],
+    [[420, 310], [520, 310], [520, 400], [420, 400]],
+])
+def test_render_warps_into_the_destination_rect(monkeypatch, dst_points):
+    from manga_translator import rendering
+
+    rng = np.random.default_rng(0)
+    boxes = []
+
+    def put_text_horizontal(font_size, text, width, height, *args):
+        # a box of the size of the destination isn't padded to its aspect ratio
+        box = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+        # transparent and opaque pixels besides the partially transparent ones
+        box[:10, :, 3] = 0
+        box[-10:, :, 3] = 255
+        boxes.append(box)
+        return box.copy()
+    monkeypatch.setattr(rendering.text_render, 'put_text_horizontal', put_text_horizontal)
+
+    img = rng.integers(0, 256, (300, 400, 3), dtype=np.uint8)
+    region = TextBlock([[[0, 0], [100, 0], [100, 50], [0, 50]]], texts=['text'], translation='text', font_size=20)
+    region.set_font_colors([0, 0, 0], [255, 255, 255])
+    dst_points = np.array([dst_points], dtype=np.float32)
+
+    rendered = rendering.render(img.copy(), region, dst_points, False, 0, False)
+    expected = render_reference(img, boxes[0], dst_points[0])
+    assert rendered.dtype == np.uint8
+    assert np.abs(rendered.astype(np.int16) - expected).max() <= 1
+    # regions off the page leave it untouched
+    on_page = (dst_points[0].max(0) > 0).all() and (dst_points[0].min(0) < img.shape[1::-1]).all()
+    assert (rendered != img).any() == on_page
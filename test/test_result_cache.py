@@ -0,0 +1,113 @@
+import io
+import threading
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import server.request_extraction
+import server.result_cache
+from manga_translator import Config
+from server.result_cache import ResultCache
+
+
+def result(nbytes: int):
+    """The cache only looks at the size of a result"""
+    return SimpleNamespace(nbytes=nbytes)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(server.result_cache.time, 'monotonic', lambda: clock.now)
+    return clock
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = ResultCache(max_bytes=1000, ttl=10)
+    first = result(100)
+    cache.put('a', first)
+    clock.now += 9
+    assert cache.get('a') is first
+    clock.now += 2
+    assert cache.get('a') is None
+    assert cache.stats().entries == 0 and cache.stats().bytes == 0
+
+    # expired entries are dropped when another result is added
+    cache.put('b', result(100))
+    clock.now += 11
+    cache.put('c', result(100))
+    assert cache.stats().entries == 1 and cache.stats().bytes == 100
+
+
+def test_least_recently_used_entries_are_evicted_by_size(clock):
+    cache = ResultCache(max_bytes=1000, ttl=60)
+    for key in 'abc':
+        cache.put(key, result(300))
+    assert cache.get('a') is not None
+    cache.put('d', result(300))
+    assert cache.get('b') is None
+    assert all(cache.get(key) is not None for key in 'acd')
+    assert cache.stats().bytes == 900
+
+    # a large result evicts as many entries as needed, one larger than the cache isn't stored
+    cache.put('e', result(700))
+    assert [key for key in 'acde' if cache.get(key) is not None] == ['d', 'e']
+    cache.put('f', result(1001))
+    assert cache.get('f') is None and cache.stats().bytes == 1000
+
+    # replacing an entry replaces its size
+    cache.put('e', result(100))
+    assert cache.stats().bytes == 400
+
+
+def test_size_zero_disables_the_cache():
+    cache = ResultCache(max_bytes=0)
+    cache.put('a', result(1))
+    assert cache.get('a') is None
+    assert cache.stats().entries == 0
+    assert cache.stats().hits == cache.stats().misses == 0
+
+
+def test_cache_stats_endpoint(monkeypatch):
+    from server.main import app
+    cache = ResultCache(max_bytes=1000)
+    monkeypatch.setattr('server.main.result_cache', cache)
+    cache.put('a', result(100))
+    cache.get('a')
+    cache.get('a')
+    cache.get('b')
+
+    stats = TestClient(app).get('/cache-stats').json()
+    assert stats == {'entries': 1, 'bytes': 100, 'max_bytes': 1000, 'hits': 2, 'misses': 1, 'hit_rate': 2 / 3}
+    assert ResultCache().stats().hit_rate == 0.0
+
+
+def encode(image: Image.Image) -> bytes:
+    data = io.BytesIO()
+    image.save(data, format='PNG')
+    return data.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_cache_key_is_computed_off_the_event_loop(monkeypatch):
+    threads = []
+    key = ResultCache.key
+
+    def recording_key(image, config):
+        threads.append(threading.current_thread())
+        return key(image, config)
+    monkeypatch.setattr(server.request_extraction.result_cache, 'key', recording_key)
+
+    image = Image.new('RGB', (64, 32), (255, 0, 0))
+    first = await server.request_extraction.cache_key(encode(image), Config())
+    assert threads and threading.current_thread() not in threads
+    # the key depends on the pixels and the config, not on the encoding
+    assert first == key(image, Config())
+    assert first == await server.request_extraction.cache_key(encode(image.convert('RGB')), Config())
+    assert first != await server.request_extraction.cache_key(encode(Image.new('RGB', (64, 32))), Config())
+    assert first != await server.request_extraction.cache_key(encode(image), Config(kernel_size=5))
+    with pytest.raises(HTTPException):
+        await server.request_extraction.cache_key(b'not an image', Config())
@@ -0,0 +1,200 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from pydantic import PrivateAttr
+
+import server.instance
+import server.myqueue
+from manga_translator import Config
+from server.instance import ExecutorInstance, Executors
+from server.myqueue import PRIORITIES, QueueElement, TaskQueue, wait_in_queue
+
+
+class FakeRequest:
+    def __init__(self, host: str = '10.0.0.1', **headers):
+        self.headers = headers
+        self.client = SimpleNamespace(host=host)
+        self.disconnected = False
+
+    async def is_disconnected(self) -> bool:
+        return self.disconnected
+
+
+class FakeProcess:
+    def __init__(self, args):
+        self.args = args
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        self.returncode = -9
+
+    def wait(self):
+        return self.returncode
+
+
+class FakeExecutor(ExecutorInstance):
+    """Answers health checks and requests without a server behind it"""
+    _alive: bool = PrivateAttr(True)
+    _fail: bool = PrivateAttr(False)
+
+    async def is_alive(self, timeout: float = 5) -> bool:
+        return self._alive and not self.process_exited()
+
+    async def sent(self, image, config, headers=None) -> bytes:
+        await asyncio.sleep(0)
+        if self._fail:
+            raise ConnectionError('executor went away')
+        return image
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    queue = TaskQueue()
+    queue.nonce = 'secret'
+    monkeypatch.setattr(server.myqueue, 'task_queue', queue)
+    return queue
+
+
+@pytest.fixture
+def executors(monkeypatch):
+    executors = Executors()
+    monkeypatch.setattr(server.myqueue, 'executor_instances', executors)
+    monkeypatch.setattr(server.instance.subprocess, 'Popen', FakeProcess)
+    return executors
+
+
+def task(name: str, host: str = '10.0.0.1', **headers) -> QueueElement:
+    return QueueElement(FakeRequest(host, **headers), name.encode(), Config(), 0)
+
+
+def names(queue: TaskQueue):
+    return [t.image.decode() for t in queue.queue]
+
+
+def test_priority_and_client_headers_need_the_nonce(queue):
+    untrusted = task('a', **{'X-Priority': 'high', 'X-Client-Id': 'forged'})
+    assert (untrusted.priority, untrusted.client) == (PRIORITIES['normal'], '10.0.0.1')
+    wrong_nonce = task('b', **{'X-Priority': 'high', 'X-Client-Id': 'forged', 'X-Nonce': 'guess'})
+    assert (wrong_nonce.priority, wrong_nonce.client) == (PRIORITIES['normal'], '10.0.0.1')
+    trusted = task('c', **{'X-Priority': 'High', 'X-Client-Id': 'user', 'X-Nonce': 'secret'})
+    assert (trusted.priority, trusted.client) == (PRIORITIES['high'], 'user')
+    unknown = task('d', **{'X-Priority': 'urgent', 'X-Nonce': 'secret'})
+    assert (unknown.priority, unknown.client) == (PRIORITIES['normal'], '10.0.0.1')
+
+    queue.nonce = None
+    assert task('e', **{'X-Priority': 'high', 'X-Nonce': ''}).priority == PRIORITIES['normal']
+
+
+@pytest.mark.asyncio
+async def test_queue_orders_by_priority_then_client_rounds(queue):
+    for i in range(3):
+        queue.add_task(task(f'a{i}', 'a'))
+    queue.add_task(task('b0', 'b'))
+    queue.add_task(task('low', 'c', **{'X-Priority': 'low', 'X-Nonce': 'secret'}))
+    queue.add_task(task('b1', 'b'))
+    queue.add_task(task('high', 'd', **{'X-Priority': 'high', 'X-Nonce': 'secret'}))
+    assert names(queue) == ['high', 'a0', 'b0', 'a1', 'b1', 'a2', 'low']
+    assert [queue.get_pos(t) for t in queue.queue] == list(range(7))
+
+    # a new client starts at the round being served instead of the first one
+    for _ in range(3):
+        await queue.remove(queue.queue[0])
+    queue.add_task(task('e0', 'e'))
+    queue.add_task(task('e1', 'e'))
+    assert names(queue) == ['e0', 'a1', 'b1', 'e1', 'a2', 'low']
+    for _ in range(2):
+        await queue.remove(queue.queue[0])
+    queue.add_task(task('f0', 'f'))
+    assert names(queue) == ['b1', 'e1', 'f0', 'a2', 'low']
+
+    removed = queue.queue[0]
+    await queue.remove(removed)
+    assert queue.get_pos(removed) is None
+    assert not queue.discard(removed)
+
+
+@pytest.mark.asyncio
+async def test_remove_disconnected(queue):
+    tasks = [task(f'a{i}', 'a') for i in range(2)] + [task('b0', 'b')]
+    for t in tasks:
+        queue.add_task(t)
+    for t in tasks[:2]:
+        t.req.disconnected = True
+    await queue.remove_disconnected()
+
+    assert names(queue) == ['b0']
+    assert tasks[0].key is not None and queue.get_pos(tasks[0]) is None
+    # the rounds of the client are forgotten with its tasks
+    assert queue._last_round == {(PRIORITIES['normal'], 'b'): 0}
+
+
+@pytest.mark.asyncio
+async def test_find_executor_waits_for_a_free_one(queue, executors):
+    first, second = FakeExecutor(ip='127.0.0.1', port=1), FakeExecutor(ip='127.0.0.1', port=2)
+    executors.register(first)
+    executors.register(second)
+    assert await executors.find_executor() is first
+    assert await executors.find_executor() is second
+    assert first.busy and executors.free_executors() == 0
+
+    waiting = asyncio.create_task(executors.find_executor())
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+    await executors.free_executor(second)
+    assert await waiting is second
+
+
+@pytest.mark.asyncio
+async def test_failed_executor_leaves_the_pool(queue, executors):
+    failing, working = FakeExecutor(ip='127.0.0.1', port=1), FakeExecutor(ip='127.0.0.1', port=2)
+    failing._fail = True
+    executors.register(failing)
+    executors.register(working)
+
+    first = task('first')
+    queue.add_task(first)
+    with pytest.raises(ConnectionError):
+        await wait_in_queue(first, None)
+    assert not failing._healthy and not failing.busy
+    assert list(executors.free) == [working]
+
+    # the next tasks only go to the healthy executor
+    for name in ('second', 'third'):
+        t = task(name)
+        queue.add_task(t)
+        assert await wait_in_queue(t, None) == name.encode()
+    assert list(executors.free) == [working]
+
+    # the executor is handed out again once it answers the health check
+    failing._fail = False
+    await executors.check_health()
+    assert failing._healthy and list(executors.free) == [working, failing]
+
+
+@pytest.mark.asyncio
+async def test_crashed_executor_process_is_restarted(queue, executors):
+    instance = FakeExecutor(ip='127.0.0.1', port=1)
+    instance.start_process(['executor'])
+    executors.register(instance)
+    assert executors.free_executors() == 0
+    await executors.check_health()
+    assert executors.free_executors() == 1
+
+    crashed = instance._process
+    crashed.returncode = 1
+    executors.mark_failed(instance)
+    assert instance._process is not crashed and instance._process.args == ['executor']
+    assert not instance._healthy and executors.free_executors() == 0
+    await executors.check_health()
+    assert instance._healthy and executors.free_executors() == 1
+
+    # executors that registered themselves are dropped when they stop answering
+    remote = FakeExecutor(ip='10.0.0.2', port=1)
+    executors.register(remote)
+    remote._alive = False
+    await executors.check_health()
+    assert remote not in executors.list and remote not in executors.free
@@ -365,3 +365,39 @@ async def test_merge_image10():
     # print((await generate_combinations(lines, width, height))[0])
     expected_combinations = [[0, 9], [1, 6, 8, 11], [2], [3, 4], [5, 7, 10], [12, 13]]
     await run_test(lines, expected_combinations, width, height, '10.png')
+
+
+def random_textlines(seed: int, count: int, size: int = 1500) -> List[Quadrilateral]:
+    rng = np.random.default_rng(seed)
+    lines = []
+    for _ in range(count):
+        cx, cy = rng.uniform(0, size, 2)
+        length, thickness = rng.uniform(60, 500), rng.uniform(15, 60)
+        w, h = (length, thickness) if rng.random() < 0.5 else (thickness, length)
+        angle = np.deg2rad(rng.uniform(-8, 8))
+        rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        corners = np.array([[-w, -h], [w, -h], [w, h], [-w, h]]) / 2 @ rotation.T + [cx, cy]
+        lines.append(Quadrilateral(corners.astype(np.int64), '', 1))
+    return lines
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_neighbouring_quadrilaterals_match_all_pairs(seed):
+    """The grid only prunes pairs that can't be merged, compared with testing every pair like before"""
+    import itertools
+    import networkx as nx
+    from manga_translator.utils import quadrilateral_can_merge_region, neighbouring_quadrilaterals, connected_components
+
+    bboxes = random_textlines(seed, 150)
+    for kwargs in ({}, {'aspect_ratio_tol': 1}, {'aspect_ratio_tol': 1.3, 'font_size_ratio_tol': 2,
+                                                 'char_gap_tolerance': 1, 'char_gap_tolerance2': 3}):
+        expected = [(u, v) for u, v in itertools.combinations(range(len(bboxes)), 2)
+                    if quadrilateral_can_merge_region(bboxes[u], bboxes[v], **kwargs)]
+        edges = [(u, v) for u, v in neighbouring_quadrilaterals(bboxes)
+                 if quadrilateral_can_merge_region(bboxes[u], bboxes[v], **kwargs)]
+        assert edges == expected
+
+        G = nx.Graph()
+        G.add_nodes_from(range(len(bboxes)))
+        G.add_edges_from(expected)
+        assert connected_components(len(bboxes), edges) == list(nx.connected_components(G))
@@ -1,4 +1,7 @@
+import asyncio
+import time
 import pytest
+from omegaconf import OmegaConf
 
 from manga_translator.translators import (
     TRANSLATORS,
@@ -6,8 +9,11 @@ from manga_translator.translators import (
     OfflineTranslator,
     MissingAPIKeyException,
     dispatch,
+    TranslationCache,
 )
-from manga_translator.translators.common import LanguageUnsupportedException
+from manga_translator.translators.common import CommonTranslator, LanguageUnsupportedException
+from manga_translator.translators.config_gpt import ConfigGPT
+from manga_translator.translators.qwen2 import Qwen2Translator
 
 @pytest.mark.asyncio
 async def test_mixed_languages():
@@ -56,3 +62,47 @@ async def test_offline_translators():
             continue
         chain = TranslatorChain(f'{key}:ENG')
         print(await dispatch(chain, queries))
+
+def test_translation_cache(tmp_path):
+    cache = TranslationCache(str(tmp_path / 'translations.db'), max_entries=2)
+    cache.put('sugoi', 'JPN', 'ENG', ['こんにちは', '目標'], ['Hello', 'Goal'])
+    assert cache.get('sugoi', 'JPN', 'ENG', ['こんにちは', '目標  ', '世界']) == ['Hello', 'Goal', None]
+    assert cache.get('deepl', 'JPN', 'ENG', ['こんにちは']) == [None]
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # The least recently used entry is evicted
+    time.sleep(0.05)
+    cache.get('sugoi', 'JPN', 'ENG', ['こんにちは'])
+    cache.put('sugoi', 'JPN', 'ENG', ['世界'], ['World'])
+    assert len(cache) == 2
+    assert cache.get('sugoi', 'JPN', 'ENG', ['こんにちは', '目標', '世界']) == ['Hello', None, 'World']
+
+    # Changing the config or the glossary of a translator misses the cache
+    class CountingTranslator(ConfigGPT, CommonTranslator):
+        _LANGUAGE_CODE_MAP = {'JPN': 'Japanese', 'ENG': 'English'}
+
+        def __init__(self):
+            ConfigGPT.__init__(self, config_key='counting')
+            CommonTranslator.__init__(self)
+            self.calls = 0
+
+        async def _translate(self, from_lang, to_lang, queries):
+            self.calls += 1
+            return [f'{query}!' for query in queries]
+
+    translator = CountingTranslator()
+    translator._CACHE = TranslationCache(str(tmp_path / 'fingerprints.db'))
+    translate = lambda: asyncio.run(translator.translate('JPN', 'ENG', ['こんにちは']))
+    assert translate() == translate() == ['こんにちは!']
+    assert translator.calls == 1
+    translator.config = OmegaConf.create({'temperature': 0.1})
+    translate()
+    assert translator.calls == 2
+    translator.glossary_entries = {'こんにちは': 'Good day'}
+    translate()
+    assert translator.calls == 3
+    translate()
+    assert translator.calls == 3
+
+    # The GPT settings of offline translators are part of their fingerprint too
+    assert Qwen2Translator._cache_settings is ConfigGPT._cache_settings